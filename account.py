@@ -0,0 +1,147 @@
+"""
+Streamed account values and the portfolio risk allocator that sizes the brackets.
+
+share_size used to size every bracket against a hard coded account size
+with a fixed risk percent, whatever the account was actually worth, how
+much risk was already open or how much buying power was left.  Asking
+TWS for those on every entry would add round trips to the entry path.
+
+Instead:
+- Account keeps the account values TWS streams in memory.  ib_insync
+    subscribes to the account updates when it connects, so nothing is
+    requested here, accountValueEvent just keeps the values current
+- RiskAllocator sizes brackets against that equity.  Each bracket risks
+    risk_percent of the equity, and together with the risk already open
+    they are held under max_open_risk_percent of the equity and under
+    the buying power.  The open risk is the distance to the stop of
+    every working stop loss, read from the OrderBook and the positions
+
+A batch of brackets (e.g. every staged entry at the top of the hour) is
+sized in one computation.  When the batch would go over a cap every
+bracket in it is scaled down by the same factor, so the first ticker
+in the batch gets no priority over the last.
+
+Everything is read from memory, so sizing an entry adds no latency.
+Until the account values arrive the equity falls back to the account
+size the bot was configured with.
+"""
+
+import numpy as np
+
+# Account values kept, all in CURRENCY
+TAGS = ("NetLiquidation", "BuyingPower", "AvailableFunds")
+CURRENCY = "USD"
+
+
+class Account:
+    """ In memory account values, kept up to date from the accountValueEvent """
+
+    def __init__(self, ib, fallback_equity, account=""):
+        self.ib = ib
+        self.fallback_equity = fallback_equity
+        self.account = account    # Needed when TWS manages more than one account
+        self.values = {}          # tag -> float
+
+        ib.accountValueEvent += self._on_value
+
+    def sync(self):
+        """ Pick up the values streamed before the event was connected. Call once after connecting """
+        for value in self.ib.accountValues(self.account):
+            self._on_value(value)
+
+    @property
+    def equity(self):
+        return self.values.get("NetLiquidation", self.fallback_equity)
+
+    @property
+    def buying_power(self):
+        return self.values.get("BuyingPower", float("inf"))
+
+    def positions(self):
+        """ Returns a dict of symbol -> (quantity, average cost) """
+        return {
+            position.contract.symbol: (position.position, position.avgCost)
+            for position in self.ib.positions(self.account) if position.position}
+
+    def report(self):
+        values = ", ".join(f"{tag} ${value:,.0f}" for tag, value in self.values.items())
+        print(f"Account: {values or f'no values yet, sizing against ${self.fallback_equity:,.0f}'}")
+
+    def _on_value(self, value):
+        if value.tag not in TAGS or value.currency != CURRENCY:
+            return
+        if self.account and value.account != self.account:
+            return
+        try:
+            self.values[value.tag] = float(value.value)
+        except ValueError:
+            pass
+
+
+class RiskAllocator:
+    """ Sizes brackets against the account's equity under a total open risk cap """
+
+    def __init__(self, account, order_book, risk_percent, max_open_risk_percent):
+        self.account = account
+        self.order_book = order_book
+        self.risk_percent = risk_percent
+        self.max_open_risk_percent = max_open_risk_percent
+
+    def open_risk(self):
+        """
+        Dollars lost if every working stop loss is hit. A stop whose bracket
+        hasn't filled yet is measured from the entry limit, the rest from the
+        average cost of the position
+        """
+        positions = None
+        risk = 0.0
+        for trade in self.order_book.by_type("STP"):
+            order = trade.order
+            if order.action != "SELL":
+                continue
+
+            parent = self.order_book.parent(trade)
+            if parent is not None:
+                entry = parent.order.lmtPrice
+            else:
+                if positions is None:
+                    positions = self.account.positions()
+                entry = positions.get(trade.contract.symbol, (0, 0.0))[1]
+
+            quantity = trade.orderStatus.remaining or order.totalQuantity
+            risk += quantity * max(0.0, entry - order.auxPrice)
+        return risk
+
+    def allocate(self, risks_per_share, prices):
+        """ Returns an int array with the number of shares for each bracket of a batch """
+        risks = np.asarray(risks_per_share, dtype=float)
+        prices = np.asarray(prices, dtype=float)
+        equity = self.account.equity
+
+        # Same rounding as common.share_size
+        quantities = np.zeros(len(risks))
+        valid = risks > 0
+        quantities[valid] = np.round(equity * self.risk_percent / risks[valid])
+
+        # Nothing to size, and nothing to divide the room by when the open risk is already over the cap
+        new_risk = float(quantities @ risks) if len(risks) else 0.0
+        if new_risk <= 0:
+            return np.zeros(len(risks), dtype=int)
+
+        # Scale the whole batch down to fit the open risk cap and the buying power
+        scale = 1.0
+        room = equity * self.max_open_risk_percent - self.open_risk()
+        if new_risk > room:
+            scale = max(room, 0.0) / new_risk
+
+        cost = float(quantities @ prices)
+        if cost > 0 and cost * scale > self.account.buying_power:
+            scale = max(self.account.buying_power, 0.0) / cost
+
+        if scale < 1:
+            quantities = np.floor(quantities * scale)
+        return quantities.astype(int)
+
+    def size(self, risk_per_share, price):
+        """ Number of shares for a single bracket """
+        return int(self.allocate([risk_per_share], [price])[0])
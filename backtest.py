@@ -0,0 +1,303 @@
+"""
+Offline backtester for the hourly inside bar strategy.
+
+Replays stored 1 hour bars for many symbols and days through the same
+rules as hourly_strat.py:
+- Setups are found with candle_patterns.hourly_setups, the vectorized
+    version of check_strategy_1 / check_strategy_2, including the
+    time of day gating
+- The entry is a limit at the inside bar high plus the offset, only
+    during the hour after the inside bar (unfilled orders are cancelled
+    at the next hour)
+- The stop starts at the inside bar low minus the offset and rolls to
+    the low of the previous bar at every new hour
+- The take profit scales out like the bracket in place_order, starting
+    at one R with scaleInitLevelSize/scaleSubsLevelSize of quantity // 10
+    and scalePriceIncrement of one R
+- Anything still open is flattened at the close of the last bar of the day
+
+Every symbol-day is a row of one NumPy array and the simulation steps
+through the bars of the day, so each step covers all rows at once.
+
+Assumptions, since only hourly OHLC is known:
+- A bar that breaks both the inside bar high and low is assumed to break the high first
+- Limit entries fill at the bar open if it gapped into the limit range, otherwise at the limit.
+    A gap over the limit that never trades back down doesn't fill
+- Within a bar the stop is checked before the take profit
+- Stops that gap fill at the bar open
+
+Bars are read from a CSV with columns symbol, date, open, high, low, close
+(the format of util.df plus a symbol column) or a directory of <symbol>.csv files.
+
+Usage: python backtest.py <bars.csv or directory>
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import candle_patterns
+import market_calendar
+
+# Position sizing, the hourly bot's fallback sizing (ACCOUNT_SIZE / RISK_PERCENT in hourly_strat.py) without the open risk cap
+ACCOUNT_SIZE = 1700
+RISK_PERCENT = 0.01
+
+# IB fixed pricing: per share with a minimum per order, capped at a percent of trade value
+COMMISSION_PER_SHARE = 0.005
+MIN_COMMISSION = 1.0
+MAX_COMMISSION_PERCENT = 0.01
+
+# Exit reasons
+STOP, TAKE_PROFIT, FLATTEN = "stop", "take_profit", "flatten"
+
+
+def load_bars(path):
+    """ Returns a DataFrame of 1 hour bars from a CSV file or a directory of <symbol>.csv files """
+    if os.path.isdir(path):
+        frames = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".csv"):
+                df = pd.read_csv(os.path.join(path, filename))
+                df["symbol"] = filename[:-4]
+                frames.append(df)
+        bars = pd.concat(frames, ignore_index=True)
+    else:
+        bars = pd.read_csv(path)
+
+    bars["date"] = pd.to_datetime(bars["date"])
+    return bars
+
+
+def stack_days(bars):
+    """
+    Returns (rows, ohlc, hours) where every row is one symbol-day.
+    rows is a DataFrame of symbol and day, ohlc an array of shape (rows, bars per day, 4)
+    padded with NaN for short days, and hours an int array of shape (rows, bars per day) with
+    the local hour each bar starts in (-1 for padding).
+    """
+    bars = bars.sort_values(["symbol", "date"])
+    day = bars["date"].dt.date
+    row = bars.groupby([bars["symbol"], day], sort=False).ngroup().to_numpy()
+    bar = bars.groupby([bars["symbol"], day], sort=False).cumcount().to_numpy()
+
+    ohlc = np.full((row.max() + 1, bar.max() + 1, 4), np.nan)
+    ohlc[row, bar] = bars[["open", "high", "low", "close"]].to_numpy(dtype=float)
+
+    rows = pd.DataFrame({"symbol": bars["symbol"].to_numpy(), "day": day.to_numpy(), "row": row})
+    rows = rows.drop_duplicates("row").set_index("row").sort_index()
+
+    # The local hour the bot sees (time.localtime) for every bar start, across daylight saving changes
+    starts = bars["date"]
+    local_hours = {
+        start: time.localtime(market_calendar.timestamp(start)).tm_hour for start in starts.unique()}
+    hours = np.full(ohlc.shape[:2], -1)
+    hours[row, bar] = starts.map(local_hours).to_numpy()
+    return rows, ohlc, hours
+
+
+def entry_levels(current_open, inside_high, inside_low):
+    """ Limit price and stop loss, same as check_for_entry in hourly_strat.py """
+    limit_price = np.where(
+        current_open < 1, np.round(inside_high + 0.005, 3),
+        np.where(current_open <= 5, np.round(inside_high + 0.01, 2), np.round(inside_high + 0.02, 2)))
+    stop_loss = np.where(
+        current_open < 1, np.round(inside_low - 0.005, 3), np.round(inside_low - 0.01, 2))
+    return limit_price, stop_loss
+
+
+def rolled_stop(previous_low):
+    """ Stop price one tick under the previous bar low, same as stop_orders.stop_price """
+    return np.where(
+        previous_low < 1, np.round(previous_low - 0.005, 3), np.round(previous_low - 0.01, 2))
+
+
+def commission(shares, price):
+    """ Commission for executions of shares at price """
+    fee = np.maximum(MIN_COMMISSION, shares * COMMISSION_PER_SHARE)
+    fee = np.minimum(fee, shares * price * MAX_COMMISSION_PERCENT)
+    return np.where(shares > 0, fee, 0.0)
+
+
+def run_backtest(bars, account_size=ACCOUNT_SIZE, risk_percent=RISK_PERCENT):
+    """ Returns a DataFrame with one row per simulated trade """
+    rows, ohlc, hours = stack_days(bars)
+    opens, highs, lows, closes = (ohlc[:, :, field] for field in range(4))
+    n_rows, n_bars = opens.shape
+    last_bar = np.sum(~np.isnan(opens), axis=1) - 1
+
+    # Open position state, one slot per symbol-day
+    active = np.zeros(n_rows, dtype=bool)
+    strategy = np.zeros(n_rows, dtype=np.int8)
+    entry_bar = np.zeros(n_rows, dtype=int)
+    quantity = np.zeros(n_rows, dtype=int)
+    entry_price = np.zeros(n_rows)
+    initial_stop = np.zeros(n_rows)
+    stop = np.zeros(n_rows)
+    risk_per_share = np.zeros(n_rows)
+    take_profit = np.zeros(n_rows)
+    level_size = np.ones(n_rows, dtype=int)
+    levels_filled = np.zeros(n_rows, dtype=int)
+    proceeds = np.zeros(n_rows)
+    fees = np.zeros(n_rows)
+    max_high = np.zeros(n_rows)
+
+    trades = []
+
+    def shares_sold(levels):
+        return np.minimum(levels * level_size, quantity)
+
+    def fill_take_profits(mask, bar_high):
+        """ Fill every scale out level reached by bar_high """
+        np.maximum(max_high, np.where(mask, bar_high, max_high), out=max_high)
+        levels = np.where(
+            mask & (max_high >= take_profit),
+            np.floor((max_high - take_profit) / np.where(mask, risk_per_share, 1) + 1e-9) + 1, 0)
+        total_levels = -(-quantity // level_size)
+        levels = np.maximum(levels_filled, np.minimum(levels, total_levels)).astype(int)
+
+        # Each new level is its own execution
+        for level in range(levels.max(initial=0)):
+            new = mask & (levels_filled <= level) & (level < levels)
+            if not new.any():
+                continue
+            price = take_profit + level * risk_per_share
+            shares = shares_sold(level + 1) - shares_sold(level)
+            proceeds[new] += (shares * price)[new]
+            fees[new] += commission(shares, price)[new]
+
+        levels_filled[mask] = levels[mask]
+        return mask & (shares_sold(levels_filled) >= quantity)
+
+    def close(mask, exit_price, reason, bar):
+        """ Exit whatever is left of the positions in mask at exit_price and record the trades """
+        if not mask.any():
+            return
+        remaining = quantity - shares_sold(levels_filled)
+        proceeds[mask] += (remaining * exit_price)[mask]
+        fees[mask] += commission(remaining, exit_price)[mask]
+
+        index = np.flatnonzero(mask)
+        gross = proceeds[index] - quantity[index] * entry_price[index]
+        net = gross - fees[index]
+        trades.append(pd.DataFrame({
+            "symbol": rows["symbol"].to_numpy()[index],
+            "day": rows["day"].to_numpy()[index],
+            "strategy": np.where(strategy[index] == 1, "strategy_1", "strategy_2"),
+            "entry_bar": entry_bar[index],
+            "exit_bar": bar,
+            "exit": reason,
+            "quantity": quantity[index],
+            "entry_price": entry_price[index],
+            "initial_stop": initial_stop[index],
+            "gross_pnl": gross,
+            "commission": fees[index],
+            "net_pnl": net,
+            "r_multiple": net / (risk_per_share[index] * quantity[index])}))
+        active[mask] = False
+
+    for bar in range(n_bars):
+        valid = ~np.isnan(opens[:, bar])
+        holding = active & valid
+
+        # Manage positions from earlier hours: roll the stop, then check stop before take profit
+        if bar > 0 and holding.any():
+            stop[holding] = rolled_stop(lows[holding, bar - 1])
+            stopped = holding & (lows[:, bar] <= stop)
+            close(stopped, np.minimum(stop, opens[:, bar]), STOP, bar)
+            done = fill_take_profits(holding & ~stopped, highs[:, bar])
+            close(done, closes[:, bar], TAKE_PROFIT, bar)
+
+        # New entries only for tickers without a position at the top of the hour
+        if bar >= 2:
+            window = ohlc[:, max(0, bar - 3):bar + 1]
+            if window.shape[1] < 4:
+                window = np.concatenate(
+                    [np.full((n_rows, 4 - window.shape[1], 4), np.nan), window], axis=1)
+            setups = candle_patterns.hourly_setups(window, hours[:, bar])
+            signal = (setups["strategy_1"] | setups["strategy_2"]) & valid & ~holding
+
+            inside_high, inside_low = highs[:, bar - 1], lows[:, bar - 1]
+            limit_price, stop_loss = entry_levels(opens[:, bar], inside_high, inside_low)
+            risk = np.round(limit_price - stop_loss, 2)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                shares = np.where(risk > 0, np.round(account_size * risk_percent / risk), 0)
+
+            gapped_over = (opens[:, bar] > limit_price) & (lows[:, bar] > limit_price)
+            filled = signal & (highs[:, bar] > inside_high) & ~gapped_over & (shares > 0)
+
+            if filled.any():
+                active[filled] = True
+                strategy[filled] = np.where(setups["strategy_1"], 1, 2)[filled]
+                entry_bar[filled] = bar
+                quantity[filled] = shares[filled]
+                gap_fill = (opens[:, bar] > inside_high) & (opens[:, bar] <= limit_price)
+                entry_price[filled] = np.where(gap_fill, opens[:, bar], limit_price)[filled]
+                initial_stop[filled] = stop_loss[filled]
+                stop[filled] = stop_loss[filled]
+                risk_per_share[filled] = risk[filled]
+                take_profit[filled] = np.round(inside_high + risk, 2)[filled]
+                level_size[filled] = np.maximum(quantity[filled] // 10, 1)
+                levels_filled[filled] = 0
+                proceeds[filled] = 0.0
+                fees[filled] = commission(quantity, entry_price)[filled]
+                max_high[filled] = 0.0
+
+                # The entry bar itself can still hit the stop or the take profit
+                stopped = filled & (lows[:, bar] <= stop)
+                close(stopped, stop, STOP, bar)
+                done = fill_take_profits(filled & ~stopped, highs[:, bar])
+                close(done, closes[:, bar], TAKE_PROFIT, bar)
+
+        # Flatten everything at the end of the day
+        close(active & (last_bar == bar), closes[:, bar], FLATTEN, bar)
+
+    if not trades:
+        return pd.DataFrame()
+    return pd.concat(trades, ignore_index=True)
+
+
+def summarize(trades):
+    """ Returns a dict of P&L, commission and R-multiple stats for a trades DataFrame """
+    if trades.empty:
+        return {"trades": 0}
+
+    daily_pnl = trades.groupby("day")["net_pnl"].sum()
+    r = trades["r_multiple"]
+    return {
+        "trades": len(trades),
+        "win_rate": float((trades["net_pnl"] > 0).mean()),
+        "gross_pnl": float(trades["gross_pnl"].sum()),
+        "commission": float(trades["commission"].sum()),
+        "net_pnl": float(trades["net_pnl"].sum()),
+        "avg_r": float(r.mean()),
+        "median_r": float(r.median()),
+        "std_r": float(r.std(ddof=0)),
+        "best_r": float(r.max()),
+        "worst_r": float(r.min()),
+        "days": len(daily_pnl),
+        "winning_days": int((daily_pnl > 0).sum()),
+        "worst_day": float(daily_pnl.min()),
+        "by_strategy": trades.groupby("strategy")["net_pnl"].agg(["count", "sum"]).to_dict("index"),
+        "by_exit": trades["exit"].value_counts().to_dict()}
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python backtest.py <bars.csv or directory>")
+
+    print("Loading bars")
+    bars = load_bars(sys.argv[1])
+    print(f"{len(bars)} bars loaded for {bars['symbol'].nunique()} tickers")
+
+    trades = run_backtest(bars)
+    for name, value in summarize(trades).items():
+        print(f"{name}: {value}")
+
+
+if __name__ == '__main__':
+    main()
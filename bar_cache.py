@@ -0,0 +1,226 @@
+"""
+Persistent bar cache for the swing scanner.
+
+The swing scan requests a few days of daily bars for every ticker in a
+TOS export, often thousands of them, although every bar except the last
+is the same as it was yesterday.  The cache keeps the bars on disk, one
+NumPy file per symbol under a directory per bar size, read back memory
+mapped:
+
+    bar_cache/1_day/AAPL.npy
+    bar_cache/1_day/index.json      symbol -> when its bars were last fetched
+
+On a request only the bars missing since the last stored bar are
+fetched (the last stored bar is fetched again in case it was still in
+progress) and everything before that is served from disk.  A symbol
+fetched since the last session close, while the market is closed, is
+served from disk without any request at all, so a scan after the close
+makes at most one small request per symbol per day.
+
+When TWS isn't connected everything is served from disk as it is.
+
+Pass a RequestScheduler to pace the historical data requests, and the
+simulator's clock when running against it.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import time
+
+import numpy as np
+
+import market_calendar
+import metrics
+from request_scheduler import historical_class
+
+CACHE_DIR = "bar_cache"
+INDEX_FILE = "index.json"
+
+# Bump whenever BAR_DTYPE changes so old files are fetched again
+CACHE_VERSION = 1
+
+BAR_DTYPE = np.dtype([
+    ("date", "datetime64[s]"),
+    ("open", "f8"),
+    ("high", "f8"),
+    ("low", "f8"),
+    ("close", "f8"),
+    ("volume", "f8")])
+
+# Duration unit used to request the missing bars, and the days it covers
+DURATION_UNITS = {"1 week": ("W", 7)}
+
+
+def to_array(bars):
+    """ Structured BAR_DTYPE array from a list of BarData """
+    array = np.empty(len(bars), dtype=BAR_DTYPE)
+    for row, bar in enumerate(bars):
+        date = bar.date
+        if isinstance(date, datetime.datetime) and date.tzinfo is not None:
+            date = date.replace(tzinfo=None)
+        array[row] = (np.datetime64(date, "s"), bar.open, bar.high, bar.low, bar.close, bar.volume)
+    return array
+
+
+class BarCache:
+    """ On disk bars of one bar size, topped up from TWS with only the missing bars """
+
+    def __init__(
+            self, ib, bar_size="1 day", duration="5 D", use_rth=True, directory=CACHE_DIR,
+            max_bars=500, scheduler=None, clock=time.time):
+        self.ib = ib
+        self.bar_size = bar_size
+        self.duration = duration    # Requested for symbols that aren't cached yet
+        self.use_rth = use_rth
+        self.max_bars = max_bars    # Older bars are dropped once a symbol has more than this
+        self.scheduler = scheduler
+        self.request_class = historical_class(bar_size)
+        self.clock = clock
+        self.hits = 0
+        self.requests = 0
+
+        # Only created on the first write, so importing a bot doesn't leave an empty cache behind
+        self.directory = os.path.join(directory, bar_size.replace(" ", "_"))
+
+        # symbol -> bot clock time the symbol was last fetched
+        self._fetched = {}
+        self._load_index()
+
+    def __contains__(self, symbol):
+        return symbol in self._fetched
+
+    def __len__(self):
+        return len(self._fetched)
+
+    def bars(self, symbol):
+        """ The stored bars of a symbol, memory mapped, or None if there are none """
+        if symbol not in self._fetched:
+            return None
+        try:
+            return np.load(self._path(symbol), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, symbol):
+        """ True if no session has traded since the symbol was fetched """
+        fetched = self._fetched.get(symbol)
+        if fetched is None:
+            return False
+        now = self.clock()
+        return fetched >= market_calendar.last_close(now) and not market_calendar.is_open(now)
+
+    def missing_duration(self, symbol):
+        """ Duration string covering the bars missing since the last stored bar, including that bar """
+        bars = self.bars(symbol)
+        if bars is None or not len(bars):
+            return self.duration
+
+        last = bars["date"][-1].astype(datetime.datetime).date()
+        today = market_calendar.exchange_time(self.clock()).date()
+        unit, days_per_unit = DURATION_UNITS.get(self.bar_size, ("D", 1))
+        return f"{max(1, (today - last).days // days_per_unit + 1)} {unit}"
+
+    async def get_async(self, contract, timeout=60):
+        """ Returns the bars of a contract, fetching only the missing ones from TWS """
+        symbol = contract.symbol
+        if self.is_fresh(symbol) or not self.ib.isConnected() or not contract.conId:
+            self.hits += 1
+            return self.bars(symbol)
+
+        duration = self.missing_duration(symbol)
+        if self.scheduler is not None:
+            await self.scheduler.acquire_async(self.request_class)
+        with metrics.inflight("historical"):
+            new_bars = await self.ib.reqHistoricalDataAsync(
+                contract,
+                endDateTime="",
+                durationStr=duration,
+                barSizeSetting=self.bar_size,
+                whatToShow="TRADES",
+                useRTH=self.use_rth,
+                formatDate=1,
+                timeout=timeout)
+        self.requests += 1
+
+        if not new_bars:
+            return self.bars(symbol)
+        return self._store(symbol, to_array(new_bars))
+
+    async def get_many_async(self, contracts, max_concurrent=20, timeout=10):
+        """
+        Returns a dict of symbol -> bars for a list of qualified contracts.
+        At most max_concurrent requests are in flight at once.  Symbols that
+        fail or time out are served from disk if they have any bars there.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        async def fetch(contract):
+            async with semaphore:
+                return await self.get_async(contract, timeout)
+
+        contracts = list({c.symbol: c for c in contracts}.values())
+        results = await asyncio.gather(
+            *[fetch(contract) for contract in contracts], return_exceptions=True)
+
+        bars_by_symbol = {}
+        for contract, bars in zip(contracts, results):
+            if isinstance(bars, Exception):
+                print(f"*** WARNING: Bars not updated for {contract.symbol}: {bars!r} ***")
+                bars = self.bars(contract.symbol)
+            if bars is not None and len(bars):
+                bars_by_symbol[contract.symbol] = bars
+
+        self._save_index()
+        return bars_by_symbol
+
+    def get_many(self, contracts, max_concurrent=20, timeout=10):
+        """ Blocking version of get_many_async """
+        return self.ib.run(self.get_many_async(contracts, max_concurrent, timeout))
+
+    def report(self):
+        print(f"{self.hits} symbols served from the bar cache, {self.requests} bar requests sent")
+
+    def _path(self, symbol):
+        return os.path.join(self.directory, symbol + ".npy")
+
+    def _store(self, symbol, new_bars):
+        """ Replace everything from the first new bar onwards and write the symbol back to disk """
+        # Read into memory rather than mapped so the file can be replaced (Windows won't replace a mapped file)
+        bars = np.load(self._path(symbol)) if os.path.exists(self._path(symbol)) else None
+        if bars is not None and len(bars):
+            kept = bars[bars["date"] < new_bars["date"][0]]
+            new_bars = np.concatenate([kept, new_bars])
+        new_bars = new_bars[-self.max_bars:]
+
+        # np.save appends .npy to a name without it
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self._path(symbol) + ".tmp.npy"
+        np.save(temp_path, new_bars)
+        os.replace(temp_path, self._path(symbol))
+
+        self._fetched[symbol] = self.clock()
+        return new_bars
+
+    def _load_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == CACHE_VERSION:
+            self._fetched = data["fetched"]
+
+    def _save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, INDEX_FILE)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"version": CACHE_VERSION, "fetched": self._fetched}, file)
+        os.replace(temp_path, path)
@@ -0,0 +1,160 @@
+"""
+Compact per-symbol bar store backed by preallocated NumPy ring buffers.
+
+The entry checks and stop adjustments only ever read the last two to
+four bars, so building a whole DataFrame from the BarDataList on every
+check is wasted work.  Each symbol gets a fixed depth (depth, 5) OHLCV
+array instead, updated in place from the bar stream events.
+
+Bars are read through preallocated views, so a check like
+bars.bar(-2).low creates no DataFrame and allocates nothing per tick.
+Indexes work like iloc: -1 is the bar in progress, -2 the last
+completed bar, and so on.
+"""
+
+import sys
+
+import numpy as np
+
+OPEN, HIGH, LOW, CLOSE, VOLUME = range(5)
+
+
+class BarView:
+    """ Read only view of one bar, indexed from the end like iloc """
+
+    __slots__ = ("_bars", "_index")
+
+    def __init__(self, bars, index):
+        self._bars = bars
+        self._index = index
+
+    @property
+    def open(self):
+        return self._bars.value(self._index, OPEN)
+
+    @property
+    def high(self):
+        return self._bars.value(self._index, HIGH)
+
+    @property
+    def low(self):
+        return self._bars.value(self._index, LOW)
+
+    @property
+    def close(self):
+        return self._bars.value(self._index, CLOSE)
+
+    @property
+    def volume(self):
+        return self._bars.value(self._index, VOLUME)
+
+
+class SymbolBars:
+    """ Ring buffer holding the last depth bars of one symbol """
+
+    __slots__ = ("data", "depth", "count", "last", "_views")
+
+    def __init__(self, depth):
+        self.data = np.zeros((depth, 5))
+        self.depth = depth
+        self.count = 0
+        self.last = -1
+
+        # One view per index so reading a bar never allocates
+        self._views = [BarView(self, -offset) for offset in range(1, depth + 1)]
+
+    def __len__(self):
+        return self.count
+
+    def append(self, bar):
+        """ Start a new bar """
+        self.last = (self.last + 1) % self.depth
+        self.count = min(self.count + 1, self.depth)
+        self._write(bar)
+
+    def update(self, bar):
+        """ Overwrite the bar in progress """
+        if self.count == 0:
+            self.append(bar)
+        else:
+            self._write(bar)
+
+    def row(self, index):
+        """ Physical row of the bar at a negative index """
+        if not -self.count <= index < 0:
+            raise IndexError(f"bar index {index} out of range for {self.count} bars")
+        return (self.last + index + 1) % self.depth
+
+    def value(self, index, field):
+        return self.data.item(self.row(index), field)
+
+    def bar(self, index):
+        """ Returns the view of the bar at a negative index e.g. bar(-2).low """
+        self.row(index)
+        return self._views[-index - 1]
+
+    def ohlc(self, depth):
+        """ Returns a (bars, 4) array of the last depth bars, oldest first """
+        rows = [self.row(index) for index in range(-min(depth, self.count), 0)]
+        return self.data[rows, :VOLUME]
+
+    def nbytes(self):
+        """ Approximate memory held by this symbol """
+        return (
+            sys.getsizeof(self) + self.data.nbytes + sys.getsizeof(self.data)
+            + sys.getsizeof(self._views) + sum(sys.getsizeof(view) for view in self._views))
+
+    def _write(self, bar):
+        row = self.data[self.last]
+        row[OPEN] = bar.open
+        row[HIGH] = bar.high
+        row[LOW] = bar.low
+        row[CLOSE] = bar.close
+        row[VOLUME] = bar.volume
+
+
+class BarStore:
+    """ SymbolBars for every streamed symbol """
+
+    def __init__(self, depth=8):
+        self.depth = depth
+        self._bars = {}
+
+    def __contains__(self, symbol):
+        return symbol in self._bars
+
+    def __len__(self):
+        return len(self._bars)
+
+    def get(self, symbol):
+        """ Returns the SymbolBars of a symbol or None if it isn't loaded """
+        return self._bars.get(symbol)
+
+    def load(self, symbol, bars):
+        """ Fill the ring buffer of a symbol from a list of bars """
+        symbol_bars = SymbolBars(self.depth)
+        for bar in bars[-self.depth:]:
+            symbol_bars.append(bar)
+        self._bars[symbol] = symbol_bars
+        return symbol_bars
+
+    def remove(self, symbol):
+        self._bars.pop(symbol, None)
+
+    def on_bar_update(self, bars: list, has_new_bar: bool):
+        """ BarDataList.updateEvent handler that keeps the ring buffer in step with the stream """
+        symbol_bars = self._bars.get(bars.contract.symbol)
+        if symbol_bars is None or not bars:
+            return
+
+        if has_new_bar:
+            # Settle the final values of the bar that just completed before starting the next one
+            if len(bars) >= 2:
+                symbol_bars.update(bars[-2])
+            symbol_bars.append(bars[-1])
+        else:
+            symbol_bars.update(bars[-1])
+
+    def memory_usage(self):
+        """ Returns the approximate number of bytes held by the store """
+        return sum(symbol_bars.nbytes() for symbol_bars in self._bars.values())
@@ -0,0 +1,190 @@
+"""
+Registry of live historical bar subscriptions (keepUpToDate=True).
+
+Every call to reqHistoricalData with keepUpToDate opens a new stream on
+TWS that stays open until it is cancelled.  The registry opens a single
+stream per symbol and hands out the same live BarDataList on every
+request, so the bars stay up to date without piling up duplicate streams.
+
+Streams for symbols that are no longer needed (off the watchlist and no
+open trade) are cancelled with retain() or cancel().
+
+get_many_async() opens streams for a whole list of contracts at once
+with a limit on how many requests are in flight.
+
+A callback registered with subscribe_updates() is attached to every
+stream's updateEvent, so bar updates can drive the strategy directly.
+
+Pass a RequestScheduler to pace the historical data requests, and a
+BarStore to keep a compact ring buffer copy of every stream up to date.
+The store is updated before any other callback runs.
+"""
+
+import asyncio
+import sys
+
+import metrics
+from request_scheduler import historical_class
+
+
+class BarStreamRegistry:
+    """ One keepUpToDate bar subscription per symbol """
+
+    def __init__(self, ib, duration="1 D", bar_size="1 hour", use_rth=True, scheduler=None, store=None):
+        self.ib = ib
+        self.scheduler = scheduler
+        self.store = store
+        self.duration = duration
+        self.bar_size = bar_size
+        self.use_rth = use_rth
+        self.request_class = historical_class(bar_size)
+
+        # symbol -> live BarDataList
+        self._streams = {}
+
+        # Callbacks attached to the updateEvent of every stream
+        self._callbacks = []
+
+    def __contains__(self, symbol):
+        return symbol in self._streams
+
+    def __len__(self):
+        return len(self._streams)
+
+    @property
+    def symbols(self):
+        return set(self._streams)
+
+    def get(self, contract):
+        """ Returns the live bars for a contract, opening a stream the first time it is requested """
+        bars = self._streams.get(contract.symbol)
+        if bars is not None:
+            return bars
+
+        if self.scheduler is not None:
+            self.scheduler.acquire(self.request_class)
+        with metrics.inflight("historical"):
+            bars = self.ib.reqHistoricalData(
+                contract,
+                endDateTime="",
+                durationStr=self.duration,
+                barSizeSetting=self.bar_size,
+                whatToShow="TRADES",
+                useRTH=self.use_rth,
+                formatDate=1,
+                keepUpToDate=True)
+
+        # Only streams that returned bars are kept. An empty result (bad contract, no data permissions,
+        # a timeout) never started a stream: TWS ended it with an error or ib_insync already cancelled it
+        if bars:
+            self._add(contract.symbol, bars)
+
+        return bars
+
+    async def get_async(self, contract, timeout=60):
+        """ Same as get but with reqHistoricalDataAsync. ib_insync cancels the request after timeout seconds """
+        bars = self._streams.get(contract.symbol)
+        if bars is not None:
+            return bars
+
+        if self.scheduler is not None:
+            await self.scheduler.acquire_async(self.request_class)
+        with metrics.inflight("historical"):
+            bars = await self.ib.reqHistoricalDataAsync(
+                contract,
+                endDateTime="",
+                durationStr=self.duration,
+                barSizeSetting=self.bar_size,
+                whatToShow="TRADES",
+                useRTH=self.use_rth,
+                formatDate=1,
+                keepUpToDate=True,
+                timeout=timeout)
+
+        # Same as get. Cancelling an empty result again would only get an error back from TWS
+        if bars:
+            self._add(contract.symbol, bars)
+
+        return bars
+
+    async def get_many_async(self, contracts, max_concurrent=20, timeout=10):
+        """
+        Returns a dict of symbol -> live bars for a list of contracts.
+        At most max_concurrent requests are in flight at once and each one
+        is given timeout seconds.  Contracts that aren't qualified, time out
+        or raise an error are left out rather than stopping the others.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        async def fetch(contract):
+            async with semaphore:
+                return await self.get_async(contract, timeout)
+
+        # Skip unqualified contracts and duplicate symbols
+        contracts = list({c.symbol: c for c in contracts if c.conId}.values())
+        results = await asyncio.gather(
+            *[fetch(contract) for contract in contracts], return_exceptions=True)
+
+        bars_by_symbol = {}
+        for contract, bars in zip(contracts, results):
+            if isinstance(bars, Exception):
+                print(f"*** WARNING: Bars not loaded for {contract.symbol}: {bars!r} ***")
+            elif bars:
+                bars_by_symbol[contract.symbol] = bars
+        return bars_by_symbol
+
+    def cancel(self, symbol):
+        """ Cancel the stream for a symbol if one is open """
+        bars = self._streams.pop(symbol, None)
+        if bars is not None:
+            for callback in self._callbacks:
+                bars.updateEvent -= callback
+            if self.store is not None:
+                bars.updateEvent -= self.store.on_bar_update
+                self.store.remove(symbol)
+            self._cancel(bars)
+
+    def subscribe_updates(self, callback):
+        """ Attach a callback(bars, has_new_bar) to every open and future stream """
+        self._callbacks.append(callback)
+        for bars in self._streams.values():
+            bars.updateEvent += callback
+
+    def retain(self, symbols):
+        """ Cancel every stream whose symbol is not in the symbols argument """
+        symbols = set(symbols)
+        for symbol in self.symbols - symbols:
+            self.cancel(symbol)
+
+    def cancel_all(self):
+        """ Cancel every open stream """
+        for symbol in self.symbols:
+            self.cancel(symbol)
+
+    def _cancel(self, bars):
+        if self.scheduler is not None:
+            self.scheduler.submit(self.request_class, self.ib.cancelHistoricalData, bars)
+        else:
+            self.ib.cancelHistoricalData(bars)
+
+    def _add(self, symbol, bars):
+        self._streams[symbol] = bars
+        metrics.count("bar_streams_opened")
+        if self.store is not None:
+            self.store.load(symbol, bars)
+            bars.updateEvent += self.store.on_bar_update
+        for callback in self._callbacks:
+            bars.updateEvent += callback
+
+    def memory_usage(self):
+        """ Returns the approximate number of bytes held by all open streams """
+        total = 0
+        for bars in self._streams.values():
+            total += sys.getsizeof(bars)
+            for bar in bars:
+                total += sys.getsizeof(bar) + sys.getsizeof(vars(bar))
+        return total
+
+    def report(self):
+        """ Print the number of open streams and the memory they hold """
+        print(f"{len(self)} bar streams open using {self.memory_usage() / 1024:.1f} KB")
@@ -0,0 +1,321 @@
+"""
+Benchmarks for the hot paths of the hourly bot.
+
+Runs hourly_strat.py against the simulator (sim_ib.py) with a fixed seed
+so every run sees the same market, then times:
+- scanner()                       every scanner band, cache disabled
+- build_watchlist()               qualify, load bars and check setups for N scanned tickers
+- check_watchlist()               one polling pass over a watchlist of N tickers
+- adjust_hourly_stop_losses()     M open stop orders
+- close_all_hourly_positions()    K open positions
+- place_order()                   one bracket order
+- cold start                      a fresh interpreter importing each CLI command's module
+
+Each benchmark reports p50/p95/p99 latency and the peak memory allocated
+during one extra traced run.  Request pacing is switched off unless
+--paced is given so the numbers measure the bot's own code rather than
+the scheduler's token buckets.
+
+Cold starts don't connect (the scripts only connect in main) and must
+stay under COLD_START_BUDGET seconds.
+
+Usage:
+    python benchmarks.py            run and compare against the saved baseline
+    python benchmarks.py --save     run and save the results as the new baseline
+    python benchmarks.py --repeat 50 --symbols 200 --stops 40 --positions 40
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# A benchmark whose p50 is this much slower than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 1.25
+# Ignore slowdowns smaller than this. Sub-millisecond paths are mostly timer noise
+REGRESSION_MIN_MS = 0.5
+
+# A command whose cold start p50 is over this many seconds fails the run
+COLD_START_BUDGET = 1.0
+
+# CLI command -> module it imports
+COLD_START_MODULES = {
+    "cli": "cli",
+    "hourly": "hourly_strat",
+    "swing-scan": "swing_strat",
+    "swing-order": "swing_ordering",
+    "scanner-params": "scanner_params",
+}
+
+# Virtual time of day the benchmarks run at (exchange time), a few bars into the session
+START_TIME = datetime.time(12, 30)
+
+
+def load_bot(symbols, seed, paced):
+    """ Import hourly_strat against a fresh simulator and return the module. Run it inside working_directory """
+    os.environ["SIMULATE_IB"] = "1"
+    os.environ["SIM_SYMBOLS"] = str(symbols)
+    os.environ["SIM_SEED"] = str(seed)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    with quiet():
+        import hourly_strat
+
+    if not paced:
+        from request_scheduler import REQUEST_CLASSES, RequestScheduler
+        unpaced = {name: (priority, 1e9, 1e9) for name, (priority, _, _) in REQUEST_CLASSES.items()}
+        scheduler = RequestScheduler(hourly_strat.ib, unpaced, message_rate=1e9)
+        hourly_strat.scheduler = scheduler
+        hourly_strat.contracts.scheduler = scheduler
+        hourly_strat.bar_streams.scheduler = scheduler
+
+    hourly_strat.scan_cache = None
+
+    ib = hourly_strat.ib
+    start = datetime.datetime.combine(ib.now.date(), START_TIME)
+    ib.sleep((start - ib.now).total_seconds())
+    return hourly_strat
+
+
+@contextlib.contextmanager
+def working_directory(prefix):
+    """ Run in a temporary directory that is removed afterwards, so the bot's caches never leak into the cwd """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=prefix) as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Swallow the bot's progress prints """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def measure(func, setup=None, repeat=20):
+    """ Time func over repeat runs. setup runs untimed before each run and returns func's arguments """
+    timings = []
+    with quiet():
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+
+        # One more run with tracemalloc on for the memory peak. Kept out of the timings
+        args = setup() if setup else ()
+        tracemalloc.start()
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    timings = np.array(timings) * 1000
+    return {
+        "runs": repeat,
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95)),
+        "p99_ms": float(np.percentile(timings, 99)),
+        "peak_kb": peak / 1024,
+    }
+
+
+def cold_start(repeat=5):
+    """ Time a fresh interpreter importing each command's module. Peak memory is the child's max RSS """
+    env = {key: value for key, value in os.environ.items() if key not in ("SIMULATE_IB", "BOT_METRICS")}
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="cold_start_") as directory:
+        for command, module in COLD_START_MODULES.items():
+            timings = []
+            peak_kb = 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                process = subprocess.Popen([sys.executable, "-c", f"import {module}"], cwd=directory, env=env)
+                _, status, usage = os.wait4(process.pid, 0)
+                timings.append(time.perf_counter() - start)
+                if status:
+                    raise RuntimeError(f"import {module} failed")
+                peak_kb = max(peak_kb, usage.ru_maxrss)
+
+            timings = np.array(timings) * 1000
+            results[f"cold_start[{command}]"] = {
+                "runs": repeat,
+                "mean_ms": float(timings.mean()),
+                "p50_ms": float(np.percentile(timings, 50)),
+                "p95_ms": float(np.percentile(timings, 95)),
+                "p99_ms": float(np.percentile(timings, 99)),
+                "peak_kb": float(peak_kb),
+            }
+    return results
+
+
+def run_benchmarks(bot, symbols, stops, positions, repeat):
+    ib = bot.ib
+    hour = time.localtime(ib.clock()).tm_hour
+    tickers = sorted(ib.symbols)[:symbols]
+
+    def drained(func):
+        """ Include the time for the scheduler to send everything func queued """
+        def run(*args):
+            func(*args)
+            bot.scheduler.drain()
+        return run
+
+    def reset_orders():
+        """ The simulator drops its orders without events so the order book is rebuilt too """
+        ib.reset_orders()
+        bot.order_book.sync()
+
+    def fresh_streams():
+        bot.bar_streams.cancel_all()
+        bot.watchlist.clear()
+        return tickers, hour
+
+    def full_watchlist():
+        reset_orders()
+        for ticker in tickers:
+            inside_bar = bot.bar_store.get(ticker).bar(-2)
+            bot.watchlist.add(ticker, "strategy_1", inside_bar.high, inside_bar.low, hour)
+        return ()
+
+    def open_stops():
+        reset_orders()
+        for ticker in tickers[:stops]:
+            contract = bot.contracts.get(ticker)
+            ib.placeOrder(contract, bot.StopOrder("SELL", 100, 0.01))
+        return (set(),)
+
+    def open_positions():
+        reset_orders()
+        for ticker in tickers[:positions]:
+            ib.placeOrder(bot.contracts.get(ticker), bot.MarketOrder("BUY", 100))
+        ib.sleep(ib.tick)
+        return ([],)
+
+    def bracket():
+        reset_orders()
+        contract = bot.contracts.get(tickers[0])
+        price = bot.bar_store.get(tickers[0]).bar(-1).close
+        return contract, "BUY", 100, price + 0.02, price + 0.22, 0.2, price - 0.2
+
+    results = {}
+    results["scanner"] = measure(
+        lambda: bot.scanner(time.localtime(ib.clock())), repeat=repeat)
+    results[f"build_watchlist[{symbols}]"] = measure(
+        bot.build_watchlist, fresh_streams, repeat)
+
+    # The remaining benchmarks read from live streams for every ticker
+    with quiet():
+        bot.build_watchlist(tickers, hour)
+
+    results[f"check_watchlist[{symbols}]"] = measure(
+        drained(bot.check_watchlist), full_watchlist, repeat)
+    results[f"adjust_hourly_stop_losses[{stops}]"] = measure(
+        drained(bot.adjust_hourly_stop_losses), open_stops, repeat)
+    results[f"close_all_hourly_positions[{positions}]"] = measure(
+        drained(bot.close_all_hourly_positions), open_positions, repeat)
+    results["place_order"] = measure(drained(bot.place_order), bracket, repeat)
+    return results
+
+
+def report(results, baseline=None):
+    """ Print the results next to the baseline. Returns the names of the regressed benchmarks """
+    regressions = []
+    print(f"{'benchmark':<36}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KB':>10}{'vs base':>10}")
+    for name, result in results.items():
+        line = (
+            f"{name:<36}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+            f"{result['p99_ms']:>10.2f}{result['peak_kb']:>10.1f}")
+
+        if name.startswith("cold_start") and result["p50_ms"] > COLD_START_BUDGET * 1000:
+            line += "  OVER BUDGET"
+            regressions.append(name)
+
+        base = (baseline or {}).get(name)
+        if base:
+            ratio = result["p50_ms"] / base["p50_ms"]
+            line += f"{ratio:>9.2f}x"
+            if ratio > REGRESSION_THRESHOLD and result["p50_ms"] - base["p50_ms"] > REGRESSION_MIN_MS:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def load_baseline(config):
+    if not os.path.exists(BASELINE_FILE):
+        return None
+    with open(BASELINE_FILE, "r") as file:
+        data = json.load(file)
+
+    # Results are only comparable for the same benchmark sizes
+    if data["config"] != config:
+        print(f"Baseline was saved with {data['config']}, not comparing")
+        return None
+    return data["results"]
+
+
+def save_baseline(config, results):
+    with open(BASELINE_FILE, "w") as file:
+        json.dump({
+            "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "config": config,
+            "results": results,
+        }, file, indent=2)
+    print(f"Baseline saved to {BASELINE_FILE}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hourly bot against the simulator")
+    parser.add_argument("--symbols", type=int, default=100, help="tickers in the watchlist benchmarks")
+    parser.add_argument("--stops", type=int, default=20, help="open stop orders to adjust")
+    parser.add_argument("--positions", type=int, default=20, help="open positions to close")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic market")
+    parser.add_argument("--paced", action="store_true", help="keep the request scheduler's pacing")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    args = parser.parse_args()
+
+    config = {
+        "symbols": args.symbols, "stops": args.stops, "positions": args.positions,
+        "seed": args.seed, "paced": args.paced}
+
+    # The simulated universe must hold enough tickers for every benchmark
+    # Cold starts first, before this process switches to the simulator
+    cold_starts = cold_start()
+
+    universe = max(300, args.symbols, args.stops, args.positions)
+    with working_directory("benchmarks_"):
+        bot = load_bot(universe, args.seed, args.paced)
+        results = run_benchmarks(bot, args.symbols, args.stops, args.positions, args.repeat)
+    results.update(cold_starts)
+
+    baseline = load_baseline(config)
+    regressions = report(results, baseline)
+
+    if args.save:
+        save_baseline(config, results)
+    elif regressions:
+        sys.exit(f"{len(regressions)} benchmark(s) regressed more than {REGRESSION_THRESHOLD:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Vectorized versions of the candle pattern checks.
+
+The strategy functions in hourly_strat.py and swing_strat.py check one
+DataFrame at a time.  These functions stack the last few OHLC bars of
+every candidate into one NumPy array of shape (symbols, depth, 4) and
+evaluate each setup for the whole universe in a single pass.
+
+They give the same results as the per-symbol functions.  Symbols with
+fewer bars than a setup needs are padded with NaN, and every comparison
+with NaN is False, so those symbols simply don't pass.
+"""
+
+import numpy as np
+
+OPEN, HIGH, LOW, CLOSE = range(4)
+
+# Bars needed by the deepest setup (hourly check_strategy_2 looks back 4 bars)
+DEPTH = 4
+
+
+def stack_bars(bars_by_symbol, depth=DEPTH):
+    """
+    Returns (symbols, ohlc) where ohlc is a float array of shape (len(symbols), depth, 4)
+    holding the last depth bars of each symbol, oldest first, right aligned and NaN padded.
+    Values can be BarDataLists (or any list of bars), bar_store.SymbolBars,
+    structured arrays with open/high/low/close fields (bar_cache.BarCache)
+    or DataFrames with open/high/low/close columns.
+    """
+    symbols = list(bars_by_symbol)
+    ohlc = np.full((len(symbols), depth, 4), np.nan)
+
+    for row, symbol in enumerate(symbols):
+        data = bars_by_symbol[symbol]
+        if data is None:
+            continue
+
+        if hasattr(data, "ohlc"):
+            values = data.ohlc(depth)
+        elif getattr(data, "dtype", None) is not None and data.dtype.names:
+            tail = data[-depth:]
+            values = np.column_stack([tail["open"], tail["high"], tail["low"], tail["close"]])
+        elif hasattr(data, "to_numpy"):
+            values = data[["open", "high", "low", "close"]].to_numpy(dtype=float)[-depth:]
+        else:
+            values = np.array(
+                [(bar.open, bar.high, bar.low, bar.close) for bar in data[-depth:]], dtype=float)
+
+        if len(values):
+            ohlc[row, depth - len(values):] = values
+
+    return symbols, ohlc
+
+
+def _bar(ohlc, index):
+    """ Returns the open, high, low and close columns of bar index (negative, like iloc) """
+    bar = ohlc[:, index]
+    return bar[:, OPEN], bar[:, HIGH], bar[:, LOW], bar[:, CLOSE]
+
+
+def hourly_setups(ohlc, hour):
+    """
+    Boolean masks for the hourly setups, same as check_strategy_1 / check_strategy_2 in hourly_strat.py
+    Returns a dict of {"strategy_1": mask, "strategy_2": mask}
+    """
+    o4, h4, l4, c4 = _bar(ohlc, -4)
+    o3, h3, l3, c3 = _bar(ohlc, -3)
+    o2, h2, l2, c2 = _bar(ohlc, -2)
+
+    # Prior bar is a green inside bar. Shared by both setups
+    green_inside_bar = (l2 >= l3) & (h2 <= h3) & (c2 >= o2)
+
+    # Bar prior to the inside bar must be green
+    strategy_1 = (c3 >= o3) & green_inside_bar
+
+    # First bar must be red and the next bar must make a lower low
+    strategy_2 = (c4 < o4) & (l3 < l4) & green_inside_bar
+
+    # Same time of day gating as the per-symbol functions. hour is one hour or an array with one per symbol
+    hour = np.asarray(hour)
+    strategy_1 &= ~((0 < hour) & (hour < 4))
+    strategy_2 &= ~(hour >= 3)
+
+    return {"strategy_1": strategy_1, "strategy_2": strategy_2}
+
+
+def swing_setups(ohlc):
+    """
+    Boolean masks for the swing setups, same as check_strategy / check_strategy_2 in swing_strat.py
+    Returns a dict of {"strategy": mask, "strategy_2": mask}
+    """
+    o2, h2, l2, c2 = _bar(ohlc, -2)
+    o1, h1, l1, c1 = _bar(ohlc, -1)
+
+    # Green bar followed by an inside bar
+    strategy = (c2 > o2) & (l1 >= l2) & (h1 <= h2)
+
+    # Strict green inside bar
+    strategy_2 = (l1 > l2) & (h1 < h2) & (c1 > o1)
+
+    return {"strategy": strategy, "strategy_2": strategy_2}
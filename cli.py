@@ -0,0 +1,124 @@
+"""
+Command line entry point for the bots.
+
+    python cli.py hourly                        run the hourly day trading bot
+                                                (--scan-worker to scan in a separate process)
+    python cli.py swing-scan [scanresults.csv]  build the swing watchlist from a TOS scan export
+    python cli.py swing-order [TICKER ...]      place swing orders, or --stops-only to roll the stops
+    python cli.py scanner-params [--codes]      list the scanner filter tags or scan codes
+                                                (--search TEXT to narrow them down)
+    python cli.py journal [--days N]            daily P&L, commissions and win rate from the trade journal
+
+Nothing heavy is imported until a command runs, and only that command's
+modules are loaded.  Every command that needs TWS connects through
+connection.connect (set SIMULATE_IB to use the simulator instead of TWS).
+"""
+
+import argparse
+
+import connection
+
+
+def run_hourly(args):
+    import hourly_strat
+    hourly_strat.main(
+        args.port or connection.PAPER_PORT, args.client_id, args.scan_worker or hourly_strat.SCAN_IN_WORKER)
+
+
+def run_swing_scan(args):
+    import swing_strat
+    swing_strat.main(args.filename, args.port or connection.PAPER_PORT, args.client_id)
+
+
+def run_swing_order(args):
+    import swing_ordering
+    swing_ordering.main(
+        args.tickers or None, not args.stops_only, args.port or connection.LIVE_PORT, args.client_id)
+
+
+def run_scanner_params(args):
+    import scanner_params
+    catalog = scanner_params.ScannerCatalog()
+
+    # The catalog is answered from disk. TWS is only asked when it is missing, stale or --refresh is given
+    ib = None
+    if args.refresh or catalog.is_stale():
+        ib = connection.connect(connection.create_ib(), args.port or connection.PAPER_PORT, args.client_id)
+        catalog.refresh(ib)
+
+    if args.search:
+        kind = "scan_codes" if args.codes else "filters"
+        matches = catalog.search(args.search, kind, prefix=args.prefix)
+        print(f"{len(matches)} matches:")
+        print("\n".join(matches))
+    elif args.codes:
+        scanner_params.scan_codes(ib, catalog)
+    else:
+        tags = scanner_params.scanner_parameters(ib, open_browser=not args.no_browser, catalog=catalog)
+        print(f"{len(tags)} scanner tags written to {scanner_params.TAGS_FILE}")
+
+    if ib is not None:
+        ib.disconnect()
+
+
+def run_journal(args):
+    import datetime
+
+    import journal
+    import market_calendar
+
+    today = market_calendar.exchange_time(datetime.datetime.now().timestamp()).date()
+    start = (today - datetime.timedelta(days=args.days)).isoformat()
+    trade_journal = journal.Journal(args.path)
+    trade_journal.report(start)
+    trade_journal.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Trading bot commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, func, help, default_port):
+        command = subparsers.add_parser(name, help=help)
+        command.add_argument(
+            "--port", type=int, help=f"TWS port (default {default_port}, live is {connection.LIVE_PORT})")
+        command.add_argument("--client-id", type=int, default=1, help="TWS client id (default 1)")
+        command.set_defaults(func=func)
+        return command
+
+    hourly = add_command("hourly", run_hourly, "run the hourly day trading bot", connection.PAPER_PORT)
+    hourly.add_argument(
+        "--scan-worker", action="store_true", help="scan in a separate process on the next client id")
+
+    swing_scan = add_command(
+        "swing-scan", run_swing_scan, "build the swing watchlist", connection.PAPER_PORT)
+    swing_scan.add_argument("filename", nargs="?", default="scanresults.csv", help="TOS scan export")
+
+    swing_order = add_command(
+        "swing-order", run_swing_order, "place swing orders or roll their stops", connection.LIVE_PORT)
+    swing_order.add_argument("tickers", nargs="*", help="tickers to order (default: list in swing_ordering.py)")
+    swing_order.add_argument("--stops-only", action="store_true", help="only update the stop losses")
+
+    scanner = add_command(
+        "scanner-params", run_scanner_params, "list the available scanner parameters", connection.PAPER_PORT)
+    scanner.add_argument("--codes", action="store_true", help="print the scan codes instead of the tags")
+    scanner.add_argument("--no-browser", action="store_true", help="don't open the XML in a browser")
+    scanner.add_argument("--search", metavar="TEXT", help="only list the tags (or codes) containing TEXT")
+    scanner.add_argument("--prefix", action="store_true", help="with --search, match the start of the name only")
+    scanner.add_argument("--refresh", action="store_true", help="fetch the parameters from TWS again")
+
+    journal = subparsers.add_parser("journal", help="report on the trade journal")
+    journal.add_argument("--days", type=int, default=30, help="days of history to report (default 30)")
+    journal.add_argument("--path", default="journal.db", help="journal database (default journal.db)")
+    journal.set_defaults(func=run_journal)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Helpers shared by the hourly and swing scripts.
+"""
+
+from ib_insync import Order
+
+
+def share_size(risk_per_share, account_size, risk_percent):
+    """
+    Function will determine the correct position sizing
+    based on risk amount, account size and risk per share
+    """
+    shares = round((account_size * risk_percent) / risk_per_share)
+    return shares
+
+
+def bracket_order(ib, action: str,
+                  quantity: int,
+                  limit_price: float,
+                  take_profit_limit_price: float,
+                  take_profit_increment: float,
+                  stop_loss_price: float,
+                  stop_limit: float = None,
+                  scale_sizes: tuple = None,
+                  tif: str = "",
+                  take_profit_outside_rth: bool = False):
+    """
+    Returns the [parent, take_profit, stop_loss] orders of a bracket.
+
+    The parent is a limit order, or a stop limit triggered at stop_limit
+    when one is given.  The take_profit object includes scale attributes
+    so that profit prices can vary depending on the level size.
+    scale_sizes is (scaleInitLevelSize, scaleSubsLevelSize): the first
+    scaling out level of the position and the portion sold at each level
+    after that.  It defaults to a tenth of the quantity for both.  The
+    scalePriceIncrement is how much the profit level will increase up at
+    each sell point.
+
+    NOTE: Make sure to always handle order transmission accurately.
+    The transmit attribute for all orders should be set to False
+    except for the last order, which is of course set to True.
+    """
+    exit_action = "SELL" if action == "BUY" else "BUY"
+    scale_init, scale_subs = scale_sizes or (quantity // 10, quantity // 10)
+
+    # Every order gets its own ID so none of them can collide with a later request
+    parent = Order()
+    parent.orderId = ib.client.getReqId()
+    parent.action = action
+    parent.totalQuantity = quantity
+    parent.lmtPrice = limit_price
+    if stop_limit is None:
+        parent.orderType = "LMT"
+    else:
+        parent.orderType = "STP LMT"
+        parent.auxPrice = stop_limit
+    parent.tif = tif
+    parent.transmit = False
+
+    # This is the profit order with scaling out options
+    take_profit = Order()
+    take_profit.orderId = ib.client.getReqId()
+    take_profit.action = exit_action
+    take_profit.orderType = "LMT"
+    take_profit.totalQuantity = quantity
+    take_profit.lmtPrice = take_profit_limit_price
+    take_profit.scaleInitLevelSize = scale_init
+    take_profit.scaleSubsLevelSize = scale_subs
+    take_profit.scalePriceIncrement = take_profit_increment
+    take_profit.parentId = parent.orderId
+    take_profit.tif = tif
+    take_profit.outsideRth = take_profit_outside_rth
+    take_profit.transmit = False
+
+    # This is the stop loss order
+    stop_loss = Order()
+    stop_loss.orderId = ib.client.getReqId()
+    stop_loss.action = exit_action
+    stop_loss.orderType = "STP"
+    stop_loss.auxPrice = stop_loss_price
+    stop_loss.totalQuantity = quantity
+    stop_loss.parentId = parent.orderId
+    stop_loss.tif = tif
+    stop_loss.transmit = True
+
+    return [parent, take_profit, stop_loss]
+
+
+def submit_orders(ib, scheduler, contract, orders):
+    """
+    Queued in order so the transmitting order (the stop loss of a bracket) always goes last.
+    Returns a future for the Trade of every order
+    """
+    return [scheduler.submit("order", ib.placeOrder, contract, order) for order in orders]
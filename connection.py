@@ -0,0 +1,39 @@
+"""
+Connection factory shared by every script.
+
+create_ib() returns the IB instance a script works with without
+connecting, so importing a script (or running --help) never touches
+TWS.  connect() opens the connection when a command actually needs it.
+
+Set SIMULATE_IB to get the local simulator instead (see sim_ib.py).
+"""
+
+import os
+
+HOST = "127.0.0.1"
+PAPER_PORT = 7497
+LIVE_PORT = 7496
+
+
+def create_ib():
+    """ Returns an unconnected IB, or the simulator when SIMULATE_IB is set """
+    if os.environ.get("SIMULATE_IB"):
+        from sim_ib import SimIB
+        return SimIB.from_env()
+
+    # Imported here so the CLI can parse its arguments without loading ib_insync
+    from ib_insync import IB
+    return IB()
+
+
+def connect(ib, port=PAPER_PORT, client_id=1, host=HOST):
+    """ Connect ib if it isn't connected yet """
+    if ib.isConnected():
+        return ib
+
+    ib.connect(host, port, client_id)
+    if ib.isConnected():
+        print("Connection established")
+    else:
+        print("Failed to connect")
+    return ib
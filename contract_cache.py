@@ -0,0 +1,215 @@
+"""
+Contract qualification cache shared by the hourly and swing scripts.
+
+Qualifying a contract is a blocking round trip to TWS, and the same
+symbols get qualified over and over again throughout the day.  The
+cache keeps every qualified contract in memory and on disk so a symbol
+only has to be qualified once.
+
+Staleness/eviction rules:
+- Entries older than max_age seconds are re-qualified on their next use
+- Once the cache holds more than max_entries symbols the least recently
+    used ones are evicted
+- Contracts that fail to qualify are never cached
+
+More than one process can share the cache file (the hourly bot and its
+scanner worker, or the hourly and swing bots).  Every save reads the
+file again and merges in what the other processes have qualified since,
+and writes through a temp file of its own, so no process overwrites the
+others' entries.
+
+Pass a RequestScheduler to pace the qualification requests.
+"""
+
+import json
+import os
+import time
+from collections import OrderedDict
+
+from ib_insync import Contract, Stock
+
+import metrics
+
+CACHE_FILE = "contract_cache.json"
+
+# Contract attributes needed to rebuild a qualified contract from disk
+CONTRACT_FIELDS = (
+    "conId",
+    "symbol",
+    "secType",
+    "exchange",
+    "primaryExchange",
+    "currency",
+    "localSymbol",
+    "tradingClass")
+
+
+class ContractCache:
+    """ Symbol keyed cache of qualified stock contracts """
+
+    def __init__(self, ib, path=CACHE_FILE, max_age=7 * 24 * 3600, max_entries=5000, scheduler=None):
+        self.ib = ib
+        self.scheduler = scheduler
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # symbol -> (time qualified, contract), kept in least recently used order
+        self._entries = OrderedDict()
+        # symbol -> time invalidated, so a save doesn't merge the old entry back from disk
+        self._invalidated = {}
+        self.load()
+
+    def __contains__(self, symbol):
+        entry = self._entries.get(symbol)
+        return entry is not None and not self._is_stale(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, symbol):
+        """ Returns a qualified contract for a symbol """
+        return self.get_many([symbol])[0]
+
+    def get_many(self, symbols):
+        """
+        Returns qualified contracts for a list of symbols in the same order.
+        Cache misses are qualified together, one call to TWS per batch the scheduler allows at once.
+        """
+        contracts, missing = self._lookup(symbols)
+        for batch in self._batches(missing):
+            if self.scheduler is not None:
+                self.scheduler.acquire("contract", len(batch))
+            with metrics.span("qualifyContracts"), metrics.inflight("contract"):
+                self.ib.qualifyContracts(*[contracts[symbol] for symbol in batch])
+        if missing:
+            self._store(contracts, missing)
+
+        return [contracts[symbol] for symbol in symbols]
+
+    async def get_many_async(self, symbols):
+        """ Same as get_many but qualifies the cache misses with qualifyContractsAsync """
+        contracts, missing = self._lookup(symbols)
+        for batch in self._batches(missing):
+            if self.scheduler is not None:
+                await self.scheduler.acquire_async("contract", len(batch))
+            with metrics.span("qualifyContracts"), metrics.inflight("contract"):
+                await self.ib.qualifyContractsAsync(*[contracts[symbol] for symbol in batch])
+        if missing:
+            self._store(contracts, missing)
+
+        return [contracts[symbol] for symbol in symbols]
+
+    def add_many(self, qualified):
+        """ Cache contracts already qualified elsewhere, e.g. by the scanner worker """
+        qualified = [contract for contract in qualified if contract.conId]
+        if not qualified:
+            return
+        self._store({contract.symbol: contract for contract in qualified},
+                    [contract.symbol for contract in qualified])
+
+    def invalidate(self, symbol):
+        """ Drop a symbol so it is re-qualified on next use """
+        if self._entries.pop(symbol, None) is not None:
+            self._invalidated[symbol] = time.time()
+            self.save()
+
+    def load(self):
+        """ Load previously qualified contracts from disk """
+        self._entries.update(self._read())
+
+        # Oldest entries first so eviction drops them before fresh ones
+        self._entries = OrderedDict(
+            sorted(self._entries.items(), key=lambda item: item[1][0]))
+        self._evict()
+
+    def save(self):
+        """
+        Merge in the entries other processes have saved since, then write the
+        cache to disk.  Written to a temp file of this process first so a crash
+        can't corrupt it and two processes saving at once can't clash
+        """
+        merged = OrderedDict()
+        for symbol, entry in self._read().items():
+            ours = self._entries.get(symbol)
+            if ours is None and entry[0] > self._invalidated.get(symbol, 0):
+                merged[symbol] = entry
+            elif ours is not None and entry[0] > ours[0]:
+                self._entries[symbol] = entry
+
+        # Entries from disk go in as the least recently used here
+        if merged:
+            merged.update(self._entries)
+            self._entries = merged
+            self._evict()
+
+        data = {
+            symbol: (qualified_at, {field: getattr(contract, field) for field in CONTRACT_FIELDS})
+            for symbol, (qualified_at, contract) in self._entries.items()}
+
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(temp_path, self.path)
+
+    def _read(self):
+        """ Returns the symbol -> (time qualified, contract) entries saved on disk """
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            print(f"*** WARNING: Could not read contract cache {self.path} ***")
+            return {}
+
+        return {
+            symbol: (qualified_at, Contract.create(**fields))
+            for symbol, (qualified_at, fields) in data.items()}
+
+    def _lookup(self, symbols):
+        """ Returns the contracts found in the cache and a list of symbols that need qualifying """
+        contracts = {}
+        missing = []
+
+        for symbol in symbols:
+            entry = self._entries.get(symbol)
+            if entry is not None and not self._is_stale(entry):
+                self._entries.move_to_end(symbol)
+                contracts[symbol] = entry[1]
+                self.hits += 1
+            elif symbol not in contracts:
+                contracts[symbol] = Stock(symbol, "SMART", "USD")
+                missing.append(symbol)
+
+        self.misses += len(missing)
+        metrics.count("contract_cache_hits", len(symbols) - len(missing))
+        metrics.count("contract_cache_misses", len(missing))
+        return contracts, missing
+
+    def _batches(self, missing):
+        """ Splits the symbols to qualify into batches of the contract request burst, one request per symbol """
+        if not missing:
+            return []
+        size = self.scheduler.burst("contract") if self.scheduler is not None else len(missing)
+        return [missing[start:start + size] for start in range(0, len(missing), size)]
+
+    def _store(self, contracts, missing):
+        """ Cache the newly qualified contracts. Only the ones that actually qualified are kept """
+        now = time.time()
+        for symbol in missing:
+            if contracts[symbol].conId:
+                self._entries[symbol] = (now, contracts[symbol])
+                self._entries.move_to_end(symbol)
+        self._evict()
+        self.save()
+
+    def _is_stale(self, entry):
+        return time.time() - entry[0] > self.max_age
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,128 @@
+"""
+Real time entry triggers for the hourly watchlist.
+
+The hourly bar streams only tell the bot about a breakout when the next
+bar update arrives, and in polling mode only on the next pass over the
+watchlist, by which time the price has often run past the limit.  The
+triggers subscribe to a faster feed for the watchlist tickers:
+- "bars"    5 second real time bars (reqRealTimeBars)
+- "ticks"   tick-by-tick last prices (reqTickByTickData)
+
+Every update calls the callback(contract, high, low) registered with
+set_callback() straight from the event, so the bracket can go out as
+soon as the trigger price trades.
+
+Each subscription uses up a market data line, and tick-by-tick is
+limited to a handful of lines per account.  The number of subscriptions
+is capped at max_lines.  retain() is given the contracts in priority
+order (e.g. closest to their trigger first): the first max_lines keep or
+get a subscription and the rest are cancelled, so the lines follow the
+setups most likely to trigger.  Tickers without a line still trigger
+from the hourly bar stream as before.
+
+Pass a RequestScheduler to pace the subscriptions.
+"""
+
+import metrics
+
+# Default line budget per mode. Leaves room for the other market data the account uses
+MAX_LINES = {"bars": 50, "ticks": 5}
+
+# Tick-by-tick tick type
+TICK_TYPE = "Last"
+
+
+class EntryTriggers:
+    """ Real time bar or tick subscriptions for a limited set of symbols """
+
+    def __init__(self, ib, mode="bars", max_lines=None, scheduler=None):
+        if mode not in MAX_LINES:
+            raise ValueError(f"Unknown entry trigger mode {mode!r}. Use one of {list(MAX_LINES)}")
+        self.ib = ib
+        self.callback = None
+        self.mode = mode
+        self.max_lines = MAX_LINES[mode] if max_lines is None else max_lines
+        self.scheduler = scheduler
+
+        # symbol -> RealTimeBarList or Ticker
+        self._subscriptions = {}
+
+    def __contains__(self, symbol):
+        return symbol in self._subscriptions
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    @property
+    def symbols(self):
+        return set(self._subscriptions)
+
+    def set_callback(self, callback):
+        """ Call callback(contract, high, low) on every update of every subscription """
+        self.callback = callback
+
+    def retain(self, contracts):
+        """
+        Subscribe the first max_lines contracts (highest priority first) and
+        cancel the subscriptions of everything else
+        """
+        wanted = {contract.symbol: contract for contract in contracts if contract.conId}
+        keep = dict(list(wanted.items())[:self.max_lines])
+
+        for symbol in self.symbols - set(keep):
+            self.cancel(symbol)
+        for symbol, contract in keep.items():
+            if symbol not in self._subscriptions:
+                self.subscribe(contract)
+
+    def subscribe(self, contract):
+        """ Open a subscription for a contract if there is a line free """
+        if contract.symbol in self._subscriptions or len(self) >= self.max_lines:
+            return None
+
+        if self.scheduler is not None:
+            self.scheduler.acquire("market_data")
+        if self.mode == "bars":
+            subscription = self.ib.reqRealTimeBars(contract, 5, "TRADES", True)
+            subscription.updateEvent += self._on_bars
+        else:
+            subscription = self.ib.reqTickByTickData(contract, TICK_TYPE)
+            subscription.updateEvent += self._on_ticks
+
+        self._subscriptions[contract.symbol] = subscription
+        metrics.count("entry_trigger_lines_opened")
+        return subscription
+
+    def cancel(self, symbol):
+        subscription = self._subscriptions.pop(symbol, None)
+        if subscription is None:
+            return
+
+        if self.mode == "bars":
+            subscription.updateEvent -= self._on_bars
+            request = (self.ib.cancelRealTimeBars, subscription)
+        else:
+            subscription.updateEvent -= self._on_ticks
+            request = (self.ib.cancelTickByTickData, subscription.contract, TICK_TYPE)
+
+        if self.scheduler is not None:
+            self.scheduler.submit("market_data", *request)
+        else:
+            request[0](*request[1:])
+
+    def cancel_all(self):
+        for symbol in self.symbols:
+            self.cancel(symbol)
+
+    def report(self):
+        print(f"{len(self)} of {self.max_lines} real time {self.mode} lines in use")
+
+    def _on_bars(self, bars, has_new_bar):
+        if bars and self.callback is not None:
+            bar = bars[-1]
+            self.callback(bars.contract, bar.high, bar.low)
+
+    def _on_ticks(self, ticker):
+        prices = [tick.price for tick in ticker.tickByTicks if tick.price > 0]
+        if prices and self.callback is not None:
+            self.callback(ticker.contract, max(prices), min(prices))
@@ -0,0 +1,138 @@
+"""
+End of day flatten engine for the hourly bot.
+
+Flattening used to cancel and close one order at a time with sleeps in
+between and then wait 30 seconds before checking the positions again.
+Instead:
+- every non-GTC open order is cancelled at once (looked up in the
+    order book when one is passed, see order_book.py)
+- a market exit for every position is fired at once, on contracts from
+    the contract cache
+- completion is tracked from position events rather than by polling
+- positions still open after the fill timeout (a partial fill, a
+    rejected order, etc.) have their exit cancelled and are retried with
+    whatever quantity is left
+- the time to flat is reported at the end
+
+Positions in the exclude list (swing trades) are left alone.
+"""
+
+import asyncio
+import time
+
+from ib_insync import MarketOrder
+
+import metrics
+
+# Seconds to wait for the exits to fill before retrying the stragglers
+FILL_TIMEOUT = 20
+
+# Rounds of exits fired for the stragglers after the first one
+RETRIES = 3
+
+
+def cancel_open_orders(ib, scheduler=None, order_book=None):
+    """ Cancel every non-GTC open order at once. Returns the number cancelled """
+    if order_book is not None:
+        orders = [trade.order for trade in order_book.non_gtc()]
+    else:
+        orders = [order for order in ib.openOrders() if order.tif != "GTC"]
+    for order in orders:
+        if scheduler is not None:
+            scheduler.submit("order", ib.cancelOrder, order)
+        else:
+            ib.cancelOrder(order)
+    return len(orders)
+
+
+def open_positions(ib, exclude=()):
+    """ Returns a dict of symbol -> signed position for everything that needs closing """
+    return {
+        position.contract.symbol: position.position for position in ib.positions()
+        if position.position and position.contract.symbol not in exclude}
+
+
+async def flatten_async(
+        ib, contracts, exclude=(), scheduler=None, timeout=FILL_TIMEOUT, retries=RETRIES, order_book=None):
+    """
+    Close every position not in exclude with market orders.
+    Returns a dict of symbol -> position still open after the last retry (empty when flat).
+    """
+    remaining = open_positions(ib, exclude)
+    flat = asyncio.Event()
+
+    def on_position(position):
+        symbol = position.contract.symbol
+        if symbol not in remaining:
+            return
+        if position.position:
+            remaining[symbol] = position.position
+        else:
+            del remaining[symbol]
+            if not remaining:
+                flat.set()
+
+    ib.positionEvent += on_position
+    try:
+        for attempt in range(retries + 1):
+            if not remaining:
+                break
+
+            if attempt:
+                print(f"*** Retrying exits for {len(remaining)} positions: {sorted(remaining)} ***")
+                metrics.count("flatten_retries", len(remaining))
+
+                # Cancel the exits that didn't finish so they can't fill on top of the new ones
+                if order_book is not None:
+                    exits = [trade for symbol in remaining for trade in order_book.by_type("MKT", symbol)]
+                else:
+                    exits = [
+                        trade for trade in ib.openTrades()
+                        if trade.contract.symbol in remaining and trade.order.orderType == "MKT"]
+                for trade in exits:
+                    if scheduler is not None:
+                        scheduler.submit("order", ib.cancelOrder, trade.order)
+                    else:
+                        ib.cancelOrder(trade.order)
+
+            exit_contracts = contracts.get_many(list(remaining))
+            for contract in exit_contracts:
+                quantity = remaining[contract.symbol]
+                order = MarketOrder("SELL" if quantity > 0 else "BUY", abs(quantity))
+                if scheduler is not None:
+                    scheduler.submit("order", ib.placeOrder, contract, order)
+                else:
+                    ib.placeOrder(contract, order)
+            metrics.count("flatten_exits", len(exit_contracts))
+
+            try:
+                await asyncio.wait_for(flat.wait(), timeout)
+            except asyncio.TimeoutError:
+                # Catch anything the events missed before deciding who is a straggler
+                remaining.clear()
+                remaining.update(open_positions(ib, exclude))
+                if not remaining:
+                    flat.set()
+    finally:
+        ib.positionEvent -= on_position
+
+    return dict(remaining)
+
+
+def flatten(ib, contracts, exclude=(), scheduler=None, timeout=FILL_TIMEOUT, retries=RETRIES, order_book=None):
+    """ Blocking version of flatten_async that also cancels the open orders and reports the time to flat """
+    start = time.perf_counter()
+
+    cancelled = cancel_open_orders(ib, scheduler, order_book)
+    print(f"** {cancelled} hourly orders cancelled **")
+
+    positions = len(open_positions(ib, exclude))
+    print(f"*** Now closing {positions} positions ***")
+    remaining = ib.run(flatten_async(ib, contracts, exclude, scheduler, timeout, retries, order_book))
+
+    seconds = time.perf_counter() - start
+    if remaining:
+        print(f"*** WARNING: Still holding {remaining} after {seconds:.1f}s. Close them in TWS ***")
+    else:
+        print(f"Flat in {seconds:.1f}s")
+    return remaining
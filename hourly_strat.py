@@ -20,70 +20,215 @@ market.  However, in a more aggressive market where buying is stronger, the prof
 taking orders need to reflect that with higher R/R levels.
 """
 
+import asyncio
 import time
 import sys
 
-import pandas as pd
-import talib  # ? Maybe can pull some ATR or other volatiity data from here and match it with the scanners
-import webbrowser
-import xml.etree.ElementTree as ET
-
 from ib_insync import *
 
-# Instantiate IB class and establish connection
-ib = IB()
-# ! Change port id when on live account to 7496
-ib.connect('127.0.0.1', 7497, 1)
-if ib.isConnected():
-    print("Connection established")
-else:
-    print("Failed to connect")
+import candle_patterns
+import common
+import connection
+import flatten
+import market_calendar
+import market_scanner
+import metrics
+import resample
+import scanner_params
+import stop_orders
+from account import Account, RiskAllocator
+from bar_store import BarStore
+from bar_streams import BarStreamRegistry
+from contract_cache import ContractCache
+from entry_triggers import EntryTriggers
+from journal import Journal
+from order_book import OrderBook
+from request_scheduler import RequestScheduler
+from watchlist import Watchlist
+
+# Instantiate IB class. The connection is only opened by main()
+# * Set SIMULATE_IB to run against the local simulator instead of TWS (see sim_ib.py)
+ib = connection.create_ib()
+
+# The simulator runs on a virtual clock
+clock = getattr(ib, "clock", time.time)
+
+# Set BOT_METRICS to a directory to record stage timings (see metrics.py)
+metrics.set_clock(clock)
+
+# Every request to TWS is paced through the scheduler. Orders always go first
+scheduler = RequestScheduler(ib)
+
+# Qualified contracts are cached so each symbol only round trips to TWS once
+contracts = ContractCache(ib, scheduler=scheduler)
+
+# Open trades indexed by symbol, order type, etc. and kept up to date from the order events
+order_book = OrderBook(ib)
+
+# Merged scanner results are kept for the rest of the hour
+scan_cache = market_scanner.ScanCache()
+
+# Local index of the scanner parameters TWS offers, to catch bad tags without a round trip
+# * Build it with: python cli.py scanner-params
+scanner_catalog = scanner_params.ScannerCatalog()
+
+# Compact ring buffers of the last 8 hourly bars for every streamed symbol
+bar_store = BarStore(depth=8)
+
+# One live 1 hour bar stream per symbol, reused by every load_bars call
+bar_streams = BarStreamRegistry(
+    ib, duration="1 D", bar_size="1 hour", scheduler=scheduler, store=bar_store)
+
+# Multi-hour bars screened in the same pass as the 1 hour bars, e.g. (2, 4) for 2 and 4 hour setups.
+# They are resampled from the session's 1 hour bars (see resample.py), so they only pass once
+# the session has enough of them: 2 hour setups from around midday
+MULTI_HOUR_TIMEFRAMES = (2,)
+
+# Set to False to fall back to polling the watchlist every 20 seconds
+EVENT_DRIVEN = True
+
+# Real time feed that fires entries as soon as a watchlist ticker trades through its trigger high
+# "bars" for 5 second bars, "ticks" for tick-by-tick (only a few lines allowed) or None for the hourly bars only
+ENTRY_TRIGGER = "bars"
+
+# Real time subscriptions for the watchlist tickers closest to their trigger, within the market data line budget
+entry_triggers = EntryTriggers(ib, ENTRY_TRIGGER, scheduler=scheduler) if ENTRY_TRIGGER else None
+
+# Scanner price bands, highest priced first. IB only returns 50 tickers per scan so each band is its own scan
+# * Still want to find a real ATR type of tag
+SCANNER_BANDS = [
+    {"priceAbove": 15, "priceBelow": 20, "changePercAbove": 3, "priceRangeAbove": 1,
+        "marketCapBelow1e6": 2000, "volume": "higher_priced"},
+    {"priceAbove": 10, "priceBelow": 15, "changePercAbove": 3, "priceRangeAbove": 0.8,
+        "marketCapBelow1e6": 1500, "volume": "lower_priced"},
+    {"priceAbove": 5, "priceBelow": 10, "changePercAbove": 4, "priceRangeAbove": 0.5,
+        "marketCapBelow1e6": 1000, "volume": "lower_priced"},
+    {"priceAbove": 2, "priceBelow": 5, "changePercAbove": 5, "priceRangeAbove": 0.2,
+        "marketCapBelow1e6": 500, "volume": "under_one_dollar"},
+    {"priceAbove": 0.5, "priceBelow": 2, "changePercAbove": 5, "priceRangeAbove": 0.08,
+        "marketCapBelow1e6": 200, "volume": "under_one_dollar"},
+]
+
+# Position sizing. Brackets are sized against the streamed net liquidation, ACCOUNT_SIZE until it arrives
+ACCOUNT_SIZE = 1700
+RISK_PERCENT = 0.01
+
+# Cap on the risk of all the open brackets and positions together (see account.py)
+MAX_OPEN_RISK_PERCENT = 0.05
+
+# Account values streamed by TWS, kept in memory so sizing an entry never waits on a request
+account = Account(ib, ACCOUNT_SIZE)
+risk_allocator = RiskAllocator(account, order_book, RISK_PERCENT, MAX_OPEN_RISK_PERCENT)
+
+# Minutes before the close to flatten all hourly positions
+FLATTEN_MINUTES_BEFORE_CLOSE = 3
+
+# Limits for loading bars of scanned tickers at the top of every hour
+MAX_CONCURRENT_REQUESTS = 20  # Historical data requests in flight at once
+SYMBOL_TIMEOUT = 10           # Seconds before giving up on a single ticker
+
+# Current swing trading tickers to avoid interacting with throughout the day
+swing_trades = []
+# for trade in ib.openTrades():
+#    swing_trades.append(trade.contract.symbol)
+
+# Submit the whole bracket with a STP LMT entry at the inside bar high as soon as a ticker makes the watchlist,
+# so TWS triggers the entry. Staged brackets are cancelled on a new low and at the top of the hour
+# * Every staged bracket holds buying power until it's filled or cancelled
+STAGED_ENTRIES = False
+
+# Entries a ticker may take per hour. Raise to re-enter a setup after its first trade has closed
+MAX_ENTRIES_PER_HOUR = 1
+
+# Setups found this hour that are waiting for an entry, keyed by ticker (see watchlist.py)
+watchlist = Watchlist(max_entries=MAX_ENTRIES_PER_HOUR)
+
+# Signals, brackets, fills and round trips of every session in a local SQLite database (see journal.py)
+# * Opened by main(). Query it with: python cli.py journal
+journal = None
+
+# Scan in a separate process on the next client ID so a slow scan never holds up the stops and entries
+# * Same as python cli.py hourly --scan-worker
+SCAN_IN_WORKER = False
+
+
+def main(port=connection.PAPER_PORT, client_id=1, scan_in_worker=SCAN_IN_WORKER):
+    global journal
 
+    # Journal from the first event so nothing is missed, including the fills ib_insync loads while connecting.
+    # The swing positions share the account but aren't the hourly bot's trades
+    journal = Journal(clock=clock, exclude=swing_trades).attach(ib)
 
-def main():
+    # ! Change port id when on live account to 7496
+    connection.connect(ib, port, client_id)
 
-    # Build current swing trading ticker list to avoid interacting with throughout the day
-    swing_trades = []
-    # for trade in ib.openTrades():
-    #    swing_trades.append(trade.contract.symbol)
+    # Pick up the orders and account values that were already streamed before connecting
+    order_book.sync()
+    account.sync()
+    account.report()
+
+    # Scanner process on the next client ID (see scan_worker.py)
+    worker = None
+    if scan_in_worker:
+        from scan_worker import ScanWorker
+        worker = ScanWorker(port, client_id)
+        worker.start()
 
     # Initialize hour variable to help track time of day
     hour = 21
 
+    # In event driven mode entries and stop rolls are triggered by the bar streams themselves
+    if EVENT_DRIVEN:
+        bar_streams.subscribe_updates(on_bar_update)
+    if entry_triggers is not None:
+        entry_triggers.set_callback(on_entry_trigger)
+
     # Run continuously until program disconnects at end of day
     while True:
 
         # Establish the time of day
         # * NOTE: this is set to local time here in Vietnam
-        time_of_day = time.localtime()
+        time_of_day = time.localtime(clock())
 
         # Update orders every hour
         if hour != time_of_day.tm_hour:
 
-            # Cancel unfilled buy orders
-            for trade in ib.openTrades():
-                if trade.contract.symbol not in swing_trades:
-                    if trade.order.action == "BUY":
-                        ib.cancelOrder(trade.order)
-                        ib.sleep(0.5)
-                        print("Unfilled order cancelled")
+            # Cancel unfilled buy orders, including the brackets staged for the previous hour
+            for trade in order_book.by_action("BUY", exclude=swing_trades):
+                scheduler.submit("order", ib.cancelOrder, trade.order)
+                print("Unfilled order cancelled")
 
             # Update stop losses
-            adjust_hourly_stop_losses(swing_trades)
+            # * In event driven mode streamed symbols have their stops rolled on the new bar event instead
+            if EVENT_DRIVEN:
+                adjust_hourly_stop_losses(set(swing_trades) | bar_streams.symbols)
+            else:
+                adjust_hourly_stop_losses(swing_trades)
             print("*** Stop orders have been updated ***")
 
-        # Close all positions at the end of the day
-        # * NOTE: this will not work when the market closes early
-        if time_of_day.tm_hour == 3 and time_of_day.tm_min >= 57:
+        # Close all positions just before the close. Early close days come from the local market calendar
+        if market_calendar.minutes_to_close(clock()) <= FLATTEN_MINUTES_BEFORE_CLOSE:
+
+            # No new entries from the bar or trigger events while flattening
+            watchlist.clear()
+            if entry_triggers is not None:
+                entry_triggers.cancel_all()
 
-            while len(ib.positions()) > 0:
-                cancel_hourly_open_orders()
-                print("*** Now closing all positions ***")
-                close_all_hourly_positions(swing_trades)
-                ib.sleep(30)
+            with metrics.span("flatten"):
+                while close_all_hourly_positions(swing_trades):
+                    print("*** Positions still open. Trying again ***")
 
             print("All positions have been closed")
             print(f"Today's total commissions: ${commissions_paid()}")
+            journal.close()
+            today = market_calendar.exchange_time(clock()).date().isoformat()
+            journal.report(today, today)
+            scheduler.report()
+            bar_streams.cancel_all()
+            scheduler.drain()
+            metrics.export()
+            if worker is not None:
+                worker.stop()
             ib.disconnect()
             sys.exit("You have been disconnected")
 
@@ -91,149 +236,366 @@ def main():
         # * This loop should only run once per hour hence the updated hour variable at the end
         if hour != time_of_day.tm_hour:
 
-            # Initialize empty watchlist variable
-            watchlist = []
+            # Empty out the previous hour's watchlist
+            watchlist.expire(time_of_day.tm_hour)
+
+            # A dead worker leaves the scanning to this process again
+            if worker is not None and not worker.is_alive():
+                print("*** Scanner worker has stopped. Scanning in this process instead ***")
+                worker = None
 
-            # Store scanner results as a variable so list doesn't change while iterating
-            print("Scanning for tickers")
-            scan_results = scanner(time_of_day)
+            if worker is not None:
+                # The setups are added by receive_setups whenever the worker is done
+                print("Scanner worker is scanning for tickers")
+                worker.request(time_of_day.tm_hour, clock())
+            else:
+                # Store scanner results as a variable so list doesn't change while iterating
+                print("Scanning for tickers")
+                scan_results = scanner(time_of_day)
 
-            print("Now adding tickers to watchlist")
+                print("Now adding tickers to watchlist")
+                build_watchlist(scan_results, time_of_day.tm_hour)
+                watchlist_ready()
 
-            for ticker in scan_results:
+            # Update hour variable to prevent loop from running again
+            hour = time_of_day.tm_hour
 
-                if ticker not in swing_trades:
+        if worker is not None:
+            receive_setups(worker, hour)
 
-                    # Create a contract
-                    contract = Stock(ticker, "SMART", "USD")
+        if EVENT_DRIVEN:
+            # Entries are placed by on_bar_update. Only need to drop streams for removed tickers here
+            bar_streams.retain(watchlist.symbols | open_trades_ticker_set())
 
-                    # Use qualify contracts function to automatically fill in additional info
-                    ib.qualifyContracts(contract)
+        # Loop thru watchlist and check for any orders to be placed
+        elif len(watchlist) > 0:
 
-                    # Create a dataframe of 1 hour bars
-                    df = build_dataframe(contract)
+            print("Starting iteration over watchlist")
+            check_watchlist()
+            print("Finished iterating over the watchlist")
 
-                    # Append ticker to watchlist if it passes the strategy check
-                    try:
-                        if check_strategy_1(df, time_of_day.tm_hour):
-                            watchlist.append(ticker)
-                        if check_strategy_2(df, time_of_day.tm_hour):
-                            watchlist.append(ticker)
-                    except AttributeError:
-                        continue
+            # Drop the bar streams for tickers removed from the watchlist
+            bar_streams.retain(watchlist.symbols | open_trades_ticker_set())
 
-            print(f"{len(watchlist)} tickers have been added to the watchlist")
-            print(watchlist)
+        else:
+            # Sleep for a while if there are no tickers in watchlist
+            print("resting...")
+            ib.sleep(30)
 
-            # Update hour variable to prevent loop from running again
-            hour = time_of_day.tm_hour
+        # Move the real time lines to the setups closest to their trigger
+        if entry_triggers is not None:
+            update_entry_triggers()
 
-        # Loop thru watchlist and check for any orders to be placed
-        if len(watchlist) > 0:
+        # Sleep interval to allow for updates
+        ib.sleep(20)
 
-            print("Starting iteration over watchlist")
 
-            # Build a ticker list with open trades
-            tickers_with_open_trades = open_trades_ticker_set()
+@metrics.timed()
+def build_watchlist(scan_results, hour):
+    """ Adds the scanned tickers that pass a strategy check to the watchlist """
+    add_setups(screen(scan_results, hour), hour)
 
-            for ticker in watchlist:
 
-                # Check an order hasn't already been placed             #? May need to consider how to adjust this so more than one trade can be made on the same ticker
-                # ? Could be done with a dictionary with tm_hour as the key and a list of tickers as the value
-                if ticker not in tickers_with_open_trades:
+@metrics.timed()
+def screen(scan_results, hour):
+    """
+    Returns a list of (ticker, strategy, trigger high, invalidation low) for
+    every scanned ticker that passes a strategy check
+    """
+
+    # Qualify and load bars for all the scanned tickers concurrently
+    tickers = [ticker for ticker in scan_results if ticker not in swing_trades]
+    # Tickers that failed to qualify, timed out or returned no bars are left out
+    bars_by_ticker = ib.run(fetch_hourly_bars(tickers))
+
+    # The 1 hour bars and every multi-hour timeframe resampled from them, keyed by (hours, ticker)
+    bars_by_key = {(1, ticker): bar_store.get(ticker) for ticker in bars_by_ticker}
+    for hours in MULTI_HOUR_TIMEFRAMES:
+        for ticker, bars in bars_by_ticker.items():
+            bars_by_key[hours, ticker] = resample.multi_hour(bars, hours)
+
+    # Check both strategies for every ticker and timeframe in one vectorized pass
+    keys, ohlc = candle_patterns.stack_bars(bars_by_key)
+    with metrics.span("hourly_setups"):
+        setups = candle_patterns.hourly_setups(ohlc, hour)
+
+    # The inside bar sets the entry and invalidation levels. A ticker passing on more than one
+    # timeframe keeps the levels of the first one it passed, the 1 hour bars first
+    found = []
+    for row, (hours, ticker) in enumerate(keys):
+        inside_bar = ohlc[row, -2]
+        for strategy in ("strategy_1", "strategy_2"):
+            if setups[strategy][row]:
+                found.append((
+                    ticker, strategy if hours == 1 else f"{strategy}_{hours}h",
+                    float(inside_bar[candle_patterns.HIGH]), float(inside_bar[candle_patterns.LOW])))
+
+    metrics.count("tickers_scanned", len(tickers))
+    return found
+
+
+def add_setups(found, hour):
+    """ Adds the setups found by screen to the watchlist and stages their entries if STAGED_ENTRIES is set """
+    for ticker, strategy, trigger_high, invalidation_low in found:
+        watchlist.add(ticker, strategy, trigger_high, invalidation_low, hour)
+        if journal is not None:
+            journal.signal(ticker, strategy, trigger_high, invalidation_low, hour)
+
+    metrics.count("watchlist_added", len(watchlist))
+
+    if STAGED_ENTRIES:
+        stage_entries()
+
+
+def watchlist_ready():
+    """ Prints the new watchlist and moves the bar streams and real time lines over to it """
+    print(f"{len(watchlist)} tickers have been added to the watchlist")
+    print(watchlist)
+
+    # Drop the bar streams for scanned tickers that didn't make the watchlist
+    bar_streams.retain(watchlist.symbols | open_trades_ticker_set())
+    bar_streams.report()
+    if entry_triggers is not None:
+        update_entry_triggers()
+        entry_triggers.report()
+    print(f"Bar store holding {len(bar_store)} tickers in {bar_store.memory_usage() / 1024:.1f} KB")
+    scheduler.report()
+    metrics.export()
+
+
+def receive_setups(worker, hour):
+    """
+    Adds the setups from the scanner worker to the watchlist once they arrive.
+    Only the bars of the tickers that passed are loaded here, the worker loaded the rest.
+    Their contracts come qualified from the worker
+    """
+    result = worker.poll()
+    if result is None:
+        return
 
-                    print(f"Checking ticker {ticker}")
+    result_hour, found, error, qualified = result
+    contracts.add_many(qualified)
+    if error is not None:
+        print(f"*** Scanner worker failed: {error} ***")
+    if result_hour != hour:
+        # Arrived after its hour was over
+        return
 
-                    # Create a contract
-                    contract = Stock(ticker, "SMART", "USD")
+    print(f"Scanner worker found {len(found)} setups")
+    ib.run(fetch_hourly_bars(list({ticker for ticker, *levels in found})))
+    add_setups(found, hour)
+    watchlist_ready()
 
-                    # Use qualify contracts function to automatically fill in additional info
-                    ib.qualifyContracts(contract)
 
-                    # Create a dataframe of 1 hour bars
-                    df = build_dataframe(contract)
+@metrics.timed()
+def check_watchlist():
+    """ One polling pass over the watchlist. Places an order on a breakout, removes a ticker on a new low """
 
-                    # Remove ticker from watchlist if it makes a new low from previous candle
-                    if df.low.iloc[-1] < df.low.iloc[-2]:
-                        watchlist.remove(ticker)
-                        print(
-                            f"*** {ticker} has been removed from watchlist ***")
+    # Setups are a snapshot so check_for_entry can remove tickers along the way
+    for setup in watchlist.setups():
+        ticker = setup.symbol
 
-                    # Place order when new hourly high is made if a new low hasn't been made first
-                    if df.high.iloc[-1] > df.high.iloc[-2] and df.low.iloc[-1] >= df.low.iloc[-2]:
+        # Staged entries are triggered by TWS. The stream keeps the bar store current so there is nothing to load
+        if setup.staged is not None:
+            check_staged_entry(setup, bar_store.get(ticker))
+            continue
 
-                        # Set the limit price. Higher priced stocks have higher limit ranges
-                        if df.open.iloc[-1] < 1:
-                            limit_price = round((df.high.iloc[-2] + 0.005), 3)
-                        elif df.open.iloc[-1] <= 5:
-                            limit_price = round((df.high.iloc[-2] + 0.01), 2)
-                        else:
-                            limit_price = round((df.high.iloc[-2] + 0.02), 2)
+        # Check an order isn't already working. Once it's closed the setup can be entered again up to MAX_ENTRIES_PER_HOUR
+        if ticker in order_book:
+            continue
 
-                        # Set the stop loss
-                        if df.open.iloc[-1] < 1:
-                            stop_loss = round((df.low.iloc[-2] - 0.005), 3)
-                        else:
-                            stop_loss = round((df.low.iloc[-2] - 0.01), 2)
+        print(f"Checking ticker {ticker}")
 
-                        # Set share size based on risk tolerance
-                        risk_per_share = round((limit_price - stop_loss), 2)
-                        quantity = share_size(risk_per_share)
+        # Get the qualified contract from the cache
+        contract = contracts.get(ticker)
 
-                        # Set take_profit increment. Always a multiple of risk per share
-                        take_profit_increment = risk_per_share * 1
+        # Get the latest 1 hour bars. Skip the ticker this pass if they timed out or haven't come in yet
+        bars = load_bars(contract)
+        if bars is None or len(bars) < 2:
+            print(f"*** No bars for {ticker} yet ***")
+            continue
 
-                        # First profit level based on risk per share
-                        take_profit_level = round(
-                            (df.high.iloc[-2] + take_profit_increment), 2)
+        # Remove from the watchlist on a new low, place an order on a new high
+        check_for_entry(setup, contract, bars)
 
-                        # Place bracket order with take profit levels and a stop loss
-                        place_order(contract, "BUY", quantity,
-                                    limit_price, take_profit_level, take_profit_increment, stop_loss)
 
-                        # Confirm order placement with print statement
-                        print(
-                            f"** An order has been placed for {ticker}. See TWS for details **")
+@metrics.timed()
+async def fetch_hourly_bars(tickers):
+    """ Returns a dict of ticker -> live 1 hour bars, qualified and requested concurrently """
+    scan_contracts = await contracts.get_many_async(tickers)
+    return await bar_streams.get_many_async(
+        scan_contracts, MAX_CONCURRENT_REQUESTS, SYMBOL_TIMEOUT)
 
-                else:
-                    # Remove ticker from watchlist if it already has an order
-                    watchlist.remove(ticker)
-                    print(
-                        f"{ticker} already has an order. It has been removed from watchlist")
 
-            print("Finished iterating over the watchlist")
+@metrics.timed()
+def check_for_entry(setup, contract, bars, high=None, low=None):
+    """
+    Checks the current bar against the inside bar levels of a watchlist setup.
+    The ticker is removed from the watchlist if the current bar makes a new low
+    and an order is placed if it makes a new high first.
+    high and low are the latest prices from a real time trigger, which can be ahead of the hourly bar
+    """
+    ticker = setup.symbol
+    current_bar = bars.bar(-1)
+    high = current_bar.high if high is None else max(high, current_bar.high)
+    low = current_bar.low if low is None else min(low, current_bar.low)
+
+    # Remove ticker from watchlist if it makes a new low from previous candle
+    if low < setup.invalidation_low:
+        watchlist.remove(ticker)
+        print(
+            f"*** {ticker} has been removed from watchlist ***")
+
+    # Place order when new hourly high is made if a new low hasn't been made first
+    if high > setup.trigger_high and low >= setup.invalidation_low:
+
+        limit_price, stop_loss, take_profit_level, take_profit_increment, risk_per_share = entry_prices(
+            setup, current_bar.open)
+
+        # Nothing left under the open risk cap or the buying power
+        quantity = share_size(risk_per_share, limit_price)
+        if quantity <= 0:
+            watchlist.remove(ticker)
+            print(f"*** {ticker} not entered. No risk left under the cap ***")
+            return
+
+        # Place bracket order with take profit levels and a stop loss
+        place_order(contract, "BUY", quantity,
+                    limit_price, take_profit_level, take_profit_increment, stop_loss,
+                    strategy="/".join(setup.strategies))
+
+        # Confirm order placement with print statement
+        print(
+            f"** An order has been placed for {ticker}. See TWS for details **")
+
+        # Done with the setup once it has taken all of its entries for the hour
+        watchlist.record_entry(setup)
+        if not watchlist.can_enter(setup):
+            watchlist.remove(ticker)
+
+
+def entry_prices(setup, open_price):
+    """ Returns (limit price, stop loss, take profit level, take profit increment, risk per share) for a setup """
+
+    # Set the limit price. Higher priced stocks have higher limit ranges
+    if open_price < 1:
+        limit_price = round((setup.trigger_high + 0.005), 3)
+    elif open_price <= 5:
+        limit_price = round((setup.trigger_high + 0.01), 2)
+    else:
+        limit_price = round((setup.trigger_high + 0.02), 2)
+
+    # Set the stop loss
+    if open_price < 1:
+        stop_loss = round((setup.invalidation_low - 0.005), 3)
+    else:
+        stop_loss = round((setup.invalidation_low - 0.01), 2)
+
+    # Share size is set from the risk per share by the risk allocator
+    risk_per_share = round((limit_price - stop_loss), 2)
 
+    # Set take_profit increment. Always a multiple of risk per share
+    take_profit_increment = risk_per_share * 1
+
+    # First profit level based on risk per share
+    take_profit_level = round(
+        (setup.trigger_high + take_profit_increment), 2)
+
+    return limit_price, stop_loss, take_profit_level, take_profit_increment, risk_per_share
+
+
+@metrics.timed()
+def stage_entries():
+    """
+    Submit a bracket with a STP LMT entry for every watchlist setup that doesn't have one yet.
+    TWS triggers the entry one tick over the inside bar high, so no data has to be checked for the breakout.
+    All the brackets are sized together so the batch stays under the open risk cap
+    """
+    entries = []
+    for setup in watchlist.setups():
+        ticker = setup.symbol
+        bars = bar_store.get(ticker)
+        if setup.staged is not None or ticker in order_book or bars is None or not watchlist.can_enter(setup):
+            continue
+
+        # Already below the inside bar low, the setup is dead
+        current_bar = bars.bar(-1)
+        if current_bar.low < setup.invalidation_low:
+            watchlist.remove(ticker)
+            continue
+
+        prices = entry_prices(setup, current_bar.open)
+
+        # Trigger one tick over the inside bar high
+        if current_bar.open < 1:
+            stop_trigger = round((setup.trigger_high + 0.005), 3)
         else:
-            # Sleep for a while if there are no tickers in watchlist
-            print("resting...")
-            ib.sleep(30)
+            stop_trigger = round((setup.trigger_high + 0.01), 2)
+        entries.append((setup, prices, min(stop_trigger, prices[0])))
 
-        # Sleep interval to allow for updates
-        ib.sleep(20)
+    quantities = risk_allocator.allocate(
+        [prices[4] for _, prices, _ in entries], [prices[0] for _, prices, _ in entries])
+
+    for (setup, prices, stop_trigger), quantity in zip(entries, quantities):
+        ticker = setup.symbol
+        limit_price, stop_loss, take_profit_level, take_profit_increment, _ = prices
+        if quantity <= 0:
+            watchlist.remove(ticker)
+            print(f"*** {ticker} not staged. No risk left under the cap ***")
+            continue
 
+        setup.staged = place_order(
+            contracts.get(ticker), "BUY", int(quantity), limit_price, take_profit_level,
+            take_profit_increment, stop_loss, stop_limit=stop_trigger, strategy="/".join(setup.strategies))
+        watchlist.record_entry(setup)
+        metrics.count("entries_staged")
+        print(f"** Entry staged for {ticker} at {stop_trigger}. See TWS for details **")
 
-def build_dataframe(contract):
-    """ Returns a dataframe of 1 hour bars from a contract argument """
 
-    # Request live updates for historical bars
-    bars = ib.reqHistoricalData(
-        contract,
-        endDateTime="",
-        durationStr="1 D",
-        barSizeSetting="1 hour",
-        whatToShow="TRADES",
-        useRTH=True,
-        formatDate=1,
-        keepUpToDate=True)
+def check_staged_entry(setup, bars):
+    """
+    Cancel a staged bracket if the current bar makes a new low before the entry triggers.
+    The setup leaves the watchlist once its entry has filled or the bracket is gone
+    """
+    future = setup.staged
+    if not future.done():
+        # Still waiting on the scheduler
+        return
+
+    ticker = setup.symbol
+    # A bracket the scheduler cancelled (e.g. on shutdown) or that failed to place counts as gone
+    trade = None if future.cancelled() or future.exception() is not None else future.result()
+    if trade is None or trade.isDone() or trade.orderStatus.filled:
+        watchlist.remove(ticker)
+        return
+
+    if bars is not None and len(bars) and bars.bar(-1).low < setup.invalidation_low:
+        # Cancelling the parent cancels its take profit and stop loss too
+        scheduler.submit("order", ib.cancelOrder, trade.order)
+        watchlist.remove(ticker)
+        metrics.count("staged_entries_cancelled")
+        print(f"*** {ticker} made a new low. Staged order cancelled and removed from watchlist ***")
+
+
+@metrics.timed()
+def load_bars(contract):
+    """
+    Returns the ring buffer of 1 hour bars from a contract argument.
+    Returns None if no bars could be loaded.
+    """
 
-    # Build dataframe from bars data list
-    df = util.df(bars)
+    # Live updating bars. The stream is only opened the first time a symbol is requested
+    bar_streams.get(contract)
 
-    return df
+    # The bar store is kept up to date by the stream so no dataframe is needed
+    return bar_store.get(contract.symbol)
 
 
 def check_strategy_1(df, hour):
-    """ Function checks if strategic criteria has been met """
+    """
+    Function checks if strategic criteria has been met
+    * candle_patterns.hourly_setups is the vectorized version. Keep the two in sync
+    """
 
     # No afternoon trading except for around noon
     if 0 < hour < 4:
@@ -253,7 +615,10 @@ def check_strategy_1(df, hour):
 
 
 def check_strategy_2(df, hour):
-    """ Function checks for the second setup """
+    """
+    Function checks for the second setup
+    * candle_patterns.hourly_setups is the vectorized version. Keep the two in sync
+    """
 
     # Cannot trade until midnight and no trading the last hour of the day
     if hour >= 3:
@@ -273,80 +638,69 @@ def check_strategy_2(df, hour):
 
 
 def on_bar_update(bars: BarDataList, has_new_bar: bool):
-    """ Callback function to update on every new bar """
+    """
+    Callback function to update on every new bar.
+    Runs inside the event loop so it must never block (no ib.sleep or blocking requests).
+    A new bar rolls the hourly stop losses for the symbol and every update
+    checks a watchlist ticker for its breakout or a new low.
+    """
+    ticker = bars.contract.symbol
+    if ticker in swing_trades or len(bars) < 2:
+        return
+
+    # The bar store has already been updated by the stream so read from it instead of bars
+    symbol_bars = bar_store.get(ticker)
+
+    # The bar that just completed is now bar(-2) so roll the stops up to its low
+    if has_new_bar:
+        roll_stop_losses(ticker, symbol_bars)
 
+    # A setup from an earlier hour has expired now that its inside bar is no longer the last completed bar
+    setup = watchlist.get(ticker, time.localtime(clock()).tm_hour)
+    if setup is None:
+        return
+    if setup.staged is not None:
+        check_staged_entry(setup, symbol_bars)
+    elif ticker not in order_book:
+        check_for_entry(setup, bars.contract, symbol_bars)
 
+
+@metrics.timed()
 def place_order(contract, action: str,
                 quantity: int,
                 limit_price: float,
                 take_profit_limit_price: float,
                 take_profit_increment: float,
-                stop_loss_price: float):
-    """ 
+                stop_loss_price: float,
+                stop_limit: float = None,
+                strategy: str = None):
+    """
     This function handles all of the order placements into IB.
-    It uses a bracket order to incorporate profit taking and 
-    a stop loss.  
-
-    The take_profit object includes scale attributes so that
-    profit prices can vary depending on the level size.
-    The scaleInitLevelSize is the first scaling out profit level of 
-    the position.  The scaleSubsLevelSize is the next portion that
-    the bracket order will sell at the next profit level. 
-    The scalePriceIncrement is how much the profit level will
-    increase up at each sell point.   
-
-    NOTE: Make sure to always handle order transmission accurately.
-    The transmit attribute for all orders should be set to False
-    except for the last order, which is of course set to True.
+    It uses a limit bracket order (common.bracket_order) to incorporate
+    profit taking, scaled out a tenth of the position at a time, and a stop loss.
+    The entry is a stop limit triggered at stop_limit when one is given (staged entries).
+    The bracket is journaled under strategy.
+    Returns a future for the parent Trade
     """
-    # Get an order ID to assign to the parent order
-    parent_order_id = ib.client.getReqId()
-
-    # This is the main order aka the "parent order"
-    parent = Order()
-    parent.orderId = parent_order_id
-    parent.action = action
-    parent.orderType = "LMT"
-    parent.totalQuantity = quantity
-    parent.lmtPrice = limit_price
-    parent.transmit = False
-
-    # This is the profit order with scaling out options
-    take_profit = Order()
-    take_profit.orderId = parent.orderId + 1
-    take_profit.action = "SELL" if action == "BUY" else "BUY"
-    take_profit.orderType = "LMT"
-    take_profit.totalQuantity = quantity
-    take_profit.lmtPrice = take_profit_limit_price
-    take_profit.scaleInitLevelSize = quantity // 10
-    take_profit.scaleSubsLevelSize = quantity // 10
-    take_profit.scalePriceIncrement = take_profit_increment
-    take_profit.parentId = parent_order_id
-    take_profit.transmit = False
-
-    # This is the stop loss order
-    stop_loss = Order()
-    stop_loss.orderId = parent.orderId + 2
-    stop_loss.action = "SELL" if action == "BUY" else "BUY"
-    stop_loss.orderType = "STP"
-    stop_loss.auxPrice = stop_loss_price
-    stop_loss.totalQuantity = quantity
-    stop_loss.parentId = parent_order_id
-    stop_loss.transmit = True
-
-    bracket_order = [parent, take_profit, stop_loss]
-
-    for order in bracket_order:
-        ib.placeOrder(contract, order)
+    bracket = common.bracket_order(
+        ib, action, quantity, limit_price, take_profit_limit_price,
+        take_profit_increment, stop_loss_price, stop_limit=stop_limit)
+    if journal is not None:
+        journal.bracket(contract, bracket, strategy)
+    futures = common.submit_orders(ib, scheduler, contract, bracket)
+    metrics.count("brackets_placed")
+    return futures[0]
 
 
+@metrics.timed()
 def scanner(time_of_day):
     """ 
     Returns a list of tickers to be used for potential trades 
     Pass on a time of day argument.  Ideally, you
     want to screen for higher volume as the day progresses.  
-    There are two scan subscriptions being made because IB only returns
-    a maximum of 50 tickers per subscription.  Subs are divided by stock price.
+    There is a scan subscription for every price band in SCANNER_BANDS because IB only returns
+    a maximum of 50 tickers per subscription.  All bands are scanned at the same time.
+    Results are cached for the rest of the hour in case the bot restarts.
     """
 
     # Initialize minimum volume requirement for scanner. Scale up volume over time.
@@ -360,224 +714,132 @@ def scanner(time_of_day):
         volume_higher_priced = 750_000
         volume_lower_priced = 1e6
 
-    volume_under_one_dollar = 1e6
+    volumes = {
+        "higher_priced": volume_higher_priced,
+        "lower_priced": volume_lower_priced,
+        "under_one_dollar": 1e6}
 
     # Create a ScannerSubscription to submit to the reqScannerData method
     # * Currently only trading on the NASDAQ to avoid AMEX and overtrading
     # * STK.US.MAJOR to trade on all major exchanges
-    sub_1 = ScannerSubscription(
-        instrument="STK",
-        locationCode="STK.NASDAQ",
-        scanCode="TOP_PERC_GAIN")
-
-    sub_2 = ScannerSubscription(
+    subscription = ScannerSubscription(
         instrument="STK",
         locationCode="STK.NASDAQ",
         scanCode="TOP_PERC_GAIN")
 
-    # Set scanner criteria with the appropriate tag values
-    tag_values_1 = [
-        # * Still want to find a real ATR type of tag
-        TagValue("changePercAbove", 3),
-        TagValue("priceBelow", 20),
-        TagValue("priceAbove", 15),
-        TagValue("volumeAbove", volume_higher_priced),
-        TagValue("priceRangeAbove", "1"),
-        TagValue("volumeRateAbove", 0),
-        TagValue("marketCapBelow1e6", 2000)]
-
-    tag_values_2 = [
-        TagValue("changePercAbove", "3"),
-        TagValue("priceBelow", 15),
-        TagValue("priceAbove", 10),
-        TagValue("volumeAbove", volume_lower_priced),
-        TagValue("priceRangeAbove", "0.8"),
-        TagValue("volumeRateAbove", 0),
-        TagValue("marketCapBelow1e6", 1500)]
-
-    tag_values_3 = [
-        TagValue("changePercAbove", "4"),
-        TagValue("priceBelow", 10),
-        TagValue("priceAbove", 5),
-        TagValue("volumeAbove", volume_lower_priced),
-        TagValue("priceRangeAbove", "0.5"),
-        TagValue("volumeRateAbove", 0),
-        TagValue("marketCapBelow1e6", 1000)]
-
-    tag_values_4 = [
-        TagValue("changePercAbove", "5"),
-        TagValue("priceBelow", 5),
-        TagValue("priceAbove", 2),
-        TagValue("volumeAbove", volume_under_one_dollar),
-        TagValue("priceRangeAbove", "0.2"),
-        TagValue("volumeRateAbove", 0),
-        TagValue("marketCapBelow1e6", 500)]
-
-    tag_values_5 = [
-        TagValue("changePercAbove", "5"),
-        TagValue("priceBelow", 2),
-        TagValue("priceAbove", 0.5),
-        TagValue("volumeAbove", volume_under_one_dollar),
-        TagValue("priceRangeAbove", "0.08"),
-        TagValue("volumeRateAbove", 0),
-        TagValue("marketCapBelow1e6", 200)]
-
-    # The tag_values are given as 3rd argument; the 2nd argument must always be an empty list
-    # (IB has not documented the 2nd argument and it's not clear what it does)
-    scan_data_1 = ib.reqScannerData(sub_1, [], tag_values_1)
-    scan_data_2 = ib.reqScannerData(sub_1, [], tag_values_2)
-    scan_data_3 = ib.reqScannerData(sub_1, [], tag_values_3)
-    scan_data_4 = ib.reqScannerData(sub_2, [], tag_values_4)
-    scan_data_5 = ib.reqScannerData(sub_2, [], tag_values_5)
-
-    # Add tickers to a list and return that list
-    symbols_1 = [sd.contractDetails.contract.symbol for sd in scan_data_1]
-    symbols_2 = [sd.contractDetails.contract.symbol for sd in scan_data_2]
-    symbols_higher_priced = symbols_1 + symbols_2
-    symbols_3 = [sd.contractDetails.contract.symbol for sd in scan_data_3]
-    symbols_4 = [sd.contractDetails.contract.symbol for sd in scan_data_4]
-    symbols_5 = [sd.contractDetails.contract.symbol for sd in scan_data_5]
-    symbols_lower_priced = symbols_3 + symbols_4 + symbols_5
-
-    print(len(symbols_higher_priced), "tickers found for higher priced stocks")
-    print(symbols_higher_priced)
-    print(len(symbols_lower_priced), "tickers found for lower priced stocks")
-    print(symbols_lower_priced)
-    return symbols_higher_priced + symbols_lower_priced
-
-
-def cancel_hourly_open_orders():
-    """ This function cancels all hourly open orders """
-
-    for order in ib.openOrders():
-        if order.tif != "GTC":
-            ib.cancelOrder(order)
-            ib.sleep(1)
-
-    print("** All hourly orders have been cancelled **")
-
-
+    # Set scanner criteria with the appropriate tag values for each band
+    bands = []
+    for band in SCANNER_BANDS:
+        tag_values = [
+            TagValue("changePercAbove", str(band["changePercAbove"])),
+            TagValue("priceBelow", str(band["priceBelow"])),
+            TagValue("priceAbove", str(band["priceAbove"])),
+            TagValue("volumeAbove", str(volumes[band["volume"]])),
+            TagValue("priceRangeAbove", str(band["priceRangeAbove"])),
+            TagValue("volumeRateAbove", "0"),
+            TagValue("marketCapBelow1e6", str(band["marketCapBelow1e6"]))]
+        bands.append((f"${band['priceAbove']}-{band['priceBelow']}", tag_values))
+
+    # Warn about misspelled tags offline. TWS would otherwise just return an empty scan
+    scanner_catalog.check(subscription, bands[0][1])
+
+    # Scan results are only good for the hour they were scanned in
+    cache_key = time.strftime("%Y-%m-%d %H", time_of_day)
+    return market_scanner.scan(
+        ib, subscription, bands, cache_key, cache=scan_cache, scheduler=scheduler)
+
+
+@metrics.timed()
 def close_all_hourly_positions(swing_trades):
-    """ Close all positions in account. Ticker list argument are tickers NOT to be closed """
-
-    # Market order out of all hourly positions
-    positions = ib.positions()
-    for position in positions:
-        if position.contract.symbol not in swing_trades:
-            contract = Stock(position.contract.symbol, "SMART", "USD")
-            ib.qualifyContracts(contract)
-            quantity = abs(position.position)
-            order = MarketOrder(action="SELL", totalQuantity=quantity)
-            ib.placeOrder(contract, order)
-            ib.sleep(1)
+    """
+    Cancel all hourly open orders and close all positions in account. Ticker list argument are tickers NOT to be closed
+    Returns a dict of ticker -> position for anything still open after the retries (empty when flat)
+    """
+    return flatten.flatten(ib, contracts, swing_trades, scheduler, order_book=order_book)
 
 
+@metrics.timed()
 def adjust_hourly_stop_losses(swing_trades):
-    """ Function will update all hourly stop losses """
-
-    for trade in ib.openTrades():
-
-        if trade.contract.symbol not in swing_trades:
+    """
+    Roll every hourly stop loss up to the low of the previous bar. Ticker list argument are tickers NOT to be updated
+    Only stops whose price changes are modified. They are all submitted at once and confirmed by their status events
+    """
 
-            if trade.order.orderType == "STP":
+    stops = [trade for trade in order_book.by_type("STP") if trade.contract.symbol not in swing_trades]
 
-                # Create new contract based on the symbol
-                contract = Stock(trade.contract.symbol, "SMART", "USD")
-                ib.qualifyContracts(contract)
+    # Stops without a bar stream yet (e.g. after a restart) get theirs opened together
+    missing = {trade.contract.symbol for trade in stops} - bar_streams.symbols
+    if missing:
+        ib.run(fetch_hourly_bars(list(missing)))
 
-                # Make sure the bars data is up to date
-                df = build_dataframe(contract)
+    # Work out every new stop price in one pass from the bar store
+    trades_and_lows = []
+    for trade in stops:
+        bars = bar_store.get(trade.contract.symbol)
+        if bars is None or len(bars) < 2:
+            print(f"*** WARNING: Stop loss not updated for: {trade.contract.symbol} ***")
+            continue
+        trades_and_lows.append((trade, bars.bar(-2).low))
 
-                # Replace previous stop order with new price
-                try:
-                    if df.low.iloc[-2] < 1:
-                        trade.order.auxPrice = round(
-                            (df.low.iloc[-2] - 0.005), 3)
-                    else:
-                        trade.order.auxPrice = round(
-                            (df.low.iloc[-2] - 0.01), 2)
-                    ib.placeOrder(contract, trade.order)
-                except AttributeError:
-                    print(
-                        f"*** WARNING: Stop loss not updated for: {trade.contract.symbol} ***")
-                    continue
-                ib.sleep(0.5)
+    changes = stop_orders.stop_changes(trades_and_lows)
+    stop_orders.modify_stops(ib, changes, scheduler)
 
 
-def share_size(risk_per_share):
-    """ 
-    Function will determine the correct position sizing
-    based on risk amount, account size and risk per share
+def roll_stop_losses(ticker, bars):
+    """
+    Move the stop losses of a single ticker up to the low of the previous bar.
+    Called from the bar events so the confirmations are awaited in the background
     """
-    account_size = 1700
-    risk_percent = 0.01
-    shares = round((account_size * risk_percent) / risk_per_share)
-    return shares
 
+    trades_and_lows = [(trade, bars.bar(-2).low) for trade in order_book.by_type("STP", ticker)]
 
-def open_trades_ticker_set():
-    """ Returns a set of tickers with open trades """
+    changes = stop_orders.stop_changes(trades_and_lows)
+    if changes:
+        asyncio.ensure_future(stop_orders.modify_stops_async(ib, changes, scheduler))
 
-    ticker_set = set()
-    for trade in ib.openTrades():
-        ticker_set.add(trade.contract.symbol)
-    return ticker_set
 
+def on_entry_trigger(contract, high, low):
+    """
+    Callback for every real time bar or tick of a watchlist ticker.
+    Runs inside the event loop so it must never block, same as on_bar_update
+    """
+    ticker = contract.symbol
+    setup = watchlist.get(ticker, time.localtime(clock()).tm_hour)
+    if setup is None or setup.staged is not None or ticker in order_book:
+        return
 
-def commissions_paid():
-    """ Return the total cost of commissions in USD """
-    commissions = sum(fill.commissionReport.commission for fill in ib.fills())
-    return round(commissions)
+    bars = bar_store.get(ticker)
+    if bars is not None and len(bars) >= 2:
+        check_for_entry(setup, contract, bars, high, low)
 
 
-def scanner_parameters():
-    """
-    #* This function is not used in the actual trade execution.  
-    It is only to find what scanner parameters are available for use.
-    The code is here for reference only.
-    Run this function in a separate script to find a list of scanner parameters
-    Libraries you may need: webbrowser, xml.etree.ElementTree
-    Function will produce a huge list of over 1800 tags..   
-    Will need additional code to make it more readable.
-    """
-    # Create xml document with scanner parameters
-    xml = ib.reqScannerParameters()
+def update_entry_triggers():
+    """ Give the real time lines to the watchlist setups closest to their trigger high """
+    distances = []
+    for setup in watchlist.setups():
+        bars = bar_store.get(setup.symbol)
+        if bars is None or len(bars) < 1 or setup.staged is not None or setup.symbol in order_book:
+            continue
+        distances.append(((setup.trigger_high - bars.bar(-1).close) / setup.trigger_high, setup.symbol))
 
-    # View all scanner parameters in a web browser
-    path = "scanner_parameters.xml"
-    with open(path, "w") as f:
-        f.write(xml)
-    webbrowser.open(path)
+    distances.sort()
+    entry_triggers.retain(contracts.get_many([symbol for _, symbol in distances]))
 
-    # Parse XML document
-    tree = ET.fromstring(xml)
 
-    # Find all tags available for filtering
-    tags = [elem.text for elem in tree.findall(".//AbstractField/code")]
-    sorted_tags = sorted(tags)
-    tags_set = set(sorted_tags)
-    df = pd.DataFrame(data={"col1": tags_set})
-    df.to_csv("./file.csv", sep=',', index=False)
+def share_size(risk_per_share, price):
+    """ Position size for the hourly account, under the open risk cap and the buying power """
+    return risk_allocator.size(risk_per_share, price)
 
 
-def scan_codes():
-    """
-    #* This function is not used in the actual trade execution.  
-    Not used in the actual trade execution
-    Print this function in a separate script
-    to get all the different types of scan codes
-    such as "top percent gainers", etc.
-    """
-    # Create xml document with scanner parameters
-    xml = ib.reqScannerParameters()
+def open_trades_ticker_set():
+    """ Returns a set of tickers with open trades """
+    return order_book.symbols
 
-    # Parse XML document
-    tree = ET.fromstring(xml)
 
-    # Print all scan codes
-    scan_codes = [e.text for e in tree.findall(".//scanCode")]
-    print(len(scan_codes), "Scan Codes:")
-    print(scan_codes)
+def commissions_paid():
+    """ Return the total cost of commissions in USD """
+    commissions = sum(fill.commissionReport.commission for fill in ib.fills())
+    return round(commissions)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,301 @@
+"""
+Append-only trade journal in a local SQLite database.
+
+The only record of a session used to be the console and the
+commissions summed from ib.fills() at the exit, all of it lost on a
+disconnect.  The journal records a session as it happens:
+- signals   every watchlist setup: strategy, inside bar levels and hour
+- orders    every bracket order with its order ID, parent ID and strategy
+- fills     every execution with its commission, from the IB events
+- trades    every round trip, written when a symbol's position is flat
+            again: strategy, entry and exit time, shares, P&L after
+            commissions and how it exited (take profit LMT, STP or the
+            flatten's MKT)
+
+A fill takes the strategy of its bracket (its order or its parent).
+Fills of other orders, e.g. the flatten's market orders, take the
+strategy of the round trip they close.  Fills that neither belong to a
+bracket of the bot nor close one of its round trips are left out, and
+so is every fill of the symbols in exclude (the swing positions on the
+same account), so the report only covers the bot's own trades.
+
+Attach the journal before connecting: ib_insync requests the day's
+executions while it connects, and their commission reports come in
+before connect returns.
+
+Writes never block the event loop: the event handlers only put rows on
+a queue, and a writer thread commits them in batches, one transaction
+per batch (every flush_interval seconds or batch_size rows).  The
+database is in WAL mode so the queries can read while it writes.
+
+The queries (daily_pnl, commissions_by_strategy, win_rate) run on the
+day indexes, so they stay fast over months of history:
+
+    python cli.py journal --days 90
+
+Round trips still open when the bot stops are picked up again from the
+fills not yet assigned to a trade when the journal is next opened.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+import market_calendar
+
+JOURNAL_FILE = "journal.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signals (
+    id INTEGER PRIMARY KEY,
+    time REAL, day TEXT, symbol TEXT, strategy TEXT,
+    trigger_high REAL, invalidation_low REAL, hour INTEGER);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    time REAL, day TEXT, order_id INTEGER, parent_id INTEGER, symbol TEXT, strategy TEXT,
+    action TEXT, order_type TEXT, quantity REAL, limit_price REAL, aux_price REAL);
+CREATE TABLE IF NOT EXISTS fills (
+    exec_id TEXT PRIMARY KEY,
+    time REAL, day TEXT, order_id INTEGER, symbol TEXT, strategy TEXT, order_type TEXT,
+    side TEXT, shares REAL, price REAL, commission REAL, trade_id INTEGER);
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY,
+    day TEXT, symbol TEXT, strategy TEXT, opened REAL, closed REAL,
+    shares REAL, pnl REAL, commission REAL, exit TEXT);
+CREATE INDEX IF NOT EXISTS signals_day ON signals (day);
+CREATE INDEX IF NOT EXISTS orders_order_id ON orders (order_id);
+CREATE INDEX IF NOT EXISTS fills_day ON fills (day, strategy);
+CREATE INDEX IF NOT EXISTS fills_open ON fills (symbol) WHERE trade_id IS NULL;
+CREATE INDEX IF NOT EXISTS trades_day ON trades (day, strategy);
+"""
+
+# Order IDs from this far back are still matched to their strategy after a restart
+ORDER_MEMORY_DAYS = 2
+
+
+class Journal:
+    """ Queues journal rows from the bot and writes them in batches on a background thread """
+
+    def __init__(self, path=JOURNAL_FILE, flush_interval=1.0, batch_size=500, clock=time.time, exclude=()):
+        self.path = path
+        self.exclude = exclude  # Symbols never journaled. Kept by reference so later additions count
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.clock = clock
+
+        self._queue = queue.Queue()
+        self._strategies = {}   # order ID -> strategy
+        self._open = {}         # symbol -> round trip in progress
+        self._exec_ids = set()  # Executions already journaled. TWS sends them again after a reconnect
+        self._next_trade_id = 1
+
+        connection = self._connect()
+        try:
+            connection.executescript(SCHEMA)
+            self._load(connection)
+        finally:
+            connection.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="journal", daemon=True)
+        self._writer.start()
+
+    def attach(self, ib):
+        """ Journal every fill of ib as its commission report comes in """
+        ib.commissionReportEvent += self._on_commission_report
+        return self
+
+    # Recording. These only queue rows so they are safe to call from event handlers
+
+    def signal(self, symbol, strategy, trigger_high, invalidation_low, hour):
+        now = self.clock()
+        self._put(
+            "INSERT INTO signals (time, day, symbol, strategy, trigger_high, invalidation_low, hour) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (now, _day(now), symbol, strategy, trigger_high, invalidation_low, hour))
+
+    def bracket(self, contract, orders, strategy):
+        """ Record the orders of a bracket (common.bracket_order) once their IDs are set """
+        now = self.clock()
+        for order in orders:
+            self._strategies[order.orderId] = strategy
+            self._put(
+                "INSERT INTO orders (time, day, order_id, parent_id, symbol, strategy, action, order_type, "
+                "quantity, limit_price, aux_price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, _day(now), order.orderId, order.parentId, contract.symbol, strategy, order.action,
+                 order.orderType, order.totalQuantity, _price(order.lmtPrice), _price(order.auxPrice)))
+
+    def fill(self, trade, fill):
+        """ Record a fill and close its round trip once the symbol is flat again """
+        order, execution = trade.order, fill.execution
+        symbol = trade.contract.symbol
+        if execution.execId in self._exec_ids or symbol in self.exclude:
+            return
+
+        round_trip = self._open.get(symbol)
+        strategy = self._strategies.get(order.orderId) or self._strategies.get(order.parentId)
+        if round_trip is None and strategy is None:
+            # Not one of the bot's brackets, e.g. a manual trade
+            return
+
+        self._exec_ids.add(execution.execId)
+        now = self.clock()
+        shares = execution.shares if execution.side == "BOT" else -execution.shares
+        commission = fill.commissionReport.commission
+
+        if round_trip is None:
+            round_trip = self._open[symbol] = {
+                "strategy": strategy, "opened": now, "shares": 0.0, "cash": 0.0,
+                "commission": 0.0, "bought": 0.0}
+        strategy = round_trip["strategy"]
+
+        round_trip["shares"] += shares
+        round_trip["cash"] -= shares * execution.price
+        round_trip["commission"] += commission
+        round_trip["bought"] += max(shares, 0)
+
+        self._put(
+            "INSERT OR IGNORE INTO fills (exec_id, time, day, order_id, symbol, strategy, order_type, side, "
+            "shares, price, commission) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (execution.execId, now, _day(now), order.orderId, symbol, strategy, order.orderType,
+             execution.side, execution.shares, execution.price, commission))
+
+        if abs(round_trip["shares"]) < 1e-9:
+            self._close(symbol, round_trip, order.orderType, now)
+
+    # Writing
+
+    def flush(self):
+        """ Block until everything queued so far is written """
+        self._queue.join()
+
+    def close(self):
+        """ Write everything queued and stop the writer thread """
+        self._queue.put(None)
+        self._writer.join()
+
+    # Queries
+
+    def daily_pnl(self, start=None, end=None):
+        """ Returns [(day, P&L after commissions, commissions, round trips)] for the days with closed trades """
+        return self._query(
+            "SELECT day, ROUND(SUM(pnl), 2), ROUND(SUM(commission), 2), COUNT(*) FROM trades "
+            "WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day", start, end)
+
+    def commissions_by_strategy(self, start=None, end=None):
+        """ Returns [(strategy, commissions, fills)] """
+        return self._query(
+            "SELECT strategy, ROUND(SUM(commission), 2), COUNT(*) FROM fills "
+            "WHERE day BETWEEN ? AND ? GROUP BY strategy ORDER BY strategy", start, end)
+
+    def win_rate(self, start=None, end=None):
+        """ Returns [(strategy, round trips, win rate, average P&L)] """
+        return self._query(
+            "SELECT strategy, COUNT(*), ROUND(AVG(pnl > 0), 3), ROUND(AVG(pnl), 2) FROM trades "
+            "WHERE day BETWEEN ? AND ? GROUP BY strategy ORDER BY strategy", start, end)
+
+    def report(self, start=None, end=None):
+        print("Day         P&L        Commissions  Trades")
+        for day, pnl, commission, count in self.daily_pnl(start, end):
+            print(f"{day}  {pnl:>10.2f}  {commission:>11.2f}  {count:>6}")
+        print(f"{'Strategy':<21}  Commissions  Fills")
+        for strategy, commission, count in self.commissions_by_strategy(start, end):
+            print(f"{str(strategy):<21}  {commission:>11.2f}  {count:>5}")
+        print(f"{'Strategy':<21}  Trades  Win rate  Avg P&L")
+        for strategy, count, rate, average in self.win_rate(start, end):
+            print(f"{str(strategy):<21}  {count:>6}  {rate:>8.1%}  {average:>7.2f}")
+
+    def _query(self, sql, start, end):
+        connection = self._connect()
+        try:
+            return connection.execute(sql, (start or "0000-00-00", end or "9999-99-99")).fetchall()
+        finally:
+            connection.close()
+
+    def _close(self, symbol, round_trip, exit_order_type, now):
+        """ Write the round trip and assign its fills to it """
+        del self._open[symbol]
+        trade_id = self._next_trade_id
+        self._next_trade_id += 1
+        pnl = round(round_trip["cash"] - round_trip["commission"], 4)
+
+        self._put(
+            "INSERT INTO trades (id, day, symbol, strategy, opened, closed, shares, pnl, commission, exit) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (trade_id, _day(now), symbol, round_trip["strategy"], round_trip["opened"], now,
+             round_trip["bought"], pnl, round_trip["commission"], exit_order_type))
+        self._put("UPDATE fills SET trade_id = ? WHERE symbol = ? AND trade_id IS NULL", (trade_id, symbol))
+
+    def _load(self, connection):
+        """ Pick up the trade IDs, recent order strategies and the round trips left open last time """
+        self._next_trade_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM trades").fetchone()[0]
+
+        since = self.clock() - ORDER_MEMORY_DAYS * 86400
+        for order_id, strategy in connection.execute(
+                "SELECT order_id, strategy FROM orders WHERE time >= ?", (since,)):
+            self._strategies[order_id] = strategy
+        self._exec_ids.update(
+            exec_id for exec_id, in connection.execute("SELECT exec_id FROM fills WHERE time >= ?", (since,)))
+
+        rows = connection.execute(
+            "SELECT symbol, side, shares, price, commission, strategy, time FROM fills "
+            "WHERE trade_id IS NULL ORDER BY time")
+        for symbol, side, shares, price, commission, strategy, filled in rows:
+            shares = shares if side == "BOT" else -shares
+            round_trip = self._open.setdefault(symbol, {
+                "strategy": strategy, "opened": filled, "shares": 0.0, "cash": 0.0,
+                "commission": 0.0, "bought": 0.0})
+            round_trip["shares"] += shares
+            round_trip["cash"] -= shares * price
+            round_trip["commission"] += commission
+            round_trip["bought"] += max(shares, 0)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _put(self, sql, params):
+        self._queue.put((sql, params))
+
+    def _write_loop(self):
+        connection = self._connect()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            # Take whatever else is already queued, up to a batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = [row for row in batch if row is not None]
+            stopping = len(rows) < len(batch)
+            try:
+                with connection:
+                    for sql, params in rows:
+                        connection.execute(sql, params)
+            except sqlite3.Error as error:
+                print(f"*** WARNING: {len(rows)} journal rows not written: {error!r} ***")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        connection.close()
+
+    def _on_commission_report(self, trade, fill, report):
+        self.fill(trade, fill)
+
+
+def _day(local_timestamp):
+    """ Exchange date of a local timestamp """
+    return market_calendar.exchange_time(local_timestamp).date().isoformat()
+
+
+def _price(price):
+    """ None for the unset (max float) prices of an Order """
+    return price if price is not None and price < 1e300 else None
@@ -0,0 +1,94 @@
+"""
+Local US equity exchange calendar for the regular session close.
+
+The hourly bot flattens a few minutes before the close.  Most days close
+at 16:00 ET, but NYSE and NASDAQ close at 13:00 ET on:
+- the day before Independence Day, when July 4th falls Tuesday to Friday
+- the day after Thanksgiving
+- Christmas Eve, when it falls Monday to Thursday
+
+These follow from fixed rules, so no network lookup is needed.  Add any
+one-off early close the exchanges announce to EXTRA_EARLY_CLOSES.
+
+The bot's clock is epoch time (time.time()), converted to exchange time
+with the America/New_York zone.  The offset from the local time the bot
+runs on (Vietnam) follows daylight saving: 11 hours while New York is
+on EDT (March to November) and 12 hours on EST.
+* On Windows zoneinfo needs the tzdata package (pip install tzdata)
+"""
+
+import datetime
+import zoneinfo
+
+EXCHANGE_TZ = zoneinfo.ZoneInfo("America/New_York")
+
+REGULAR_OPEN = datetime.time(9, 30)
+REGULAR_CLOSE = datetime.time(16, 0)
+EARLY_CLOSE = datetime.time(13, 0)
+
+# date -> close time for early closes the rules don't cover
+EXTRA_EARLY_CLOSES = {}
+
+
+def thanksgiving(year):
+    """ Fourth Thursday of November """
+    first = datetime.date(year, 11, 1)
+    first_thursday = first + datetime.timedelta(days=(3 - first.weekday()) % 7)
+    return first_thursday + datetime.timedelta(weeks=3)
+
+
+def early_closes(year):
+    """ Returns a dict of date -> close time for the early closes of a year """
+    closes = {}
+
+    independence_day = datetime.date(year, 7, 4)
+    if 1 <= independence_day.weekday() <= 4:
+        closes[independence_day - datetime.timedelta(days=1)] = EARLY_CLOSE
+
+    closes[thanksgiving(year) + datetime.timedelta(days=1)] = EARLY_CLOSE
+
+    christmas_eve = datetime.date(year, 12, 24)
+    if christmas_eve.weekday() <= 3:
+        closes[christmas_eve] = EARLY_CLOSE
+
+    closes.update({day: close for day, close in EXTRA_EARLY_CLOSES.items() if day.year == year})
+    return closes
+
+
+def close_time(day):
+    """ Regular session close in exchange time for a date """
+    return early_closes(day.year).get(day, REGULAR_CLOSE)
+
+
+def exchange_time(local_timestamp):
+    """ Exchange time (naive ET datetime) for an epoch timestamp e.g. time.time() """
+    return datetime.datetime.fromtimestamp(local_timestamp, EXCHANGE_TZ).replace(tzinfo=None)
+
+
+def timestamp(exchange_datetime):
+    """ Epoch timestamp of a naive exchange time (ET) datetime, the reverse of exchange_time """
+    return exchange_datetime.replace(tzinfo=EXCHANGE_TZ).timestamp()
+
+
+def minutes_to_close(local_timestamp):
+    """ Minutes left in the regular session, negative once it has closed """
+    now = exchange_time(local_timestamp)
+    close = datetime.datetime.combine(now.date(), close_time(now.date()))
+    return (close - now).total_seconds() / 60
+
+
+def is_open(local_timestamp):
+    """ True during a weekday's regular session. Holidays aren't known here """
+    now = exchange_time(local_timestamp)
+    return now.weekday() < 5 and REGULAR_OPEN <= now.time() < close_time(now.date())
+
+
+def last_close(local_timestamp):
+    """ Local epoch timestamp of the most recent regular session close, weekends skipped """
+    now = exchange_time(local_timestamp)
+    day = now.date()
+    while True:
+        close = datetime.datetime.combine(day, close_time(day))
+        if day.weekday() < 5 and close <= now:
+            return timestamp(close)
+        day -= datetime.timedelta(days=1)
@@ -0,0 +1,147 @@
+"""
+Runs a set of IB market scans at the same time and merges the results.
+
+IB only returns 50 tickers per scan, so the hourly scanner is split into
+price bands that each get their own scan.  All the bands are requested
+concurrently, the results are deduplicated across bands (first band
+wins) and the merged list is cached on disk for the rest of the hour so
+a reconnect or restart doesn't scan again.
+
+Each run reports how long every band took and how many tickers it returned.
+
+Every band is its own scanner subscription, cancelled as soon as its
+first set of results comes in.  A band that times out or fails is
+cancelled too: TWS only allows 10 scanner subscriptions at a time, so
+one left open would eventually make every scan fail.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import metrics
+
+SCAN_CACHE_FILE = "scan_cache.json"
+
+# Scanner messages that aren't failures. 165 means no more matching results, 2100-2199 are notices
+SCANNER_WARNINGS = {165}
+
+
+class ScanCache:
+    """ On disk cache of the merged scan results, valid until the key (e.g. the hour) changes """
+
+    def __init__(self, path=SCAN_CACHE_FILE):
+        self.path = path
+
+    def load(self, key):
+        """ Returns the cached symbols for the key or None if there are none """
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("key") != key:
+            return None
+        return data["symbols"]
+
+    def save(self, key, symbols):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"key": key, "symbols": symbols}, file)
+        os.replace(temp_path, self.path)
+
+
+async def run_scans_async(ib, subscription, bands, scheduler=None, timeout=30):
+    """
+    Request every band at once.  bands is a list of (name, tag_values).
+    Returns a list of (name, symbols, seconds) in band order.  A band that
+    fails or times out is reported with symbols set to None.
+    """
+
+    async def scan(tag_values):
+        if scheduler is not None:
+            await scheduler.acquire_async("scanner")
+        start = time.perf_counter()
+        with metrics.inflight("scanner"):
+            scan_data = await scan_data_async(ib, subscription, tag_values, timeout)
+        symbols = [sd.contractDetails.contract.symbol for sd in scan_data]
+        return symbols, time.perf_counter() - start
+
+    results = await asyncio.gather(
+        *[scan(tag_values) for _, tag_values in bands], return_exceptions=True)
+
+    band_results = []
+    for (name, _), result in zip(bands, results):
+        if isinstance(result, BaseException):
+            print(f"*** WARNING: Scan failed for {name}: {result!r} ***")
+            band_results.append((name, None, 0.0))
+        else:
+            band_results.append((name, *result))
+    return band_results
+
+
+async def scan_data_async(ib, subscription, tag_values, timeout=30):
+    """
+    Returns the first set of results of a scanner subscription.  Same as
+    reqScannerDataAsync, except the subscription is also cancelled when
+    the scan times out or TWS reports an error for it
+    """
+    scan_data = ib.reqScannerSubscription(subscription, [], tag_values)
+    done = asyncio.get_event_loop().create_future()
+
+    def on_update(data):
+        if not done.done():
+            done.set_result(data)
+
+    def on_error(req_id, code, message, contract):
+        if req_id != scan_data.reqId or code in SCANNER_WARNINGS or 2100 <= code < 2200:
+            return
+        if not done.done():
+            done.set_exception(RuntimeError(f"Error {code}: {message}"))
+
+    scan_data.updateEvent += on_update
+    ib.errorEvent += on_error
+    try:
+        return await asyncio.wait_for(done, timeout)
+    finally:
+        scan_data.updateEvent -= on_update
+        ib.errorEvent -= on_error
+        ib.cancelScannerSubscription(scan_data)
+
+
+def scan(ib, subscription, bands, key, cache=None, scheduler=None, timeout=30):
+    """
+    Returns the deduplicated symbols from every band, in band order.
+    The result is served from the cache if it was already scanned for this key.
+    """
+    if cache is not None:
+        symbols = cache.load(key)
+        if symbols is not None:
+            print(f"{len(symbols)} tickers loaded from the scan cache")
+            return symbols
+
+    band_results = ib.run(run_scans_async(ib, subscription, bands, scheduler, timeout))
+
+    symbols = []
+    seen = set()
+    for name, band_symbols, seconds in band_results:
+        if band_symbols is None:
+            continue
+        new_symbols = [symbol for symbol in dict.fromkeys(band_symbols) if symbol not in seen]
+        seen.update(new_symbols)
+        symbols.extend(new_symbols)
+        print(
+            f"{name}: {len(band_symbols)} tickers ({len(new_symbols)} new) in {seconds:.2f}s")
+    print(f"{len(symbols)} unique tickers found")
+
+    # Don't cache a partial scan so the missing bands are retried
+    failed = any(band_symbols is None for _, band_symbols, _ in band_results)
+    if cache is not None and not failed:
+        cache.save(key, symbols)
+
+    return symbols
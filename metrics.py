@@ -0,0 +1,214 @@
+"""
+Timing spans, counters and in-flight request gauges for the bots.
+
+Metrics are off unless the BOT_METRICS environment variable is set to a
+directory when the bot starts.  While off, metrics.timed returns the
+function unchanged and metrics.span / metrics.inflight return a shared
+do-nothing context manager, so the instrumented code runs as before.
+
+When on:
+- metrics.timed / metrics.span record how long each stage takes in a
+    histogram per stage and per hour of the day
+- metrics.count adds to a named counter
+- metrics.inflight tracks how many IB requests of each kind are waiting
+    for a reply, and the peak for every hour
+- metrics.export() writes everything to <dir>/metrics.prom in the
+    Prometheus text format (point a node_exporter textfile collector at it)
+    and appends every span recorded since the last export to <dir>/spans.jsonl
+
+Usage:
+    @metrics.timed("scanner")
+    def scanner(...): ...
+
+    with metrics.span("check_strategy"):
+        ...
+"""
+
+import contextlib
+import functools
+import inspect
+import json
+import os
+import time
+from collections import defaultdict
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+PROMETHEUS_FILE = "metrics.prom"
+SPANS_FILE = "spans.jsonl"
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.total += seconds
+        self.count += 1
+
+
+class Metrics:
+    """ Everything recorded since the bot started """
+
+    def __init__(self, directory, clock=time.time):
+        self.directory = directory
+        self.clock = clock
+        self.histograms = defaultdict(Histogram)  # (span, hour) -> Histogram
+        self.counters = defaultdict(float)        # name -> total
+        self.inflight = defaultdict(int)          # request kind -> requests waiting for a reply
+        self.inflight_peak = defaultdict(int)     # (request kind, hour) -> peak in flight
+        self._spans = []                          # spans not yet written to the JSON lines file
+
+    def hour(self):
+        return time.localtime(self.clock()).tm_hour
+
+    def observe(self, name, seconds):
+        hour = self.hour()
+        self.histograms[(name, hour)].observe(seconds)
+        self._spans.append({"time": round(self.clock(), 3), "hour": hour, "span": name, "seconds": seconds})
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def track_inflight(self, kind):
+        self.inflight[kind] += 1
+        key = (kind, self.hour())
+        self.inflight_peak[key] = max(self.inflight_peak[key], self.inflight[kind])
+        try:
+            yield
+        finally:
+            self.inflight[kind] -= 1
+
+    def prometheus(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        lines = [
+            "# HELP bot_span_seconds Time spent in each instrumented stage by hour of day",
+            "# TYPE bot_span_seconds histogram"]
+        for (name, hour), histogram in sorted(self.histograms.items()):
+            labels = f'span="{name}",hour="{hour}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'bot_span_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"bot_span_seconds_sum{{{labels}}} {histogram.total}")
+            lines.append(f"bot_span_seconds_count{{{labels}}} {histogram.count}")
+
+        lines += ["# HELP bot_events_total Counted events", "# TYPE bot_events_total counter"]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'bot_events_total{{event="{name}"}} {value:g}')
+
+        lines += [
+            "# HELP bot_inflight_requests IB requests waiting for a reply",
+            "# TYPE bot_inflight_requests gauge"]
+        for kind, value in sorted(self.inflight.items()):
+            lines.append(f'bot_inflight_requests{{request="{kind}"}} {value}')
+
+        lines += [
+            "# HELP bot_inflight_requests_peak Most IB requests waiting for a reply at once by hour of day",
+            "# TYPE bot_inflight_requests_peak gauge"]
+        for (kind, hour), value in sorted(self.inflight_peak.items()):
+            lines.append(f'bot_inflight_requests_peak{{request="{kind}",hour="{hour}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """ Rewrite the Prometheus file and append the new spans to the JSON lines file """
+        os.makedirs(self.directory, exist_ok=True)
+
+        path = os.path.join(self.directory, PROMETHEUS_FILE)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.prometheus())
+        os.replace(temp_path, path)
+
+        if self._spans:
+            with open(os.path.join(self.directory, SPANS_FILE), "a") as file:
+                file.writelines(json.dumps(span) + "\n" for span in self._spans)
+            self._spans.clear()
+
+
+# The active Metrics or None when metrics are off
+_metrics = Metrics(os.environ["BOT_METRICS"]) if os.environ.get("BOT_METRICS") else None
+
+
+def enabled():
+    return _metrics is not None
+
+
+def enable(directory, clock=time.time):
+    """ Turn metrics on. Functions already decorated with timed while off stay untimed """
+    global _metrics
+    _metrics = Metrics(directory, clock)
+    return _metrics
+
+
+def set_clock(clock):
+    """ Use a different clock for the hour of day labels e.g. the simulator's virtual clock """
+    if _metrics is not None:
+        _metrics.clock = clock
+
+
+def timed(name=None):
+    """ Decorator recording a span for every call. Returns the function untouched while metrics are off """
+
+    def decorate(func):
+        if _metrics is None:
+            return func
+        span_name = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _metrics.span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _metrics.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def span(name):
+    """ Context manager recording how long the block takes """
+    if _metrics is None:
+        return _NULL_SPAN
+    return _metrics.span(name)
+
+
+def inflight(kind):
+    """ Context manager counting an IB request of a kind as in flight until the block exits """
+    if _metrics is None:
+        return _NULL_SPAN
+    return _metrics.track_inflight(kind)
+
+
+def count(name, value=1):
+    if _metrics is not None:
+        _metrics.counters[name] += value
+
+
+def export():
+    if _metrics is not None:
+        _metrics.export()
@@ -0,0 +1,152 @@
+"""
+Incrementally maintained index of the open orders, keyed by symbol.
+
+The hourly bot used to rebuild its picture of the open orders with a
+scan of ib.openTrades() / ib.openOrders() on every pass: the set of
+tickers with open trades, the unfilled buys to cancel every hour, the
+stops to roll on every new bar and the non-GTC orders to cancel at the
+close.  Instead every open trade is indexed once, by:
+- symbol
+- order type, and symbol + order type (e.g. the STP children of a ticker)
+- action (BUY / SELL)
+- GTC or not
+- order id and parent order id, linking a bracket's parent and children
+
+The index is kept up to date from the order events (new, modified,
+open order, order status, exec details and cancel), so a lookup only
+touches the trades it returns.  A trade is open until its status is one
+of OrderStatus.DoneStates, the same rule as ib.openTrades().
+
+TWS reports the orders that were already open when the connection is
+made without any events, so call sync() once after connecting (or after
+anything else that replaces the orders behind the events' back).
+"""
+
+from collections import defaultdict
+
+from ib_insync import OrderStatus
+
+EVENTS = (
+    "newOrderEvent",
+    "orderModifyEvent",
+    "openOrderEvent",
+    "orderStatusEvent",
+    "execDetailsEvent",
+    "cancelOrderEvent")
+
+INDEXES = ("symbol", "type", "symbol_type", "action", "gtc", "order_id", "parent")
+
+
+class OrderBook:
+    """ Open trades indexed by symbol, order type, action, tif and bracket parent """
+
+    def __init__(self, ib):
+        self.ib = ib
+
+        # Trades aren't hashable so everything is keyed by id(trade)
+        self._trades = {}       # id -> trade
+        self._keys = {}         # id -> (index, key) pairs the trade is filed under
+        self._index = {index: defaultdict(dict) for index in INDEXES}  # index -> key -> {id: trade}
+
+        for event in EVENTS:
+            getattr(ib, event).connect(self._on_trade)
+        self.sync()
+
+    def __len__(self):
+        return len(self._trades)
+
+    def __contains__(self, symbol):
+        """ True if the symbol has an open trade """
+        return symbol in self._index["symbol"]
+
+    @property
+    def symbols(self):
+        """ Set of symbols with open trades """
+        return set(self._index["symbol"])
+
+    def sync(self):
+        """ Rebuild the index from ib.openTrades() """
+        self._trades.clear()
+        self._keys.clear()
+        for trades in self._index.values():
+            trades.clear()
+        for trade in self.ib.openTrades():
+            self.update(trade)
+
+    def update(self, trade):
+        """ File an open trade under its current keys, or drop it once it's done """
+        trade_id = id(trade)
+        self._remove(trade_id)
+        if trade.orderStatus.status in OrderStatus.DoneStates:
+            return
+
+        order = trade.order
+        symbol = trade.contract.symbol
+        keys = (
+            ("symbol", symbol),
+            ("type", order.orderType),
+            ("symbol_type", (symbol, order.orderType)),
+            ("action", order.action),
+            ("gtc", order.tif == "GTC"),
+            ("order_id", order.orderId),
+            ("parent", order.parentId))
+
+        self._trades[trade_id] = trade
+        self._keys[trade_id] = keys
+        for index, key in keys:
+            self._index[index][key][trade_id] = trade
+
+    # Lookups. Each returns a new list so orders can be cancelled or modified while looping over it
+
+    def trades(self):
+        return list(self._trades.values())
+
+    def by_symbol(self, symbol):
+        return self._lookup("symbol", symbol)
+
+    def by_type(self, order_type, symbol=None):
+        """ Open trades of an order type e.g. "STP", optionally for one symbol only """
+        if symbol is None:
+            return self._lookup("type", order_type)
+        return self._lookup("symbol_type", (symbol, order_type))
+
+    def by_action(self, action, exclude=()):
+        """ Open "BUY" or "SELL" trades, leaving out the symbols in exclude """
+        return [trade for trade in self._lookup("action", action) if trade.contract.symbol not in exclude]
+
+    def non_gtc(self):
+        """ Open trades that don't carry over to the next session """
+        return self._lookup("gtc", False)
+
+    def children(self, trade):
+        """ Open take profit / stop loss children of a bracket's parent trade """
+        if not trade.order.orderId:
+            return []
+        return self._lookup("parent", trade.order.orderId)
+
+    def parent(self, trade):
+        """ The open parent of a bracket child, or None """
+        parent_id = trade.order.parentId
+        if not parent_id:
+            return None
+        for parent in self._lookup("order_id", parent_id):
+            if parent.order.clientId == trade.order.clientId:
+                return parent
+        return None
+
+    def _lookup(self, index, key):
+        trades = self._index[index].get(key)
+        return list(trades.values()) if trades else []
+
+    def _remove(self, trade_id):
+        if self._trades.pop(trade_id, None) is None:
+            return
+        for index, key in self._keys.pop(trade_id):
+            trades = self._index[index][key]
+            del trades[trade_id]
+            # Drop empty buckets so symbols and membership checks only see open trades
+            if not trades:
+                del self._index[index][key]
+
+    def _on_trade(self, trade, *args):
+        self.update(trade)
@@ -0,0 +1,242 @@
+"""
+Pacing aware scheduler for requests sent to TWS.
+
+IB disconnects clients that send more than 50 messages a second and
+throttles historical data and scanner requests that come in too fast.
+Rather than sleeping a fixed amount after every request, each request
+class gets its own token bucket and all requests share one bucket for
+the overall message rate.  A request only waits when its bucket is empty.
+
+Historical data requests are paced by bar size.  IB's historical data
+pacing limits (60 requests per 10 minutes) only apply to bars of 30
+seconds or less, so those get their own slow class.  Requests for
+larger bars, like the hourly bot's 1 hour streams, are only held to the
+overall message rate; historical_class() picks the class for a bar size.
+
+Requests waiting on the shared message rate are released by priority,
+so stop loss modifications and flatten orders always go ahead of the
+scanner and watchlist history requests.
+
+Usage:
+- scheduler.submit("order", ib.placeOrder, contract, order)
+    Non-blocking.  Runs the call as soon as it is allowed.  Safe to use
+    from inside event callbacks
+- scheduler.call("historical", ib.reqHistoricalData, ...)
+    Blocks until the call is allowed, then runs it and returns the result.
+    Must not be used from inside event callbacks
+- await scheduler.acquire_async("historical")
+    Waits for permission inside a coroutine.  A call that sends several
+    requests at once (e.g. qualifyContracts) acquires one per request
+    with count
+- scheduler.drain()
+    Blocks until every queued request has been sent, e.g. before disconnecting
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from ib_insync import util
+
+# Request class: (priority, requests per second, burst size). Lower priority goes first
+REQUEST_CLASSES = {
+    "order": (0, 40, 40),        # Stop loss modifications, cancels and flatten orders
+    "contract": (1, 20, 50),     # Contract qualification
+    "historical": (2, 40, 50),   # Historical bars of 1 minute and up
+    "historical_small": (2, 0.1, 6),  # Bars of 30 seconds or less: 60 requests per 10 minutes
+    "market_data": (2, 10, 20),  # Real time bar and tick-by-tick subscriptions
+    "scanner": (3, 1, 10),       # IB only allows 10 scanner subscriptions at a time
+}
+
+# Shared by every request class. IB's hard limit is 50 messages per second
+MESSAGE_RATE = 45
+
+
+def historical_class(bar_size):
+    """ Request class for historical bars of bar_size, e.g. "1 hour" or "5 secs" """
+    count, unit = bar_size.split()
+    if unit.startswith("sec") and int(count) <= 30:
+        return "historical_small"
+    return "historical"
+
+
+class TokenBucket:
+    """ Refills at rate tokens per second up to capacity """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """ Seconds until the next token is available """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class _Job:
+    __slots__ = ("request_class", "func", "args", "kwargs", "future", "submitted")
+
+    def __init__(self, request_class, func, args, kwargs, future):
+        self.request_class = request_class
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.submitted = time.monotonic()
+
+
+class RequestScheduler:
+    """ Token bucket pacing per request class with priority ordering """
+
+    def __init__(self, ib, request_classes=REQUEST_CLASSES, message_rate=MESSAGE_RATE):
+        self.ib = ib
+        self.priorities = {name: priority for name, (priority, _, _) in request_classes.items()}
+        self.buckets = {
+            name: TokenBucket(rate, burst) for name, (_, rate, burst) in request_classes.items()}
+        self.messages = TokenBucket(message_rate, message_rate)
+
+        self._queue = []  # heap of (priority, sequence, job)
+        self._sequence = itertools.count()
+        self._timer = None
+
+        # Metrics per request class
+        self.stats = {
+            name: {"requests": 0, "queued": 0, "max_queued": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for name in request_classes}
+
+    def submit(self, request_class, func=None, *args, **kwargs):
+        """
+        Queue a request and return a future for its result.
+        func is called from the scheduler as soon as pacing allows, so it must not block.
+        Without a func the future is simply resolved once the request is allowed to go.
+        """
+        future = util.getLoop().create_future()
+        if func is not None:
+            future.add_done_callback(_log_exception)
+
+        job = _Job(request_class, func, args, kwargs, future)
+        heapq.heappush(self._queue, (self.priorities[request_class], next(self._sequence), job))
+
+        stats = self.stats[request_class]
+        stats["queued"] += 1
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+
+        self._dispatch()
+        return future
+
+    def acquire(self, request_class, count=1):
+        """ Block until count requests of this class are allowed to go """
+        futures = [self.submit(request_class) for _ in range(count)]
+        pending = [future for future in futures if not future.done()]
+        if pending:
+            util.run(asyncio.gather(*pending))
+
+    async def acquire_async(self, request_class, count=1):
+        """ Wait inside a coroutine until count requests of this class are allowed to go """
+        await asyncio.gather(*[self.submit(request_class) for _ in range(count)])
+
+    def burst(self, request_class):
+        """ Most requests of a class that can go at once """
+        return int(self.buckets[request_class].capacity)
+
+    def call(self, request_class, func, *args, **kwargs):
+        """ Block until pacing allows, then run the (possibly blocking) request and return its result """
+        self.acquire(request_class)
+        return func(*args, **kwargs)
+
+    def drain(self):
+        """ Block until every queued request has been sent """
+        while self._queue:
+            util.sleep(self.messages.wait_time() or 0.02)
+
+    def queue_depth(self):
+        """ Returns the number of waiting requests per class """
+        return {name: stats["queued"] for name, stats in self.stats.items()}
+
+    def metrics(self):
+        """ Returns request counts, queue depth and wait times per class """
+        metrics = {}
+        for name, stats in self.stats.items():
+            requests = stats["requests"]
+            metrics[name] = {
+                "requests": requests,
+                "queued": stats["queued"],
+                "max_queued": stats["max_queued"],
+                "avg_wait": stats["total_wait"] / requests if requests else 0.0,
+                "max_wait": stats["max_wait"]}
+        return metrics
+
+    def report(self):
+        """ Print the scheduler metrics """
+        for name, metric in self.metrics().items():
+            print(
+                f"{name}: {metric['requests']} requests, {metric['queued']} queued "
+                f"(max {metric['max_queued']}), wait avg {metric['avg_wait']:.3f}s "
+                f"max {metric['max_wait']:.3f}s")
+
+    def _dispatch(self):
+        """ Release every queued request the buckets allow, highest priority first """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        self.messages.refill(now)
+        for bucket in self.buckets.values():
+            bucket.refill(now)
+
+        held = []
+        while self._queue and self.messages.tokens >= 1:
+            item = heapq.heappop(self._queue)
+            job = item[-1]
+            bucket = self.buckets[job.request_class]
+
+            # Out of tokens for this class. Later jobs of other classes may still go
+            if bucket.tokens < 1:
+                held.append(item)
+                continue
+
+            bucket.tokens -= 1
+            self.messages.tokens -= 1
+            self._release(job, now)
+
+        for item in held:
+            heapq.heappush(self._queue, item)
+
+        # Come back when the next token is available
+        if self._queue:
+            waits = [self.buckets[item[-1].request_class].wait_time() for item in self._queue]
+            wait = max(min(waits), self.messages.wait_time())
+            self._timer = util.getLoop().call_later(wait, self._dispatch)
+
+    def _release(self, job, now):
+        stats = self.stats[job.request_class]
+        wait = now - job.submitted
+        stats["queued"] -= 1
+        stats["requests"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+        if job.future.done():
+            return
+
+        if job.func is None:
+            job.future.set_result(None)
+            return
+
+        try:
+            job.future.set_result(job.func(*job.args, **job.kwargs))
+        except Exception as error:
+            job.future.set_exception(error)
+
+
+def _log_exception(future):
+    """ Fire and forget requests have nobody waiting on them, so report their errors here """
+    if not future.cancelled() and future.exception() is not None:
+        print(f"*** WARNING: Request failed: {future.exception()!r} ***")
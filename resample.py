@@ -0,0 +1,102 @@
+"""
+Local resampling of bars into higher timeframes.
+
+Daily and weekly scans used to need their own requests ("5 D" / "1 day"
+and "5 W" / "1 week"), and so did any 2 or 4 hour view of the hourly
+bars.  Instead one fetch of the lower timeframe is resampled here:
+- weekly(daily)             weekly bars from daily bars
+- multi_hour(hourly, hours) 2, 4, ... hour bars from 1 hour bars, screened
+                            by the hourly bot along with the 1 hour bars
+                            (MULTI_HOUR_TIMEFRAMES in hourly_strat.py)
+
+Bars are grouped along the exchange sessions, not the clock:
+- a week is every session from Monday to Friday, dated by its first
+    session, so a short holiday week is still one bar
+- multi-hour bars start again at every session open.  With RTH bars
+    the 4 hour bars of a session are 09:30-13:00 and 13:00-16:00 (the
+    first hourly bar only covers 09:30-10:00)
+
+Sessions are found from the gap between bar start times rather than
+from the dates, so bars timestamped in the TWS time zone (Vietnam,
+where a session runs over midnight) are grouped the same as bars in
+exchange time.
+
+Each resampled bar takes the open of its first bar, the close of its
+last, the highest high, lowest low and total volume.  The last bar is
+still in progress when its last input bar is, the same as a bar
+requested at that size.
+
+Bars are BAR_DTYPE structured arrays (bar_cache.py).  Lists of BarData
+are converted first.
+"""
+
+import numpy as np
+
+from bar_cache import BAR_DTYPE, to_array
+
+# Bar start gap that begins a new session. Longer than any gap inside a session, shorter than overnight
+SESSION_GAP = np.timedelta64(4, "h")
+
+# Timeframes the swing scan can run, built from daily bars
+DAILY_TIMEFRAMES = ("daily", "weekly")
+
+
+def as_array(bars):
+    """ BAR_DTYPE array for a structured array or list of BarData """
+    if getattr(bars, "dtype", None) is not None and bars.dtype.names:
+        return bars
+    return to_array(bars)
+
+
+def aggregate(bars, keys):
+    """ One bar per run of equal keys. keys is an array with one group key per bar, in bar order """
+    if not len(bars):
+        return np.empty(0, dtype=BAR_DTYPE)
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(bars)] - 1
+
+    resampled = np.empty(len(starts), dtype=BAR_DTYPE)
+    resampled["date"] = bars["date"][starts]
+    resampled["open"] = bars["open"][starts]
+    resampled["high"] = np.maximum.reduceat(bars["high"], starts)
+    resampled["low"] = np.minimum.reduceat(bars["low"], starts)
+    resampled["close"] = bars["close"][ends]
+    resampled["volume"] = np.add.reduceat(bars["volume"], starts)
+    return resampled
+
+
+def weekly(daily):
+    """ Weekly bars from daily bars, Monday to Friday """
+    daily = as_array(daily)
+    days = daily["date"].astype("datetime64[D]")
+
+    # Day 0 of datetime64 (1970-01-01) is a Thursday, so this is 0 on Mondays
+    weekday = (days.astype(np.int64) + 3) % 7
+    return aggregate(daily, days - weekday)
+
+
+def multi_hour(hourly, hours):
+    """ Bars of hours hours from 1 hour bars, starting again at every session open """
+    hourly = as_array(hourly)
+    if hours == 1 or not len(hourly):
+        return hourly
+
+    dates = hourly["date"]
+    new_session = np.r_[True, np.diff(dates) > SESSION_GAP]
+    session = np.cumsum(new_session)
+
+    # Position of each bar within its session
+    position = np.arange(len(hourly))
+    session_start = np.flatnonzero(new_session)
+    position -= session_start[session - 1]
+
+    # Sessions never have anywhere near 1000 bars, so this keeps the groups apart
+    return aggregate(hourly, session * 1000 + position // hours)
+
+
+def timeframes(daily, names=DAILY_TIMEFRAMES):
+    """ Returns a dict of name -> bars for each of names ("daily", "weekly") from one set of daily bars """
+    daily = as_array(daily)
+    builders = {"daily": lambda bars: bars, "weekly": weekly}
+    return {name: builders[name](daily) for name in names}
@@ -0,0 +1,119 @@
+"""
+Scanner process for the hourly bot's multi-process mode.
+
+In the default mode the hourly bot scans, loads the bars of every
+scanned ticker and checks the setups in the same loop that rolls the
+stops and places the entries, so a slow scan at the top of the hour
+holds everything else up.  In multi-process mode the scan runs in a
+worker process with its own IB connection on the next client ID, and
+the main process (the execution side) only handles the orders,
+positions and the watchlist's bar streams.
+
+The two sides talk through a pair of queues:
+- requests  (hour, clock time) sent by the execution side at the top of
+            every hour, None to stop the worker
+- results   (hour, setups, error, contracts) sent back once the scan is
+            done, where setups is a list of (ticker, strategy, trigger
+            high, invalidation low) tuples, ready for Watchlist.add, and
+            contracts the worker's qualified contracts of those tickers,
+            so the execution side doesn't qualify them again
+
+The execution side never waits on the worker: it polls for results on
+every pass of its loop and drops results for an hour that has already
+gone.  If the worker dies the bot goes back to scanning in-process.
+
+The worker imports hourly_strat itself and runs its scanner() and
+screen(), with its own scheduler, contract cache and bar streams.  Its
+bar streams are cancelled after every scan, the execution side streams
+the tickers that made the watchlist.
+"""
+
+import multiprocessing
+import queue
+
+# The scanner connects on the execution client ID plus this
+SCANNER_CLIENT_OFFSET = 1
+
+# Seconds to wait for the worker to finish its scan and disconnect when stopping
+STOP_TIMEOUT = 30
+
+
+def run(port, client_id, requests, results):
+    """ Worker process entry point. Scans for every hour requested until it gets None """
+    import os
+    import time
+
+    # Keep the worker's metrics apart from the execution side's
+    if os.environ.get("BOT_METRICS"):
+        os.environ["BOT_METRICS"] = os.path.join(os.environ["BOT_METRICS"], "scanner")
+
+    import connection
+    import hourly_strat as bot
+
+    connection.connect(bot.ib, port, client_id)
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        hour, timestamp = request
+
+        # The simulator's clock only moves on sleep. Catch it up to the execution side's
+        if hasattr(bot.ib, "clock"):
+            bot.ib.sleep(max(0, timestamp - bot.ib.clock()))
+
+        try:
+            scan_results = bot.scanner(time.localtime(timestamp))
+            setups = bot.screen(scan_results, hour)
+            qualified = bot.contracts.get_many(list({ticker for ticker, *levels in setups}))
+            results.put((hour, setups, None, qualified))
+        except Exception as error:
+            results.put((hour, [], repr(error), []))
+        finally:
+            bot.bar_streams.cancel_all()
+            bot.metrics.export()
+
+    bot.ib.disconnect()
+
+
+class ScanWorker:
+    """ Scanner process on its own client ID, driven through a request and a result queue """
+
+    def __init__(self, port, client_id):
+        # Spawned rather than forked so the worker starts with a clean event loop, the same as on Windows
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.client_id = client_id + SCANNER_CLIENT_OFFSET
+        self.process = context.Process(
+            target=run, args=(port, self.client_id, self.requests, self.results),
+            name="scanner", daemon=True)
+
+    def start(self):
+        self.process.start()
+        print(f"Scanner worker started on client ID {self.client_id}")
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def request(self, hour, timestamp):
+        """ Ask for the setups of an hour. Returns straight away """
+        self.requests.put((hour, timestamp))
+
+    def poll(self):
+        """ Returns the next (hour, setups, error, contracts) result or None if there isn't one yet """
+        try:
+            return self.results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """ Let the worker finish and disconnect, killing it if it takes longer than timeout seconds """
+        if not self.process.is_alive():
+            return
+        self.requests.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -0,0 +1,238 @@
+"""
+Indexed catalog of the scanner parameters TWS offers.
+
+reqScannerParameters returns a huge XML document (over 1800 filter
+tags).  It used to be fetched and parsed again every time a tag list or
+the scan codes were needed.  Instead it is fetched once, parsed with a
+streaming parser and kept on disk as a small versioned JSON index of:
+- filters       tag names for TagValue e.g. "priceAbove"
+- scan_codes    e.g. "TOP_PERC_GAIN"
+- instruments   e.g. "STK"
+- locations     e.g. "STK.NASDAQ"
+
+The index supports exact lookups, prefix and substring searches, and
+checking a scanner subscription and its TagValues offline, with no
+round trip to TWS.  It is refetched once it is older than max_age or was
+written by an older version of this module.
+
+Run it with:
+    python cli.py scanner-params                  all filter tags, written to file.csv
+    python cli.py scanner-params --codes          all scan codes such as "TOP_PERC_GAIN"
+    python cli.py scanner-params --search volume  filter tags containing "volume"
+    python cli.py scanner-params --refresh        fetch the parameters from TWS again
+
+The XML parser and webbrowser are only imported when they are needed, so
+the bots can check their scans against the index without loading them.
+"""
+
+import bisect
+import json
+import os
+import time
+
+XML_FILE = "scanner_parameters.xml"
+TAGS_FILE = "file.csv"
+CATALOG_FILE = "scanner_catalog.json"
+
+# Bump whenever the index layout or the parsing changes so old indexes are rebuilt
+CATALOG_VERSION = 1
+
+# (parent element, element) -> index the element's text belongs to
+CATALOG_FIELDS = {
+    ("AbstractField", "code"): "filters",
+    ("ScanType", "scanCode"): "scan_codes",
+    ("Instrument", "type"): "instruments",
+    ("Location", "locationCode"): "locations"}
+
+KINDS = ("filters", "scan_codes", "instruments", "locations")
+
+# Size of the chunks fed to the streaming parser
+CHUNK_SIZE = 1 << 16
+
+
+def parse_catalog(xml):
+    """
+    Returns a dict of kind -> set of codes from a reqScannerParameters XML document.
+    Elements are dropped as soon as they are read so the full tree is never built.
+    """
+    from xml.etree.ElementTree import XMLPullParser
+
+    index = {kind: set() for kind in KINDS}
+    parser = XMLPullParser(events=("start", "end"))
+    parents = []
+
+    def read_events():
+        for event, element in parser.read_events():
+            if event == "start":
+                parents.append(element.tag)
+                continue
+            parents.pop()
+            kind = CATALOG_FIELDS.get((parents[-1] if parents else None, element.tag))
+            if kind is not None and element.text and element.text.strip():
+                index[kind].add(element.text.strip())
+            element.clear()
+
+    for start in range(0, len(xml), CHUNK_SIZE):
+        parser.feed(xml[start:start + CHUNK_SIZE])
+        read_events()
+    parser.close()
+    read_events()
+    return index
+
+
+class ScannerCatalog:
+    """ On disk index of the scanner filters, scan codes, instruments and locations """
+
+    def __init__(self, path=CATALOG_FILE, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self.fetched = None
+
+        # kind -> set of codes for lookups, and kind -> sorted (lower case code, code) for searches
+        self._codes = {kind: set() for kind in KINDS}
+        self._folded = {kind: [] for kind in KINDS}
+        self.load()
+
+    def __contains__(self, code):
+        return any(code in codes for codes in self._codes.values())
+
+    def __len__(self):
+        return sum(len(codes) for codes in self._codes.values())
+
+    @property
+    def available(self):
+        """ False until an index has been loaded or fetched """
+        return self.fetched is not None
+
+    def is_stale(self):
+        return self.fetched is None or time.time() - self.fetched > self.max_age
+
+    def codes(self, kind="filters"):
+        """ Sorted list of every code of a kind """
+        return [code for _, code in self._folded[kind]]
+
+    def has(self, code, kind="filters"):
+        return code in self._codes[kind]
+
+    def search(self, text, kind="filters", prefix=False):
+        """ Codes of a kind that start with (prefix=True) or contain text, ignoring case """
+        text = text.lower()
+        folded = self._folded[kind]
+        if not prefix:
+            return [code for key, code in folded if text in key]
+
+        matches = []
+        for index in range(bisect.bisect_left(folded, (text,)), len(folded)):
+            key, code = folded[index]
+            if not key.startswith(text):
+                break
+            matches.append(code)
+        return matches
+
+    def problems(self, subscription=None, tag_values=()):
+        """
+        Returns a list of the scan code, instrument, location and TagValue names
+        that aren't in the catalog.  Always empty while no index is available.
+        """
+        if not self.available:
+            return []
+
+        problems = []
+        if subscription is not None:
+            for kind, code in (
+                    ("scan_codes", subscription.scanCode),
+                    ("instruments", subscription.instrument),
+                    ("locations", subscription.locationCode)):
+                if code and not self.has(code, kind):
+                    problems.append(f"unknown {kind[:-1].replace('_', ' ')} {code!r}")
+        for tag_value in tag_values:
+            if not self.has(tag_value.tag):
+                problems.append(f"unknown filter {tag_value.tag!r}")
+        return problems
+
+    def check(self, subscription=None, tag_values=()):
+        """ Print a warning for every problem in a scan. Returns True when there are none """
+        problems = self.problems(subscription, tag_values)
+        for problem in problems:
+            print(f"*** WARNING: Scanner {problem} ***")
+        return not problems
+
+    def refresh(self, ib):
+        """ Fetch the scanner parameters from TWS once and rebuild the index """
+        xml = ib.reqScannerParameters()
+
+        # Keep the raw document around for viewing in a web browser
+        with open(XML_FILE, "w") as f:
+            f.write(xml)
+
+        self._set_index(parse_catalog(xml), time.time())
+        self.save()
+        return self
+
+    def ensure(self, ib):
+        """ Refresh from TWS only when the index is missing or stale """
+        if self.is_stale():
+            if ib is None:
+                raise RuntimeError("No up to date scanner catalog. Connect to TWS to fetch one")
+            self.refresh(ib)
+        return self
+
+    def load(self):
+        """ Load the index written by save. Indexes from another CATALOG_VERSION are ignored """
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") != CATALOG_VERSION:
+            return
+        self._set_index({kind: data.get(kind, []) for kind in KINDS}, data["fetched"])
+
+    def save(self):
+        data = {"version": CATALOG_VERSION, "fetched": self.fetched}
+        data.update({kind: self.codes(kind) for kind in KINDS})
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(temp_path, self.path)
+
+    def _set_index(self, index, fetched):
+        self.fetched = fetched
+        for kind in KINDS:
+            self._codes[kind] = set(index[kind])
+            self._folded[kind] = sorted((code.lower(), code) for code in self._codes[kind])
+
+
+def scanner_parameters(ib=None, open_browser=True, catalog=None):
+    """
+    Writes every tag available for filtering to TAGS_FILE.
+    Function will produce a huge list of over 1800 tags..
+    Use ScannerCatalog.search to narrow it down.
+    """
+    catalog = (catalog or ScannerCatalog()).ensure(ib)
+
+    # View all scanner parameters in a web browser
+    if open_browser and os.path.exists(XML_FILE):
+        import webbrowser
+        webbrowser.open(XML_FILE)
+
+    tags = catalog.codes("filters")
+    with open(TAGS_FILE, "w") as f:
+        f.write("col1\n")
+        f.writelines(tag + "\n" for tag in tags)
+    return tags
+
+
+def scan_codes(ib=None, catalog=None):
+    """ Print all the different types of scan codes such as "top percent gainers", etc. """
+    catalog = (catalog or ScannerCatalog()).ensure(ib)
+
+    scan_codes = catalog.codes("scan_codes")
+    print(len(scan_codes), "Scan Codes:")
+    print(scan_codes)
+    return scan_codes
@@ -0,0 +1,671 @@
+"""
+Local stand-in for the IB class so the bots can run without TWS.
+
+SimIB implements the calls the scripts make (reqHistoricalData with
+keepUpToDate updates, reqRealTimeBars, reqTickByTickData,
+reqScannerData, reqScannerSubscription, qualifyContracts, placeOrder,
+cancelOrder, openTrades, openOrders, positions, fills, sleep and their
+async versions) on top of recorded or synthetic 1 hour bars.
+
+Time runs on a virtual clock.  ib.sleep(secs) advances the clock
+instantly instead of waiting, so a full trading day runs in seconds.
+On every tick of the clock the in-progress bars move along a simple
+open -> low -> high -> close path (open -> high -> low -> close for red
+bars), live bar streams get their updateEvent, and working orders fill
+against the price range the path covered.
+
+The last day in the data is replayed as today, earlier days are history.
+ib.clock() is epoch time like time.time(), converted from exchange time
+with the America/New_York zone, so time.localtime(ib.clock()) gives the
+machine's local hours the same as the live bot sees them.  Run with
+TZ=Asia/Ho_Chi_Minh to get the Vietnam hours the hourly bot is tuned for.
+
+Set the SIMULATE_IB environment variable to run a script against the simulator:
+- SIMULATE_IB=1                 synthetic bars (SIM_SYMBOLS tickers, SIM_SEED seed)
+- SIMULATE_IB=path/to/bars.csv  recorded bars in the backtest.py format
+SIM_EQUITY sets the starting cash the account values are worked out from.
+"""
+
+import asyncio
+import datetime
+import itertools
+import os
+import zlib
+from bisect import bisect_right
+
+import numpy as np
+import pandas as pd
+from eventkit import Event
+from ib_insync import (
+    IB, AccountValue, BarData, BarDataList, CommissionReport, Contract, ContractDetails, Execution,
+    Fill, OrderStatus, Position, RealTimeBar, RealTimeBarList, ScanData, ScanDataList, TickAttribLast,
+    TickByTickAllLast, Ticker, Trade, util)
+from ib_insync.util import UNSET_INTEGER
+
+from backtest import commission, load_bars
+import market_calendar
+from market_calendar import close_time
+
+# RTH 1 hour bars start at 9:30 then on the hour until the close
+BAR_STARTS = [(9, 30), (10, 0), (11, 0), (12, 0), (13, 0), (14, 0), (15, 0)]
+
+ACCOUNT = "SIM"
+
+# Starting cash, the same as the hourly bot's ACCOUNT_SIZE. Set SIM_EQUITY to change it
+STARTING_EQUITY = 1700
+
+# Buying power as a multiple of the net liquidation (intraday margin)
+BUYING_POWER_MULTIPLE = 4
+
+# Returned by reqScannerParameters
+SCANNER_FILTERS = (
+    "changePercAbove", "changePercBelow", "marketCapAbove1e6", "marketCapBelow1e6", "priceAbove",
+    "priceBelow", "priceRangeAbove", "volumeAbove", "volumeRateAbove")
+SCAN_CODES = ("HOT_BY_VOLUME", "MOST_ACTIVE", "TOP_PERC_GAIN", "TOP_PERC_LOSE")
+SCANNER_LOCATIONS = ("STK.NASDAQ", "STK.NYSE", "STK.US", "STK.US.MAJOR")
+
+
+def synthetic_bars(symbols=300, days=5, seed=0, end_date=None):
+    """ Returns a DataFrame of random walk 1 hour bars across the scanner's price bands """
+    rng = np.random.default_rng(seed)
+    end_date = end_date or datetime.date.today()
+    dates = pd.bdate_range(end=end_date, periods=days)
+
+    rows = []
+    for number in range(symbols):
+        symbol = f"SIM{number:04d}"
+        price = float(np.exp(rng.uniform(np.log(0.6), np.log(19))))
+        volatility = rng.uniform(0.01, 0.04)
+        volume = rng.uniform(2e5, 3e6)
+        for day in dates:
+            # Some tickers gap up each day so the gainers scan has something to find
+            price *= 1 + max(0.0, rng.normal(0.0, 0.04))
+            for hour, minute in BAR_STARTS:
+                open_ = price
+                close = max(0.05, open_ * (1 + rng.normal(0.0, volatility)))
+                high = max(open_, close) * (1 + abs(rng.normal(0.0, volatility / 2)))
+                low = min(open_, close) * (1 - abs(rng.normal(0.0, volatility / 2)))
+                rows.append((
+                    symbol, day + pd.Timedelta(hours=hour, minutes=minute),
+                    round(open_, 2), round(high, 2), round(low, 2), round(close, 2),
+                    int(volume * rng.uniform(0.05, 0.3))))
+                price = close
+
+    return pd.DataFrame(rows, columns=["symbol", "date", "open", "high", "low", "close", "volume"])
+
+
+class _SymbolDay:
+    """ Today's bars of one symbol plus its history, with the intrabar price path """
+
+    def __init__(self, bars, today):
+        bars = bars.sort_values("date")
+        is_today = bars["date"].dt.date == today
+        self.history = bars[~is_today]
+        today_bars = bars[is_today]
+
+        self.starts = list(today_bars["date"].dt.to_pydatetime())
+        close = datetime.datetime.combine(today, close_time(today))
+        self.ends = self.starts[1:] + [close]
+        self.ohlcv = today_bars[["open", "high", "low", "close", "volume"]].to_numpy(dtype=float)
+        self.previous_close = (
+            float(self.history["close"].iloc[-1]) if len(self.history) else self.ohlcv.item(0, 0))
+
+    def bar_index(self, when):
+        """ Index of the bar in progress at exchange time when, -1 before the open """
+        return bisect_right(self.starts, when) - 1
+
+    def is_open(self, when):
+        return bool(self.starts) and self.starts[0] <= when < self.ends[-1]
+
+    def _path(self, index):
+        """ Path vertices as (fraction of the bar, price) """
+        open_, high, low, close, _ = self.ohlcv[index].tolist()
+        first, second = (low, high) if close >= open_ else (high, low)
+        return [(0.0, open_), (1 / 3, first), (2 / 3, second), (1.0, close)]
+
+    def _fraction(self, index, when):
+        start, end = self.starts[index], self.ends[index]
+        return min(1.0, max(0.0, (when - start) / (end - start)))
+
+    def price(self, when):
+        """ Last traded price at exchange time when """
+        index = self.bar_index(when)
+        if index < 0:
+            return self.previous_close
+        fraction = self._fraction(index, when)
+        points = self._path(index)
+        for (f0, p0), (f1, p1) in zip(points, points[1:]):
+            if fraction <= f1:
+                return p0 + (p1 - p0) * (fraction - f0) / (f1 - f0)
+        return points[-1][1]
+
+    def partial_bar(self, index, when):
+        """ (open, high, low, close, volume) of bar index as it stood at exchange time when """
+        fraction = self._fraction(index, when)
+        points = [price for f, price in self._path(index) if f <= fraction]
+        current = self.price(when) if fraction < 1 else self.ohlcv.item(index, 3)
+        points.append(current)
+        return (
+            self.ohlcv.item(index, 0), float(max(points)), float(min(points)), float(current),
+            self.ohlcv.item(index, 4) * fraction)
+
+    def price_range(self, start, end):
+        """ Lowest and highest price traded between two exchange times """
+        prices = [self.price(start), self.price(end)]
+        for index in range(max(0, self.bar_index(start)), self.bar_index(end) + 1):
+            for fraction, price in self._path(index):
+                when = self.starts[index] + (self.ends[index] - self.starts[index]) * fraction
+                if start <= when <= end:
+                    prices.append(price)
+        return min(prices), max(prices)
+
+    def volume(self, when):
+        index = self.bar_index(when)
+        if index < 0:
+            return 0.0
+        return float(self.ohlcv[:index, 4].sum()) + self.partial_bar(index, when)[4]
+
+
+class _Client:
+    """ The parts of ib.client the scripts use """
+
+    def __init__(self):
+        self._reqIds = itertools.count(1)
+
+    def getReqId(self):
+        return next(self._reqIds)
+
+
+class SimIB:
+    """ Drop-in replacement for ib_insync.IB driven by a virtual clock """
+
+    events = IB.events
+
+    def __init__(self, bars=None, start=None, tick=5):
+        for name in self.events:
+            setattr(self, name, Event(name))
+
+        bars = synthetic_bars() if bars is None else bars.copy()
+        bars["date"] = pd.to_datetime(bars["date"])
+        today = bars["date"].dt.date.max()
+        self.symbols = {
+            symbol: _SymbolDay(symbol_bars, today) for symbol, symbol_bars in bars.groupby("symbol")}
+
+        # Virtual clock in exchange time. Starts half an hour before the open by default
+        open_time = datetime.datetime.combine(today, datetime.time(*BAR_STARTS[0]))
+        self.now = start or open_time - datetime.timedelta(minutes=30)
+        self.tick = tick
+
+        self.client = _Client()
+        self._connected = False
+        self._con_ids = {}
+        self._streams = {}  # reqId -> BarDataList
+        self._realtime_bars = {}  # reqId -> RealTimeBarList
+        self._tickers = {}  # symbol -> Ticker with tick-by-tick last prices
+        self._scanner_subscriptions = {}  # reqId -> ScanDataList
+        self._trades = {}   # orderId -> Trade
+        self._fills = []
+        self._positions = {}  # symbol -> [contract, quantity, average cost]
+        self._exec_ids = itertools.count(1)
+        self.starting_equity = STARTING_EQUITY
+        self._cash = self.starting_equity
+
+    @classmethod
+    def from_env(cls):
+        """ Build a simulator from the SIMULATE_IB, SIM_SYMBOLS, SIM_SEED and SIM_EQUITY environment variables """
+        source = os.environ.get("SIMULATE_IB", "1")
+        if os.path.exists(source):
+            ib = cls(load_bars(source))
+        else:
+            ib = cls(synthetic_bars(
+                int(os.environ.get("SIM_SYMBOLS", 300)), seed=int(os.environ.get("SIM_SEED", 0))))
+        if os.environ.get("SIM_EQUITY"):
+            ib.starting_equity = ib._cash = float(os.environ["SIM_EQUITY"])
+        return ib
+
+    # Connection
+
+    def connect(self, host="127.0.0.1", port=7497, clientId=1, *args, **kwargs):
+        self._connected = True
+        self.connectedEvent.emit()
+        return self
+
+    def isConnected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._connected = False
+        self.disconnectedEvent.emit()
+
+    # Clock
+
+    def clock(self):
+        """ Virtual time as epoch seconds, like time.time() """
+        return market_calendar.timestamp(self.now)
+
+    def sleep(self, secs=0.02):
+        """ Advance the virtual clock, updating bar streams and working orders along the way """
+        # Let anything waiting on the real event loop (scheduler timers, etc.) run
+        util.run(asyncio.sleep(0))
+
+        target = self.now + datetime.timedelta(seconds=secs)
+        while self.now < target:
+            previous = self.now
+            self.now = min(target, self.now + datetime.timedelta(seconds=self.tick))
+            self._step(previous, self.now)
+        return True
+
+    def run(self, *awaitables, timeout=None):
+        return util.run(*awaitables, timeout=timeout)
+
+    # Contracts
+
+    def qualifyContracts(self, *contracts):
+        qualified = []
+        for contract in contracts:
+            if contract.symbol in self.symbols:
+                contract.conId = self._con_id(contract.symbol)
+                contract.primaryExchange = "NASDAQ"
+                contract.localSymbol = contract.symbol
+                contract.tradingClass = "NMS"
+                qualified.append(contract)
+        return qualified
+
+    async def qualifyContractsAsync(self, *contracts):
+        return self.qualifyContracts(*contracts)
+
+    # Market data
+
+    def reqHistoricalData(
+            self, contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+            useRTH, formatDate=1, keepUpToDate=False, chartOptions=[], timeout=60):
+        bars = BarDataList()
+        bars.reqId = self.client.getReqId()
+        bars.contract = contract
+        bars.durationStr = durationStr
+        bars.barSizeSetting = barSizeSetting
+        bars.keepUpToDate = keepUpToDate
+
+        symbol_day = self.symbols.get(contract.symbol)
+        if symbol_day is None:
+            return bars
+
+        if barSizeSetting == "1 hour":
+            for index in range(symbol_day.bar_index(self.now) + 1):
+                bars.append(self._hourly_bar(symbol_day, index))
+        else:
+            bars.extend(self._daily_bars(symbol_day, durationStr, barSizeSetting))
+
+        if keepUpToDate:
+            self._streams[bars.reqId] = bars
+        return bars
+
+    async def reqHistoricalDataAsync(self, *args, **kwargs):
+        return self.reqHistoricalData(*args, **kwargs)
+
+    def cancelHistoricalData(self, bars):
+        self._streams.pop(bars.reqId, None)
+
+    def reqRealTimeBars(self, contract, barSize, whatToShow, useRTH, realTimeBarsOptions=[]):
+        """ A bar for every tick of the clock (5 seconds by default) while the market is open """
+        bars = RealTimeBarList()
+        bars.reqId = self.client.getReqId()
+        bars.contract = contract
+        bars.barSize = barSize
+        bars.whatToShow = whatToShow
+        bars.useRTH = useRTH
+        bars.realTimeBarsOptions = realTimeBarsOptions
+        if contract.symbol in self.symbols:
+            self._realtime_bars[bars.reqId] = bars
+        return bars
+
+    def cancelRealTimeBars(self, bars):
+        self._realtime_bars.pop(bars.reqId, None)
+
+    def reqTickByTickData(self, contract, tickType, numberOfTicks=0, ignoreSize=False):
+        """ Ticks at the low, high and last price of every tick of the clock while the market is open """
+        ticker = Ticker(contract=contract)
+        if contract.symbol in self.symbols:
+            self._tickers[contract.symbol] = ticker
+        return ticker
+
+    def cancelTickByTickData(self, contract, tickType):
+        self._tickers.pop(contract.symbol, None)
+
+    def reqScannerData(self, subscription, scannerSubscriptionOptions=[], scannerSubscriptionFilterOptions=[]):
+        """ Top percent gainers that pass the price, change and volume filters """
+        tags = {tag.tag: float(tag.value) for tag in scannerSubscriptionFilterOptions}
+        candidates = []
+        for symbol, symbol_day in self.symbols.items():
+            price = symbol_day.price(self.now)
+            change = (price / symbol_day.previous_close - 1) * 100
+            if not tags.get("priceAbove", 0) <= price <= tags.get("priceBelow", float("inf")):
+                continue
+            if change < tags.get("changePercAbove", float("-inf")):
+                continue
+            if symbol_day.volume(self.now) < tags.get("volumeAbove", 0):
+                continue
+            candidates.append((change, symbol))
+
+        scan_data = ScanDataList()
+        scan_data.subscription = subscription
+        for rank, (_, symbol) in enumerate(sorted(candidates, reverse=True)[:50]):
+            contract = Contract(secType="STK", symbol=symbol, exchange="SMART", currency="USD",
+                                conId=self._con_id(symbol))
+            scan_data.append(ScanData(rank, ContractDetails(contract=contract), "", "", "", ""))
+        return scan_data
+
+    async def reqScannerDataAsync(self, *args, **kwargs):
+        return self.reqScannerData(*args, **kwargs)
+
+    def reqScannerSubscription(
+            self, subscription, scannerSubscriptionOptions=[], scannerSubscriptionFilterOptions=[]):
+        """ Same scan as reqScannerData. The results arrive on the list's updateEvent, like TWS's scannerDataEnd """
+        scan_data = self.reqScannerData(subscription, scannerSubscriptionOptions, scannerSubscriptionFilterOptions)
+        scan_data.reqId = self.client.getReqId()
+        self._scanner_subscriptions[scan_data.reqId] = scan_data
+        asyncio.get_event_loop().call_soon(scan_data.updateEvent.emit, scan_data)
+        return scan_data
+
+    def cancelScannerSubscription(self, dataList):
+        self._scanner_subscriptions.pop(dataList.reqId, None)
+
+    def reqScannerParameters(self):
+        """ A small document in the same layout as TWS's, with the codes the bots use """
+        filters = "".join(
+            f"<RangeFilter><AbstractField><code>{code}</code></AbstractField></RangeFilter>"
+            for code in SCANNER_FILTERS)
+        scan_codes = "".join(f"<ScanType><scanCode>{code}</scanCode></ScanType>" for code in SCAN_CODES)
+        locations = "".join(
+            f"<Location><locationCode>{code}</locationCode></Location>" for code in SCANNER_LOCATIONS)
+        return (
+            "<ScanParameterResponse><InstrumentList><Instrument><type>STK</type></Instrument>"
+            f"</InstrumentList><LocationTree>{locations}</LocationTree>"
+            f"<ScanTypeList>{scan_codes}</ScanTypeList><FilterList>{filters}</FilterList>"
+            "</ScanParameterResponse>")
+
+    # Orders
+
+    def placeOrder(self, contract, order):
+        """ Submit a new order, or modify the working order with the same orderId """
+        if not order.orderId:
+            order.orderId = self.client.getReqId()
+
+        trade = self._trades.get(order.orderId)
+        if trade is not None and trade.isActive():
+            trade.order = order
+            trade.modifyEvent.emit(trade)
+            self.orderModifyEvent.emit(trade)
+            # TWS echoes a modification back as an open order. It sends no order status for it
+            self.openOrderEvent.emit(trade)
+            return trade
+
+        status = OrderStatus.PreSubmitted if order.parentId else OrderStatus.Submitted
+        trade = Trade(contract, order, OrderStatus(
+            orderId=order.orderId, status=status, remaining=order.totalQuantity,
+            parentId=order.parentId))
+        self._trades[order.orderId] = trade
+        self.newOrderEvent.emit(trade)
+        self.openOrderEvent.emit(trade)
+        self._set_status(trade, status)
+
+        # Market orders fill straight away while the market is open
+        if order.orderType == "MKT" and status == OrderStatus.Submitted:
+            self._match(trade, self.now, self.now)
+        return trade
+
+    def cancelOrder(self, order):
+        trade = self._trades.get(order.orderId)
+        if trade is None or trade.isDone():
+            return trade
+        self.cancelOrderEvent.emit(trade)
+        self._set_status(trade, OrderStatus.Cancelled)
+        trade.cancelledEvent.emit(trade)
+
+        # Cancelling a parent cancels its children
+        for child in self._children(order.orderId):
+            self.cancelOrder(child.order)
+        return trade
+
+    def openTrades(self):
+        return [trade for trade in self._trades.values() if not trade.isDone()]
+
+    def openOrders(self):
+        return [trade.order for trade in self.openTrades()]
+
+    def trades(self):
+        return list(self._trades.values())
+
+    def positions(self, account=""):
+        return [
+            Position(ACCOUNT, contract, quantity, average_cost)
+            for contract, quantity, average_cost in self._positions.values() if quantity]
+
+    def fills(self):
+        return list(self._fills)
+
+    def accountValues(self, account=""):
+        """ Net liquidation (cash plus positions at the current price), buying power and available funds """
+        net_liquidation = self._cash + sum(
+            quantity * self.symbols[contract.symbol].price(self.now)
+            for contract, quantity, _ in self._positions.values() if quantity)
+        buying_power = net_liquidation * BUYING_POWER_MULTIPLE
+        return [
+            AccountValue(ACCOUNT, tag, f"{value:.2f}", "USD", "")
+            for tag, value in (
+                ("NetLiquidation", net_liquidation), ("BuyingPower", buying_power),
+                ("AvailableFunds", buying_power))]
+
+    def reset_orders(self):
+        """ Forget every order, fill and position e.g. between benchmark runs """
+        self._cash = self.starting_equity
+        self._trades.clear()
+        self._fills.clear()
+        self._positions.clear()
+
+    # Simulation
+
+    def _con_id(self, symbol):
+        return self._con_ids.setdefault(symbol, zlib.crc32(symbol.encode()) & 0x7FFFFFFF)
+
+    def _hourly_bar(self, symbol_day, index):
+        open_, high, low, close, volume = symbol_day.partial_bar(index, self.now)
+        return BarData(
+            date=symbol_day.starts[index], open=open_, high=high, low=low, close=close,
+            volume=volume, average=(high + low + close) / 3, barCount=0)
+
+    def _daily_bars(self, symbol_day, duration, bar_size):
+        """ Daily or weekly bars built from the hourly history plus today so far """
+        history = symbol_day.history.set_index("date")
+        rule = "W-FRI" if bar_size == "1 week" else "D"
+        days = history.resample(rule).agg(
+            {"open": "first", "high": "max", "low": "min", "close": "last", "volume": "sum"}).dropna()
+
+        bars = [
+            BarData(date=date.date(), open=row.open, high=row.high, low=row.low,
+                    close=row.close, volume=row.volume)
+            for date, row in days.iterrows()]
+
+        index = symbol_day.bar_index(self.now)
+        if index >= 0:
+            today = [symbol_day.partial_bar(i, self.now) for i in range(index + 1)]
+            bars.append(BarData(
+                date=self.now.date(), open=today[0][0], high=max(bar[1] for bar in today),
+                low=min(bar[2] for bar in today), close=today[-1][3],
+                volume=sum(bar[4] for bar in today)))
+
+        count = int(duration.split()[0])
+        return bars[-count:]
+
+    def _step(self, previous, now):
+        """ Move the market from one tick to the next """
+        for bars in list(self._streams.values()):
+            symbol_day = self.symbols[bars.contract.symbol]
+            if bars.barSizeSetting != "1 hour":
+                continue
+            index = symbol_day.bar_index(now)
+            # Nothing moves before the open, or after the close once the last bar is settled
+            if index < 0 or (not symbol_day.is_open(previous) and len(bars) > index):
+                continue
+
+            has_new_bar = False
+            while len(bars) <= index:
+                if bars:
+                    bars[-1] = self._hourly_bar(symbol_day, len(bars) - 1)
+                bars.append(self._hourly_bar(symbol_day, len(bars)))
+                has_new_bar = True
+            bars[-1] = self._hourly_bar(symbol_day, index)
+            bars.updateEvent.emit(bars, has_new_bar)
+            self.barUpdateEvent.emit(bars, has_new_bar)
+
+        for bars in list(self._realtime_bars.values()):
+            symbol_day = self.symbols[bars.contract.symbol]
+            if symbol_day.is_open(previous):
+                low, high = symbol_day.price_range(previous, now)
+                bars.append(RealTimeBar(
+                    time=previous, open_=symbol_day.price(previous), high=high, low=low,
+                    close=symbol_day.price(now), volume=symbol_day.volume(now) - symbol_day.volume(previous)))
+                bars.updateEvent.emit(bars, True)
+
+        for ticker in list(self._tickers.values()):
+            symbol_day = self.symbols[ticker.contract.symbol]
+            if symbol_day.is_open(previous):
+                low, high = symbol_day.price_range(previous, now)
+                ticker.tickByTicks = [
+                    TickByTickAllLast(1, now, price, 100, TickAttribLast(), "", "")
+                    for price in (low, high, symbol_day.price(now))]
+                ticker.updateEvent.emit(ticker)
+
+        for trade in list(self._trades.values()):
+            if trade.orderStatus.status == OrderStatus.Submitted:
+                self._match(trade, previous, now)
+
+    def _match(self, trade, previous, now):
+        """ Fill a working order if the price path since the last tick reached it """
+        order = trade.order
+        symbol_day = self.symbols[trade.contract.symbol]
+        if not symbol_day.is_open(now):
+            return
+
+        low, high = symbol_day.price_range(previous, now)
+        last = symbol_day.price(previous)
+        buy = order.action == "BUY"
+
+        if order.orderType == "MKT":
+            self._fill(trade, trade.orderStatus.remaining, symbol_day.price(now))
+
+        elif order.orderType == "LMT":
+            if _is_set(order.scaleInitLevelSize) and order.scaleInitLevelSize > 0 and not buy:
+                self._fill_scale_levels(trade, high)
+            elif buy and low <= order.lmtPrice:
+                self._fill(trade, trade.orderStatus.remaining, min(last, order.lmtPrice))
+            elif not buy and high >= order.lmtPrice:
+                self._fill(trade, trade.orderStatus.remaining, max(last, order.lmtPrice))
+
+        elif order.orderType == "STP":
+            if buy and high >= order.auxPrice:
+                self._fill(trade, trade.orderStatus.remaining, max(last, order.auxPrice))
+            elif not buy and low <= order.auxPrice:
+                self._fill(trade, trade.orderStatus.remaining, min(last, order.auxPrice))
+
+        elif order.orderType == "STP LMT":
+            # Triggered at the stop price and filled if that is within the limit
+            if buy and high >= order.auxPrice and order.auxPrice <= order.lmtPrice:
+                self._fill(trade, trade.orderStatus.remaining, max(last, order.auxPrice))
+            elif not buy and low <= order.auxPrice and order.auxPrice >= order.lmtPrice:
+                self._fill(trade, trade.orderStatus.remaining, min(last, order.auxPrice))
+
+    def _fill_scale_levels(self, trade, high):
+        """ Scale out take profit: one fill per price level reached """
+        order = trade.order
+        increment = order.scalePriceIncrement if _is_set(order.scalePriceIncrement) else 0
+        subsequent = order.scaleSubsLevelSize if _is_set(order.scaleSubsLevelSize) else order.totalQuantity
+
+        while trade.orderStatus.remaining > 0:
+            filled = trade.orderStatus.filled
+            level = 0 if filled < order.scaleInitLevelSize else (
+                1 + (filled - order.scaleInitLevelSize) // max(subsequent, 1))
+            price = round(order.lmtPrice + level * increment, 4)
+            if high < price:
+                return
+            size = order.scaleInitLevelSize if level == 0 else subsequent
+            self._fill(trade, min(size, trade.orderStatus.remaining), price)
+
+    def _fill(self, trade, quantity, price):
+        if quantity <= 0:
+            return
+        contract, order, status = trade.contract, trade.order, trade.orderStatus
+        bought = order.action == "BUY"
+
+        exec_id = f"sim.{next(self._exec_ids)}"
+        fee = float(commission(quantity, price))
+        status.filled += quantity
+        status.remaining -= quantity
+        status.avgFillPrice = (
+            (status.avgFillPrice * (status.filled - quantity) + price * quantity) / status.filled)
+        status.lastFillPrice = price
+
+        execution = Execution(
+            execId=exec_id, time=self.now, acctNumber=ACCOUNT, exchange="SMART",
+            side="BOT" if bought else "SLD", shares=quantity, price=price,
+            orderId=order.orderId, cumQty=status.filled, avgPrice=status.avgFillPrice)
+        fill = Fill(contract, execution, CommissionReport(exec_id, fee, "USD"), self.now)
+        trade.fills.append(fill)
+        self._fills.append(fill)
+        self._update_position(contract, quantity if bought else -quantity, price)
+        self._cash -= (quantity if bought else -quantity) * price + fee
+        for value in self.accountValues():
+            self.accountValueEvent.emit(value)
+
+        trade.fillEvent.emit(trade, fill)
+        self.execDetailsEvent.emit(trade, fill)
+        trade.commissionReportEvent.emit(trade, fill, fill.commissionReport)
+        self.commissionReportEvent.emit(trade, fill, fill.commissionReport)
+
+        if status.remaining <= 0:
+            self._set_status(trade, OrderStatus.Filled)
+            trade.filledEvent.emit(trade)
+        else:
+            self._set_status(trade, OrderStatus.Submitted)
+
+        if order.parentId:
+            self._reduce_siblings(trade, quantity)
+        else:
+            # A filled parent releases its bracket children
+            for child in self._children(order.orderId):
+                if child.orderStatus.status == OrderStatus.PreSubmitted:
+                    child.order.totalQuantity = status.filled
+                    child.orderStatus.remaining = status.filled
+                    self._set_status(child, OrderStatus.Submitted)
+
+    def _reduce_siblings(self, trade, quantity):
+        """ Bracket children share one position: a fill on one reduces (or cancels) the others """
+        for sibling in self._children(trade.order.parentId):
+            if sibling is trade or sibling.isDone():
+                continue
+            sibling.orderStatus.remaining -= quantity
+            if sibling.orderStatus.remaining <= 0:
+                self._set_status(sibling, OrderStatus.Cancelled)
+                sibling.cancelledEvent.emit(sibling)
+
+    def _children(self, parent_id):
+        return [trade for trade in self._trades.values() if trade.order.parentId == parent_id]
+
+    def _update_position(self, contract, quantity, price):
+        _, position, average_cost = self._positions.get(contract.symbol, (contract, 0, 0.0))
+        new_position = position + quantity
+        if new_position and (position >= 0) == (quantity > 0):
+            average_cost = (average_cost * position + price * quantity) / new_position
+        elif not new_position:
+            average_cost = 0.0
+        self._positions[contract.symbol] = [contract, new_position, average_cost]
+        self.positionEvent.emit(Position(ACCOUNT, contract, new_position, average_cost))
+
+    def _set_status(self, trade, status):
+        trade.orderStatus.status = status
+        trade.statusEvent.emit(trade)
+        self.orderStatusEvent.emit(trade)
+
+
+def _is_set(value):
+    return value is not None and value != UNSET_INTEGER and value < 1e300
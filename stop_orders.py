@@ -0,0 +1,105 @@
+"""
+Batched stop loss modifications shared by the hourly and swing scripts.
+
+Rolling stops used to walk the open trades one at a time, resubmit every
+stop whether it moved or not and sleep after each one.  Instead:
+- the caller works out every new stop price in one pass from bars it
+    already holds
+- only stops whose auxPrice actually changes are modified
+- all modifications are submitted at once
+- each one is confirmed by the open order TWS echoes back with the new
+    stop price rather than by sleeping.  The order status is no use for
+    this: TWS sends none for the modification of a stop that is still
+    PreSubmitted, e.g. the stop of a bracket whose entry hasn't filled
+- the stop is modified on a copy of the order, so the trade only shows
+    the new price once TWS has echoed it and a stale or rejected echo
+    can't confirm it
+
+Stops that aren't confirmed within the timeout are reported so they can
+be checked in TWS.
+"""
+
+import asyncio
+import copy
+
+import metrics
+
+# Seconds to wait for TWS to acknowledge all the modifications
+CONFIRM_TIMEOUT = 5
+
+
+def stop_price(low):
+    """ Stop price just under a bar's low. Sub dollar stocks get a tighter offset and 3 decimals """
+    if low < 1:
+        return round((low - 0.005), 3)
+    return round((low - 0.01), 2)
+
+
+def stop_changes(trades_and_lows):
+    """
+    Returns a list of (trade, new stop price) for every (trade, low) pair
+    whose stop price would actually change
+    """
+    changes = []
+    for trade, low in trades_and_lows:
+        new_stop = stop_price(low)
+        if round(trade.order.auxPrice, 3) != new_stop:
+            changes.append((trade, new_stop))
+    return changes
+
+
+async def modify_stops_async(ib, changes, scheduler=None, timeout=CONFIRM_TIMEOUT):
+    """
+    Submit every (trade, new stop price) modification at once and wait for
+    TWS to acknowledge them.  Returns the list of trades that weren't confirmed.
+    """
+    if not changes:
+        return []
+
+    loop = asyncio.get_event_loop()
+    pending = {}    # order ID -> (trade, new stop price, future)
+    for trade, new_stop in changes:
+        pending[trade.order.orderId] = (trade, new_stop, loop.create_future())
+
+    def on_open_order(trade):
+        # trade.order holds the prices TWS echoed back, the modification below never touches it
+        entry = pending.get(trade.order.orderId)
+        if entry is None:
+            return
+        _, new_stop, future = entry
+        if not future.done() and round(trade.order.auxPrice, 3) == new_stop:
+            future.set_result(trade)
+
+    # Listen before submitting so an immediate acknowledgement can't be missed
+    ib.openOrderEvent += on_open_order
+    try:
+        for trade, new_stop in changes:
+            # Modify a copy so only TWS's echo changes the stop price of the trade
+            order = copy.copy(trade.order)
+            order.auxPrice = new_stop
+            if scheduler is not None:
+                scheduler.submit("order", ib.placeOrder, trade.contract, order)
+            else:
+                ib.placeOrder(trade.contract, order)
+        metrics.count("stops_modified", len(changes))
+
+        await asyncio.wait([future for _, _, future in pending.values()], timeout=timeout)
+    finally:
+        ib.openOrderEvent -= on_open_order
+
+    unconfirmed = []
+    for trade, _, future in pending.values():
+        if not future.done():
+            future.cancel()
+            unconfirmed.append(trade)
+            print(f"*** WARNING: Stop loss change not confirmed for: {trade.contract.symbol} ***")
+    metrics.count("stops_unconfirmed", len(unconfirmed))
+    return unconfirmed
+
+
+def modify_stops(ib, changes, scheduler=None, timeout=CONFIRM_TIMEOUT):
+    """ Blocking version of modify_stops_async. Must not be called from inside event callbacks """
+    unconfirmed = ib.run(modify_stops_async(ib, changes, scheduler, timeout))
+
+    print(f"{len(changes)} stop orders modified, {len(changes) - len(unconfirmed)} confirmed")
+    return unconfirmed
@@ -1,56 +1,122 @@
 from ib_insync import *
 import sys
+import time
 
+import common
+import connection
+import metrics
+import resample
+import stop_orders
+from account import Account, RiskAllocator
+from bar_cache import BarCache
+from bar_streams import BarStreamRegistry
+from contract_cache import ContractCache
+from order_book import OrderBook
+from request_scheduler import RequestScheduler
 
-# Instantiate IB class and establish connection
-ib = IB()
-# * Change port id when on live account to 7496, Paper account to 7497 
-ib.connect('127.0.0.1', 7496, 1)
-if ib.isConnected():
-    print("Connection established")
-else:
-    print("Failed to connect")
 
+# Instantiate IB class. The connection is only opened by main()
+# * Set SIMULATE_IB to run against the local simulator instead of TWS (see sim_ib.py)
+ib = connection.create_ib()
 
-def main():
+# Every request to TWS is paced through the scheduler. Orders always go first
+scheduler = RequestScheduler(ib)
 
-    place_orders = True
+# Qualified contracts are cached so each symbol only round trips to TWS once
+contracts = ContractCache(ib, scheduler=scheduler)
+
+# Daily bars. Change TIMEFRAME to "weekly" to order from the weekly bars, resampled from the daily ones
+BAR_DURATION = "5 D"
+BAR_SIZE = "1 day"
+TIMEFRAME = "daily"
+
+# Order bars come from the same on-disk daily bars as the swing scan (see bar_cache.py)
+bar_cache = BarCache(
+    ib, BAR_SIZE, "5 W", scheduler=scheduler, clock=getattr(ib, "clock", time.time))
+
+# Daily bars for the stop loss roll, requested for all the stops at once
+daily_bars = BarStreamRegistry(ib, duration=BAR_DURATION, bar_size=BAR_SIZE, scheduler=scheduler)
+
+# Position sizing. Orders are sized against the streamed net liquidation, ACCOUNT_SIZE until it arrives
+ACCOUNT_SIZE = 600
+RISK_PERCENT = 0.01
+
+# Cap on the risk of all the swing brackets and positions together (see account.py)
+MAX_OPEN_RISK_PERCENT = 0.06
+
+# Open orders and account values, for the open risk already taken
+order_book = OrderBook(ib)
+account = Account(ib, ACCOUNT_SIZE)
+risk_allocator = RiskAllocator(account, order_book, RISK_PERCENT, MAX_OPEN_RISK_PERCENT)
+
+
+def main(tickers=None, place_orders=True, port=connection.LIVE_PORT, client_id=1):
+    """ Place swing orders for tickers (defaults to the list below) or only update the stop losses """
+
+    # * Change port id when on live account to 7496, Paper account to 7497
+    connection.connect(ib, port, client_id)
+    order_book.sync()
+    account.sync()
 
     if not place_orders:
         adjust_stop_losses()
+        scheduler.drain()
+        metrics.export()
         print("Stop losses have been updated")
 
-    tickers = []
+    if tickers is None:
+        tickers = []
 
     position_value = 0
     
     if place_orders:
 
+        # Load the bars of every ticker at once
+        bars_by_ticker = bar_cache.get_many(contracts.get_many(tickers))
+        account.report()
+
+        orders = []
         for ticker in tickers:
 
-            # Create a contract
-            contract = Stock(ticker, "SMART", "USD")
-            ib.qualifyContracts(contract)
-            df = build_dataframe(contract)
+            # Get the qualified contract from the cache
+            contract = contracts.get(ticker)
+            bars = bars_by_ticker.get(ticker)
+            if bars is None:
+                print(f"*** WARNING: No bars for {ticker}, order not placed ***")
+                continue
+            bar = resample.timeframes(bars, [TIMEFRAME])[TIMEFRAME][-1]
 
             # Set stop limit prices
-            if df.open.iloc[-1] < 1:
-                stop_limit = round((df.high.iloc[-1] + 0.005), 3)
+            if bar["open"] < 1:
+                stop_limit = round((bar["high"] + 0.005), 3)
             else:
-                stop_limit = round((df.high.iloc[-1] + 0.01), 2)
-            limit_price = round((df.high.iloc[-1] + 0.02), 2)
+                stop_limit = round((bar["high"] + 0.01), 2)
+            limit_price = round((bar["high"] + 0.02), 2)
 
             # Set stop loss
-            if df.open.iloc[-1] < 1:
-                stop_loss = round((df.low.iloc[-1] - 0.005), 3)
+            if bar["open"] < 1:
+                stop_loss = round((bar["low"] - 0.005), 3)
             else:
-                stop_loss = round((df.low.iloc[-1] - 0.01), 2)
+                stop_loss = round((bar["low"] - 0.01), 2)
 
             risk_per_share = round((limit_price - stop_loss), 2)
             take_profit_increment = risk_per_share
             take_profit_level = round(
-                (df.high.iloc[-1] + take_profit_increment), 2)
-            quantity = share_size(risk_per_share)
+                (bar["high"] + take_profit_increment), 2)
+            orders.append((
+                ticker, contract, limit_price, take_profit_level, take_profit_increment,
+                stop_loss, stop_limit, risk_per_share))
+
+        # Size every order together so they stay under the open risk cap
+        quantities = risk_allocator.allocate(
+            [order[-1] for order in orders], [order[2] for order in orders])
+
+        for order, quantity in zip(orders, quantities):
+            ticker, contract, limit_price, take_profit_level, take_profit_increment, stop_loss, stop_limit, _ = order
+            quantity = int(quantity)
+            if quantity <= 0:
+                print(f"*** WARNING: No risk left under the cap, order for {ticker} not placed ***")
+                continue
 
             place_order(
                 contract,
@@ -64,29 +130,14 @@ def main():
             )
             print(f"Order for {ticker} has been placed")
             position_value += round(stop_limit * quantity)
-            
-        print(f"Total position value: ${position_value}")
 
-def build_dataframe(contract):
-    """ Returns a dataframe of weekly bars from a contract argument """
-
-    # Request live updates for historical bars
-    bars = ib.reqHistoricalData(
-        contract,
-        endDateTime="",
-        durationStr= "5 D",          # Change to "5 W" for the weekly, "5 D" for daily
-        barSizeSetting= "1 day",     # Change to "1 week" for weekly, "1 day" for the daily
-        whatToShow="TRADES",
-        useRTH=True,
-        formatDate=1,
-        keepUpToDate=True)
-
-    # Build dataframe from bars data list
-    df = util.df(bars)
-
-    return df
+        # Make sure every queued order has been sent before the script exits
+        scheduler.drain()
+        metrics.export()
+        print(f"Total position value: ${position_value}")
 
 
+@metrics.timed()
 def place_order(contract, action: str,
                 quantity: int,
                 limit_price: float,
@@ -94,106 +145,51 @@ def place_order(contract, action: str,
                 take_profit_increment: float,
                 stop_loss_price: float,
                 stop_limit: float):
-    """ 
+    """
     This function handles all of the order placements into IB.
-    It uses a bracket order to incorporate profit taking and 
-    a stop loss.  
-
-    The take_profit object includes scale attributes so that
-    profit prices can vary depending on the level size.
-    The scaleInitLevelSize is the first scaling out profit level of 
-    the position.  The scaleSubsLevelSize is the next portion that
-    the bracket order will sell at the next profit level. 
-    The scalePriceIncrement is how much the profit level will
-    increase up at each sell point.   
-
-    NOTE: Make sure to always handle order transmission accurately.
-    The transmit attribute for all orders should be set to False
-    except for the last order, which is of course set to True.
+    It uses a GTC bracket order (common.bracket_order) with a stop limit
+    entry triggered at stop_limit, a take profit that scales out a third
+    of the position and then a quarter at a time (outside regular hours too)
+    and a stop loss.
     """
-    # Get an order ID to assign to the parent order
-    parent_order_id = ib.client.getReqId()
-
-    # Parent Stop Limit order
-    parent = Order()
-    parent.orderId = parent_order_id
-    parent.action = action
-    parent.orderType = "STP LMT"
-    parent.totalQuantity = quantity
-    parent.lmtPrice = limit_price
-    parent.auxPrice = stop_limit
-    parent.tif = "GTC"
-    #parent.outsideRth = True
-    parent.transmit = False
-
-    # Profit taking order
-    take_profit = Order()
-    take_profit.orderId = parent.orderId + 1
-    take_profit.action = "SELL" if action == "BUY" else "BUY"
-    take_profit.orderType = "LMT"
-    take_profit.totalQuantity = quantity
-    take_profit.lmtPrice = take_profit_limit_price
-    take_profit.scaleInitLevelSize = quantity // 3
-    take_profit.scaleSubsLevelSize = quantity // 4
-    take_profit.scalePriceIncrement = take_profit_increment
-    take_profit.parentId = parent_order_id
-    take_profit.tif = "GTC"
-    take_profit.outsideRth = True
-    take_profit.transmit = False
-
-    # Stop loss order
-    stop_loss = Order()
-    stop_loss.orderId = parent.orderId + 2
-    stop_loss.action = "SELL" if action == "BUY" else "BUY"
-    stop_loss.orderType = "STP"
-    stop_loss.auxPrice = stop_loss_price
-    stop_loss.totalQuantity = quantity
-    stop_loss.parentId = parent_order_id
-    stop_loss.tif = "GTC"
-    stop_loss.transmit = True
-
-    bracket_order = [parent, take_profit, stop_loss]
-
-    for order in bracket_order:
-        ib.placeOrder(contract, order)
-
-
-def adjust_stop_losses():                                               
-    """ Function will update all hourly stop losses """                                                
-
-    for trade in ib.openTrades():
-
-        if trade.order.orderType == "STP":
-
-            # Create new contract based on the symbol
-            contract = Stock(trade.contract.symbol, "SMART", "USD")
-            ib.qualifyContracts(contract)
-
-            # Make sure the bars data is up to date
-            df = build_dataframe(contract)
-
-            # Replace previous stop order with new price
-            try:
-                if df.low.iloc[-2] < 1:
-                    trade.order.auxPrice = round((df.low.iloc[-1] - 0.005), 3)
-                else:
-                    trade.order.auxPrice = round((df.low.iloc[-1] - 0.01), 2)
-                ib.placeOrder(contract, trade.order)
-            except AttributeError:
-                print(f"*** WARNING: Stop loss not updated for: {trade.contract.symbol} ***")
-                continue
-            ib.sleep(0.5)
+    bracket = common.bracket_order(
+        ib, action, quantity, limit_price, take_profit_limit_price,
+        take_profit_increment, stop_loss_price, stop_limit=stop_limit,
+        scale_sizes=(quantity // 3, quantity // 4), tif="GTC", take_profit_outside_rth=True)
+    common.submit_orders(ib, scheduler, contract, bracket)
 
 
-def share_size(risk_per_share):
-    """ 
-    Function will determine the correct position sizing
-    based on risk amount, account size and risk per share
+@metrics.timed()
+def adjust_stop_losses():
+    """
+    Function will update all swing stop losses to just under the low of the latest daily bar
+    Only stops whose price changes are modified. They are all submitted at once and confirmed from TWS's echo
     """
-    account_size = 600
-    risk_percent = 0.01
-    shares = round((account_size * risk_percent) / risk_per_share)
-    return shares
+
+    # The order book indexes the open stops, no need to scan every open trade
+    stops = order_book.by_type("STP")
+
+    # Load the daily bars for every ticker with a stop at the same time
+    stop_contracts = contracts.get_many(list({trade.contract.symbol for trade in stops}))
+    bars_by_ticker = ib.run(daily_bars.get_many_async(stop_contracts))
+
+    # Work out every new stop price in one pass
+    trades_and_lows = []
+    for trade in stops:
+        bars = bars_by_ticker.get(trade.contract.symbol)
+        if not bars:
+            print(f"*** WARNING: Stop loss not updated for: {trade.contract.symbol} ***")
+            continue
+        trades_and_lows.append((trade, bars[-1].low))
+
+    changes = stop_orders.stop_changes(trades_and_lows)
+    stop_orders.modify_stops(ib, changes, scheduler)
+    daily_bars.cancel_all()
+
+
+def share_size(risk_per_share, price):
+    """ Position size for the swing account, under the open risk cap and the buying power """
+    return risk_allocator.size(risk_per_share, price)
 
 
 if __name__ == '__main__':
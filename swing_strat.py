@@ -6,6 +6,7 @@ This would include inside candles with big volume spikes
 on small cap stocks under $10 with a certain volatility.
 
 The strategy can accomodate for both the daily and weekly.
+Both are scanned together from the same daily bars (see resample.py).
 
 A list of tickers that may be helpful as examples to tune the scanner on:
 - CABA, weekly
@@ -19,55 +20,93 @@ A list of tickers that may be helpful as examples to tune the scanner on:
 """
 
 from ib_insync import *
+import asyncio
 import sys
+import time
 
+import candle_patterns
+import common
+import connection
+import metrics
+import resample
+from bar_cache import BarCache
+from contract_cache import ContractCache
+from request_scheduler import RequestScheduler
 
-# Instantiate IB class and establish connection
-ib = IB()
-ib.connect('127.0.0.1', 7497, 1)  #* Change port id when on live account to 7496
-if ib.isConnected():
-    print("Connection established")
-else:
-    print("Failed to connect")
 
+# Instantiate IB class. The connection is only opened by main()
+# * Set SIMULATE_IB to run against the local simulator instead of TWS (see sim_ib.py)
+ib = connection.create_ib()
 
-def main():
+# Every request to TWS is paced through the scheduler
+scheduler = RequestScheduler(ib)
+
+# Qualified contracts are cached so each symbol only round trips to TWS once
+contracts = ContractCache(ib, scheduler=scheduler)
+
+# Daily bars, enough for the last few weekly bars too. The weekly bars are resampled from them (see resample.py)
+BAR_DURATION = "5 W"
+BAR_SIZE = "1 day"
+
+# Timeframes scanned in the same pass
+TIMEFRAMES = ("daily", "weekly")
+
+# Bars are kept on disk so each scan only requests the bars missing since the last one (see bar_cache.py)
+bar_cache = BarCache(
+    ib, BAR_SIZE, BAR_DURATION, scheduler=scheduler, clock=getattr(ib, "clock", time.time))
+
+# Position sizing
+ACCOUNT_SIZE = 1700
+RISK_PERCENT = 0.02
+
+
+def main(filename="scanresults.csv", port=connection.PAPER_PORT, client_id=1):
+
+    #* Change port id when on live account to 7496
+    try:
+        connection.connect(ib, port, client_id)
+    except (OSError, asyncio.TimeoutError):
+        print("*** TWS is unavailable. Scanning the bars in the bar cache ***")
 
     # Read in scan results from CSV file
     print("Reading in scan results")
-    filename = "scanresults.csv"
     scan_results = scanner(filename)
     print(f"{len(scan_results)} tickers found in scanner")
 
-    # Initialize watchlist
-    watchlist = []
+    # Initialize a watchlist per timeframe
+    watchlists = {timeframe: [] for timeframe in TIMEFRAMES}
 
     # Scan tickers to add to watchlist
     print("Now adding tickers to the watchlist")
-    for ticker in scan_results:
-
-        # Create a contract
-        contract = Stock(ticker, "SMART", "USD")
-        
-        # Use qualify contracts function to automatically fill in additional info
-        ib.qualifyContracts(contract)
-
-        # Create a dataframe of weekly bars
-        df = build_dataframe(contract)
-
-        # Add ticker to watchlist if strategy function returns True
-        try:
-            if check_strategy(df):
-                watchlist.append(ticker)
-                continue
-            if check_strategy_2(df):
-                watchlist.append(ticker)
-        except:
-            print(f"*** Error raised for {ticker} ***")
-            continue
-        
-    print(len(watchlist))
-    print(watchlist)
+    if ib.isConnected():
+        scan_contracts = contracts.get_many(scan_results)
+    else:
+        scan_contracts = [Stock(ticker, "SMART", "USD") for ticker in scan_results]
+
+    # Only the bars missing from the bar cache are requested, all the tickers at once
+    bars_by_ticker = bar_cache.get_many(scan_contracts)
+    bar_cache.report()
+
+    # Every timeframe is built from the same daily bars and stacked together, keyed by (timeframe, ticker)
+    bars_by_key = {}
+    for ticker, bars in bars_by_ticker.items():
+        for timeframe, timeframe_bars in resample.timeframes(bars, TIMEFRAMES).items():
+            bars_by_key[timeframe, ticker] = timeframe_bars
+
+    # Check both strategies for every ticker and timeframe in one vectorized pass
+    keys, ohlc = candle_patterns.stack_bars(bars_by_key)
+    with metrics.span("swing_setups"):
+        setups = candle_patterns.swing_setups(ohlc)
+
+    # Add ticker to the timeframe's watchlist if either strategy passes
+    for row, (timeframe, ticker) in enumerate(keys):
+        if setups["strategy"][row] or setups["strategy_2"][row]:
+            watchlists[timeframe].append(ticker)
+
+    for timeframe, watchlist in watchlists.items():
+        print(f"{timeframe}: {len(watchlist)}")
+        print(watchlist)
+    metrics.export()
 
 
 def scanner(filename):
@@ -81,28 +120,11 @@ def scanner(filename):
     return scan_results
 
 
-def build_dataframe(contract):
-    """ Returns a dataframe of weekly bars from a contract argument """
-
-    # Request live updates for historical bars
-    bars = ib.reqHistoricalData(
-        contract,
-        endDateTime="",
-        durationStr="5 D",          # Change to "5 W" for the weekly, "5 D" for daily
-        barSizeSetting="1 day",     # Change to "1 week" for weekly, "1 day" for the daily
-        whatToShow="TRADES",
-        useRTH=True,
-        formatDate=1,
-        keepUpToDate=True)
-
-    # Build dataframe from bars data list
-    df = util.df(bars)
-
-    return df
-
-
 def check_strategy(df):
-    """ Function checks if strategic criteria has been met """                               
+    """
+    Function checks if strategic criteria has been met
+    * candle_patterns.swing_setups is the vectorized version. Keep the two in sync
+    """                               
                                                                                         
     # Bar prior to inside bar must be green
     if df.close.iloc[-2] > df.open.iloc[-2]:
@@ -121,7 +143,10 @@ def check_strategy(df):
 
 
 def check_strategy_2(df):
-    """ Function checks for the second setup """
+    """
+    Function checks for the second setup
+    * candle_patterns.swing_setups is the vectorized version. Keep the two in sync
+    """
 
     # First and second bars to be checked both must be red
     #if df.close.iloc[-3] < df.open.iloc[-3] and df.close.iloc[-2] < df.open.iloc[-2]:
@@ -137,14 +162,8 @@ def check_strategy_2(df):
 
 
 def share_size(risk_per_share):
-    """ 
-    Function will determine the correct position sizing
-    based on risk amount, account size and risk per share
-    """
-    account_size = 1700
-    risk_percent = 0.02
-    shares = round((account_size * risk_percent) / risk_per_share)
-    return shares
+    """ Position size for the swing account """
+    return common.share_size(risk_per_share, ACCOUNT_SIZE, RISK_PERCENT)
 
 
 if __name__ == '__main__':
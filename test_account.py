@@ -0,0 +1,147 @@
+"""
+Edge cases of RiskAllocator sizing in account.py.
+
+Run with: python -m pytest -q
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from eventkit import Event
+from ib_insync import AccountValue, LimitOrder, OrderStatus, Position, Stock, StopOrder, Trade
+
+import common
+from account import Account, RiskAllocator
+
+RISK_PERCENT = 0.01
+MAX_OPEN_RISK_PERCENT = 0.05
+
+
+class FakeIB:
+    """ Just the account values and positions Account reads """
+
+    def __init__(self):
+        self.accountValueEvent = Event("accountValueEvent")
+        self._positions = []
+
+    def accountValues(self, account=""):
+        return []
+
+    def positions(self, account=""):
+        return self._positions
+
+    def stream(self, tag, value):
+        self.accountValueEvent.emit(AccountValue("DU1", tag, str(value), "USD", ""))
+
+
+class FakeOrderBook:
+    """ Working stop losses, optionally with the parent entry of their bracket """
+
+    def __init__(self):
+        self.stops = []
+        self.parents = {}
+
+    def by_type(self, order_type):
+        return self.stops if order_type == "STP" else []
+
+    def parent(self, trade):
+        return self.parents.get(trade.order.orderId)
+
+    def add_stop(self, symbol, quantity, stop, entry=None):
+        stop_trade = Trade(Stock(symbol, "SMART", "USD"), StopOrder("SELL", quantity, stop), OrderStatus())
+        stop_trade.order.orderId = len(self.stops) + 1
+        if entry is not None:
+            self.parents[stop_trade.order.orderId] = SimpleNamespace(order=LimitOrder("BUY", quantity, entry))
+        self.stops.append(stop_trade)
+
+
+def make_allocator(equity=10_000, buying_power=None):
+    ib = FakeIB()
+    account = Account(ib, fallback_equity=equity)
+    if buying_power is not None:
+        ib.stream("BuyingPower", buying_power)
+    order_book = FakeOrderBook()
+    return RiskAllocator(account, order_book, RISK_PERCENT, MAX_OPEN_RISK_PERCENT), ib, order_book
+
+
+def test_single_bracket_matches_share_size():
+    allocator, _, _ = make_allocator()
+    for risk_per_share in (0.07, 0.5, 1.0, 3.3):
+        assert allocator.size(risk_per_share, 10.0) == common.share_size(risk_per_share, 10_000, RISK_PERCENT)
+
+
+def test_streamed_equity_replaces_the_fallback():
+    allocator, ib, _ = make_allocator(equity=10_000)
+    ib.stream("NetLiquidation", 20_000)
+    assert allocator.size(1.0, 10.0) == 200
+
+
+def test_empty_batch():
+    allocator, _, _ = make_allocator()
+    quantities = allocator.allocate([], [])
+    assert quantities.dtype.kind == "i"
+    assert quantities.tolist() == []
+
+
+@pytest.mark.parametrize("equity", [0, -500])
+def test_no_equity_sizes_nothing(equity):
+    allocator, _, _ = make_allocator(equity=equity)
+    assert allocator.allocate([0.5, 1.0], [10.0, 20.0]).tolist() == [0, 0]
+
+
+def test_zero_or_negative_risk_is_not_sized():
+    allocator, _, _ = make_allocator()
+    assert allocator.allocate([0.0, -1.0, 1.0], [10.0, 10.0, 10.0]).tolist() == [0, 0, 100]
+
+
+def test_only_zero_risk_sizes_nothing():
+    allocator, _, _ = make_allocator()
+    assert allocator.allocate([0.0, 0.0], [10.0, 10.0]).tolist() == [0, 0]
+
+
+def test_batch_over_the_cap_is_scaled_down_evenly():
+    # 10 brackets risking $100 each against $500 of room under the cap
+    allocator, _, _ = make_allocator()
+    quantities = allocator.allocate([1.0] * 10, [1.0] * 10)
+    assert quantities.tolist() == [50] * 10
+    assert quantities.sum() <= 10_000 * MAX_OPEN_RISK_PERCENT
+
+
+def test_open_risk_takes_room_under_the_cap():
+    allocator, ib, order_book = make_allocator()
+
+    # Filled bracket measured from the average cost, unfilled one from its entry limit
+    ib._positions = [Position("DU1", Stock("AAA", "SMART", "USD"), 100, 10.0)]
+    order_book.add_stop("AAA", 100, 9.0)
+    order_book.add_stop("BBB", 50, 4.0, entry=6.0)
+    assert allocator.open_risk() == pytest.approx(200.0)
+
+    # $300 of room left for $1,000 of new risk
+    assert allocator.allocate([1.0] * 10, [1.0] * 10).tolist() == [30] * 10
+
+
+def test_open_risk_over_the_cap_sizes_nothing():
+    allocator, _, order_book = make_allocator()
+    order_book.add_stop("AAA", 1000, 9.0, entry=10.0)
+    assert allocator.open_risk() > 10_000 * MAX_OPEN_RISK_PERCENT
+    assert allocator.allocate([1.0, 0.5], [10.0, 10.0]).tolist() == [0, 0]
+
+
+def test_batch_over_the_buying_power_is_scaled_down():
+    # 3 x 100 shares at $10 is $3,000 against $1,500 of buying power. Risk is under the cap
+    allocator, _, _ = make_allocator(buying_power=1_500)
+    assert allocator.allocate([1.0] * 3, [10.0] * 3).tolist() == [50] * 3
+
+
+def test_tighter_of_the_two_caps_wins():
+    # The risk cap allows half the batch, the buying power only a quarter
+    allocator, _, _ = make_allocator(buying_power=2_500)
+    assert allocator.allocate([1.0] * 10, [10.0] * 10).tolist() == [25] * 10
+
+
+def test_scaled_quantities_round_down():
+    # 3 x 100 shares against $200 of room: 66.67 shares each is floored so the cap holds
+    allocator, _, order_book = make_allocator()
+    order_book.add_stop("AAA", 300, 9.0, entry=10.0)
+    quantities = allocator.allocate([1.0] * 3, [1.0] * 3)
+    assert quantities.tolist() == [66] * 3
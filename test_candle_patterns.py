@@ -0,0 +1,122 @@
+"""
+Checks the vectorized setups in candle_patterns.py against the per-symbol
+check_strategy functions of hourly_strat.py and swing_strat.py they replace.
+
+Run with: python -m pytest -q
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from ib_insync import BarData
+
+import candle_patterns
+import hourly_strat
+import swing_strat
+from bar_store import BarStore
+
+# Small whole number prices so inside bars, equal lows/highs and doji bars all come up often
+SYMBOLS = 400
+BARS = 6
+
+
+def make_bars(seed=7):
+    """ Returns a dict of symbol -> DataFrame of BARS fixed, valid OHLC bars """
+    rng = np.random.default_rng(seed)
+    opens = rng.integers(5, 10, size=(SYMBOLS, BARS)).astype(float)
+    closes = rng.integers(5, 10, size=(SYMBOLS, BARS)).astype(float)
+    highs = np.maximum(opens, closes) + rng.integers(0, 3, size=(SYMBOLS, BARS))
+    lows = np.minimum(opens, closes) - rng.integers(0, 3, size=(SYMBOLS, BARS))
+
+    return {
+        f"SYM{row:03}": pd.DataFrame(
+            {"open": opens[row], "high": highs[row], "low": lows[row], "close": closes[row]})
+        for row in range(SYMBOLS)}
+
+
+@pytest.fixture(scope="module")
+def frames():
+    return make_bars()
+
+
+@pytest.fixture(scope="module")
+def stacked(frames):
+    return candle_patterns.stack_bars(frames)
+
+
+@pytest.mark.parametrize("hour", range(24))
+def test_hourly_setups_match_check_strategy(frames, stacked, hour):
+    symbols, ohlc = stacked
+    setups = candle_patterns.hourly_setups(ohlc, hour)
+
+    expected_1 = [hourly_strat.check_strategy_1(frames[symbol], hour) for symbol in symbols]
+    expected_2 = [hourly_strat.check_strategy_2(frames[symbol], hour) for symbol in symbols]
+    assert setups["strategy_1"].tolist() == expected_1
+    assert setups["strategy_2"].tolist() == expected_2
+
+
+def test_hourly_setups_with_an_hour_per_symbol(frames, stacked):
+    symbols, ohlc = stacked
+    hours = np.arange(len(symbols)) % 24
+    setups = candle_patterns.hourly_setups(ohlc, hours)
+
+    for row, symbol in enumerate(symbols):
+        assert setups["strategy_1"][row] == hourly_strat.check_strategy_1(frames[symbol], hours[row])
+        assert setups["strategy_2"][row] == hourly_strat.check_strategy_2(frames[symbol], hours[row])
+
+
+def test_swing_setups_match_check_strategy(frames, stacked):
+    symbols, ohlc = stacked
+    setups = candle_patterns.swing_setups(ohlc)
+
+    assert setups["strategy"].tolist() == [swing_strat.check_strategy(frames[symbol]) for symbol in symbols]
+    assert setups["strategy_2"].tolist() == [swing_strat.check_strategy_2(frames[symbol]) for symbol in symbols]
+
+
+def test_fixture_covers_every_setup(stacked):
+    """ The comparisons above only mean something if every setup both passes and fails somewhere """
+    _, ohlc = stacked
+    masks = list(candle_patterns.hourly_setups(ohlc, 0).values())
+    masks += list(candle_patterns.swing_setups(ohlc).values())
+    for mask in masks:
+        assert 0 < mask.sum() < len(mask)
+
+
+def test_short_history_never_passes():
+    """ NaN padded symbols fail every setup instead of raising like iloc would """
+    frames = make_bars()
+    short = {symbol: frame.iloc[:1] for symbol, frame in frames.items()}
+    short["EMPTY"] = None
+    _, ohlc = candle_patterns.stack_bars(short)
+
+    assert np.isnan(ohlc[:, :-1]).all()
+    for mask in [*candle_patterns.hourly_setups(ohlc, 0).values(), *candle_patterns.swing_setups(ohlc).values()]:
+        assert not mask.any()
+
+
+def test_stack_bars_accepts_every_bar_container(frames):
+    """ BarDataLists, BarStore ring buffers and structured arrays stack the same as DataFrames """
+    frames = dict(list(frames.items())[:20])
+    _, expected = candle_patterns.stack_bars(frames)
+
+    start = datetime.datetime(2024, 1, 2, 9, 30)
+    bar_lists = {
+        symbol: [
+            BarData(date=start + datetime.timedelta(hours=index), volume=100, **row)
+            for index, row in enumerate(frame.to_dict("records"))]
+        for symbol, frame in frames.items()}
+
+    store = BarStore(depth=8)
+    ring_buffers = {symbol: store.load(symbol, bars) for symbol, bars in bar_lists.items()}
+
+    structured = {
+        symbol: frame.to_records(index=False).astype(
+            [("open", float), ("high", float), ("low", float), ("close", float)])
+        for symbol, frame in frames.items()}
+
+    for bars_by_symbol in (bar_lists, ring_buffers, structured):
+        symbols, ohlc = candle_patterns.stack_bars(bars_by_symbol)
+        assert symbols == list(frames)
+        np.testing.assert_array_equal(ohlc, expected)
@@ -0,0 +1,111 @@
+"""
+Hourly watchlist of tickers waiting for a breakout of their inside bar.
+
+The watchlist used to be a plain list:
+- a ticker passing both setups was appended twice
+- tickers were removed from the list while it was being iterated over,
+    which skipped the ticker after every removal
+- nothing recorded which setup a ticker passed or what its levels were
+
+Instead each ticker has one Setup keyed by symbol, holding the
+strategies it passed, the trigger high and invalidation low of the
+inside bar, the hour it was created, how many entries it has taken and,
+for staged entries, the bracket already working at TWS.
+Membership and removal are dict operations, and iterating returns a
+snapshot so entries can be removed while evaluating them.
+
+Setups are only good for the hour they were found in.  Once the next
+hourly bar starts they are expired: lookups with a later hour drop them
+straight away and expire(hour) drops the rest in one go.
+"""
+
+
+class Setup:
+    """ A watchlist entry for one ticker """
+
+    __slots__ = ("symbol", "strategies", "trigger_high", "invalidation_low", "hour", "entries", "staged")
+
+    def __init__(self, symbol, strategy, trigger_high, invalidation_low, hour):
+        self.symbol = symbol
+        self.strategies = [strategy]
+        self.trigger_high = trigger_high
+        self.invalidation_low = invalidation_low
+        self.hour = hour
+        self.entries = 0
+
+        # Future for the parent Trade of a staged bracket, None until one is submitted
+        self.staged = None
+
+    def __repr__(self):
+        return (
+            f"Setup({self.symbol}, {'/'.join(self.strategies)}, high={self.trigger_high}, "
+            f"low={self.invalidation_low}, hour={self.hour}, entries={self.entries})")
+
+
+class Watchlist:
+    """ Symbol keyed setups for the current hour """
+
+    def __init__(self, max_entries=1):
+        # Entries a setup may take in its hour. Each one still needs the ticker to have no open orders
+        self.max_entries = max_entries
+        self._setups = {}
+
+    def __len__(self):
+        return len(self._setups)
+
+    def __contains__(self, symbol):
+        return symbol in self._setups
+
+    def __iter__(self):
+        """ Iterates over a snapshot of the symbols so entries can be removed along the way """
+        return iter(list(self._setups))
+
+    def __repr__(self):
+        return repr(list(self._setups))
+
+    @property
+    def symbols(self):
+        return set(self._setups)
+
+    def add(self, symbol, strategy, trigger_high, invalidation_low, hour):
+        """ Add a setup. A ticker passing a second strategy in the same hour keeps one entry """
+        setup = self._setups.get(symbol)
+        if setup is not None and setup.hour == hour:
+            if strategy not in setup.strategies:
+                setup.strategies.append(strategy)
+            return setup
+
+        setup = self._setups[symbol] = Setup(symbol, strategy, trigger_high, invalidation_low, hour)
+        return setup
+
+    def get(self, symbol, hour=None):
+        """ The setup for a symbol or None. Passing the current hour drops a setup from an earlier hour """
+        setup = self._setups.get(symbol)
+        if setup is not None and hour is not None and setup.hour != hour:
+            del self._setups[symbol]
+            return None
+        return setup
+
+    def setups(self):
+        """ Snapshot list of every setup """
+        return list(self._setups.values())
+
+    def remove(self, symbol):
+        """ Remove a symbol if it's on the watchlist. Returns its setup or None """
+        return self._setups.pop(symbol, None)
+
+    def can_enter(self, setup):
+        return setup.entries < self.max_entries
+
+    def record_entry(self, setup):
+        setup.entries += 1
+
+    def expire(self, hour):
+        """ Drop every setup not created in hour. Returns the number dropped """
+        expired = [symbol for symbol, setup in self._setups.items() if setup.hour != hour]
+        for symbol in expired:
+            del self._setups[symbol]
+        return len(expired)
+
+    def clear(self):
+        self._setups.clear()